@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_app.settings')
+# Under ASGI the catalog's list and retrieve routes are async views (products/asyncread.py).
+os.environ.setdefault('ASYNC_CATALOG_READS', 'True')
+# Every ASGI request runs its sync code in a thread of its own; don't keep connections open.
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
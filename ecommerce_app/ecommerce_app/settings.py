@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'products.metrics.MetricsMiddleware',
+    'products.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,10 +90,102 @@ DATABASES = {
         'USER': os.getenv('DB_USER'),
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': 'localhost',
-        'PORT': '5432'
+        'PORT': '5432',
+        # Keep connections open per worker and check them before reuse.
+        # ecommerce_app/asgi.py sets DB_CONN_MAX_AGE=0: under ASGI every request
+        # gets its own thread, so a persistent connection would never be reused.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Read replicas (products/routers.py): one alias per host[:port] in
+# DB_REPLICA_HOSTS, with the primary's name and credentials. Safe API requests
+# read from them; clients that just wrote stay on the primary for
+# REPLICA_STICKY_SECONDS. Leave DB_REPLICA_HOSTS unset when running the tests.
+DATABASE_REPLICAS = []
+for number, address in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    host, _, port = address.strip().partition(':')
+    DATABASES[f'replica_{number}'] = dict(
+        DATABASES['default'], HOST=host, PORT=port or DATABASES['default']['PORT'], TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(f'replica_{number}')
+DATABASE_ROUTERS = ['products.routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Local memory by default; point CACHE_BACKEND/CACHE_LOCATION at a shared cache
+# (e.g. django.core.cache.backends.redis.RedisCache) when running several workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'ecommerce-app'),
+    }
+}
+
+# Catalog response cache (products/cache.py); entries are invalidated on write,
+# the timeout only bounds how long superseded entries stay around.
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 300
+
+# Serve list/retrieve of categories, products and product images from async views
+# (products/asyncread.py). ecommerce_app/asgi.py turns this on; leave it off under WSGI.
+ASYNC_CATALOG_READS = os.getenv('ASYNC_CATALOG_READS', 'False') == 'True'
+
+# Best matches a ?q= search keeps without PostgreSQL full-text search; longer
+# result sets are cut and flagged with X-Search-Truncated (products/search.py)
+SEARCH_FALLBACK_RESULT_LIMIT = 1000
+
+# Rows fetched per round trip by the streaming exports (products/exports.py)
+EXPORT_CHUNK_SIZE = 2000
+
+# Rows validated and upserted per batch by the bulk import (products/imports.py)
+IMPORT_BATCH_SIZE = 1000
+
+# Restocks, returns and adjustments go to a ledger and one of STOCK_COUNTER_SHARDS
+# counter rows per product; `manage.py compact_stock` folds them into
+# stock_quantity, STOCK_COMPACTION_BATCH_SIZE products at a time (products/stock.py).
+STOCK_COUNTER_SHARDS = 8
+STOCK_COMPACTION_BATCH_SIZE = 500
+
+# Orders locked and updated per transaction by bulk status transitions (products/transitions.py)
+ORDER_TRANSITION_CHUNK_SIZE = 1000
+
+# Per-endpoint request metrics served at /api/metrics/ (products/metrics.py).
+# A request repeating one query shape this many times is reported as an N+1.
+METRICS_ENABLED = True
+METRICS_N_PLUS_ONE_THRESHOLD = 5
+
+# Thread pool that login and registration hash passwords on (products/hashing.py).
+# Requests beyond workers + queue are refused with 503 instead of waiting.
+PASSWORD_HASHING_WORKERS = int(os.getenv('PASSWORD_HASHING_WORKERS', 2))
+PASSWORD_HASHING_QUEUE = int(os.getenv('PASSWORD_HASHING_QUEUE', 32))
+
+# Payment settlement (products/settlement.py, run `manage.py settle_payments`).
+# PAYMENT_GATEWAY is the dotted path of the gateway client class;
+# products.settlement.FakeGateway approves everything and is only for local runs.
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', '')
+PAYMENT_SETTLEMENT_BATCH_SIZE = 100
+PAYMENT_SETTLEMENT_CONCURRENCY = 10  # gateway calls in flight per worker
+PAYMENT_SETTLEMENT_LEASE = timedelta(minutes=5)
+PAYMENT_SETTLEMENT_MAX_ATTEMPTS = 5
+PAYMENT_SETTLEMENT_RETRY_DELAY = timedelta(seconds=30)  # doubled after every attempt
+PAYMENT_GATEWAY_RETRIES = 2  # immediate retries of a transient error, within one attempt
+PAYMENT_GATEWAY_BACKOFF = 0.2  # seconds, doubled per retry
+PAYMENT_GATEWAY_TIMEOUT = 10.0  # seconds
+
+# Uploaded product images (products/images.py). Variants are made by a thread
+# pool of PRODUCT_IMAGE_WORKERS per process once the upload commits; 0 makes
+# them in the committing thread. `manage.py process_images` catches up.
+PRODUCT_IMAGE_WIDTHS = (160, 320, 640, 1280)
+PRODUCT_IMAGE_FORMAT = 'WEBP'
+PRODUCT_IMAGE_QUALITY = 80
+PRODUCT_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+PRODUCT_IMAGE_WORKERS = int(os.getenv('PRODUCT_IMAGE_WORKERS', 2))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -142,7 +236,7 @@ AUTH_USER_MODEL = 'products.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'products.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -160,10 +254,13 @@ REST_FRAMEWORK = {
         "user": "1000/day",
         "anon": "100/day",
     },
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'products.pagination.KeysetPagination',
     'PAGE_SIZE': 20,  
 }
 
+# How long stock stays reserved for an unpaid order (see products/reservations.py)
+STOCK_RESERVATION_TTL = timedelta(minutes=15)
+
 SIMPLE_JWT = {
     "USER_ID_FIELD": "user_id",          
     "USER_ID_CLAIM": "user_id",          
@@ -171,8 +268,16 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),      
     'ROTATE_REFRESH_TOKENS': False,                   
     'BLACKLIST_AFTER_ROTATION': True,                 
+    'TOKEN_OBTAIN_SERIALIZER': 'products.serializers.ClaimsTokenObtainPairSerializer',
 }
 
+# Authenticated users are cached per worker (products/authentication.py)
+AUTH_USER_CACHE_SIZE = 10000
+AUTH_USER_CACHE_TTL = 60  # seconds
+# Build request.user from the signed role/is_active claims instead of the database.
+# Role changes and deactivation then apply only once the token is reissued.
+JWT_TRUST_USER_CLAIMS = os.getenv('JWT_TRUST_USER_CLAIMS', 'False') == 'True'
+
 # Browser security
 SECURE_BROWSER_XSS_FILTER = True
 SECURE_CONTENT_TYPE_NOSNIFF = True
@@ -0,0 +1,139 @@
+"""
+Sales rollups: units, revenue and order counts per (day, product), with the
+product's category alongside.
+
+Rows are adjusted incrementally whenever orders enter or leave a counted status
+(paid, shipped, delivered): the items of just those orders are aggregated in one
+query and added to, or subtracted from, the rollups with a single
+`INSERT ... ON CONFLICT DO UPDATE SET units_sold = units_sold + excluded.units_sold`. Reports
+(`sales_report`) then read only the rollup table, however long the order
+history grows.
+
+Items added to or removed from an order after it was paid are not tracked
+incrementally; `rebuild_rollups` (the `backfill_sales_rollups` command)
+recomputes any date range from the orders themselves.
+"""
+import uuid
+from decimal import Decimal
+
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import OrderItem, OrderStatus, SalesRollup
+
+COUNTED_STATUSES = frozenset({OrderStatus.PAID, OrderStatus.SHIPPED, OrderStatus.DELIVERED})
+
+
+def _item_totals(items):
+    """Aggregate order items into one row per (day, product)."""
+    return (
+        items.order_by()
+        .values('product_id', 'product__category_id', day=TruncDate('order__created_at'))
+        .annotate(units_sold=Sum('quantity'), gross_revenue=Sum('subtotal'), order_count=Count('order_id', distinct=True))
+    )
+
+
+def _upsert(rows, sign):
+    """Add `sign` x each row to the rollups in one statement."""
+    if not rows:
+        return 0
+    opts = SalesRollup._meta
+    connection = connections[router.db_for_write(SalesRollup)]
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in
+              ('rollup_id', 'day', 'product', 'category', 'units_sold', 'gross_revenue', 'order_count', 'updated_at')]
+    column = {field.name: qn(field.column) for field in fields}
+    now = timezone.now()
+    params = []
+    for row in rows:
+        values = [
+            uuid.uuid4(), row['day'], row['product_id'], row['product__category_id'],
+            sign * row['units_sold'], sign * (row['gross_revenue'] or Decimal('0')), sign * row['order_count'], now,
+        ]
+        params.extend(field.get_db_prep_save(value, connection) for field, value in zip(fields, values))
+    table = qn(opts.db_table)
+    placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    increments = ', '.join(f'{column[name]} = {table}.{column[name]} + excluded.{column[name]}'
+                           for name in ('units_sold', 'gross_revenue', 'order_count'))
+    sql = (
+        f'INSERT INTO {table} ({", ".join(column.values())}) '
+        f'VALUES {", ".join([placeholders] * len(rows))} '
+        f'ON CONFLICT ({column["day"]}, {column["product"]}) DO UPDATE SET {increments}, '
+        f'{column["category"]} = excluded.{column["category"]}, {column["updated_at"]} = excluded.{column["updated_at"]}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+    return len(rows)
+
+
+def apply_orders(order_ids, sign=1, batch_size=500):
+    """Add (sign=1) or remove (sign=-1) the items of the given orders from the rollups."""
+    rows = list(_item_totals(OrderItem.objects.filter(order_id__in=list(order_ids))))
+    with transaction.atomic(using=router.db_for_write(SalesRollup)):
+        for start in range(0, len(rows), batch_size):
+            _upsert(rows[start:start + batch_size], sign)
+    return len(rows)
+
+
+def record_status_change(order_ids, previous, status):
+    """Adjust the rollups for orders that moved from `previous` to `status`."""
+    was_counted, is_counted = previous in COUNTED_STATUSES, status in COUNTED_STATUSES
+    if was_counted != is_counted:
+        apply_orders(order_ids, sign=1 if is_counted else -1)
+
+
+def rebuild_rollups(start=None, end=None, batch_size=1000):
+    """
+    Recompute the rollups of orders placed between `start` and `end` (dates,
+    inclusive) from scratch. Returns the number of rollup rows written.
+    """
+    items = OrderItem.objects.filter(order__status__in=COUNTED_STATUSES)
+    rollups = SalesRollup.objects.all()
+    if start is not None:
+        items = items.filter(order__created_at__date__gte=start)
+        rollups = rollups.filter(day__gte=start)
+    if end is not None:
+        items = items.filter(order__created_at__date__lte=end)
+        rollups = rollups.filter(day__lte=end)
+
+    written = 0
+    with transaction.atomic(using=router.db_for_write(SalesRollup)):
+        rollups.delete()
+        batch = []
+        for row in _item_totals(items).iterator(chunk_size=batch_size):
+            batch.append(SalesRollup(
+                day=row['day'], product_id=row['product_id'], category_id=row['product__category_id'],
+                units_sold=row['units_sold'], gross_revenue=row['gross_revenue'] or Decimal('0'),
+                order_count=row['order_count'],
+            ))
+            if len(batch) >= batch_size:
+                written += len(SalesRollup.objects.bulk_create(batch))
+                batch = []
+        written += len(SalesRollup.objects.bulk_create(batch))
+    return written
+
+
+def sales_report(start=None, end=None, limit=10):
+    """Totals, revenue per day and per category, and the top products, from the rollups only."""
+    rollups = SalesRollup.objects.all()
+    if start is not None:
+        rollups = rollups.filter(day__gte=start)
+    if end is not None:
+        rollups = rollups.filter(day__lte=end)
+    rollups = rollups.order_by()
+    sums = {'units': Sum('units_sold'), 'revenue': Sum('gross_revenue')}
+
+    totals = rollups.aggregate(**sums)
+    return {
+        'totals': {'units': totals['units'] or 0, 'revenue': totals['revenue'] or Decimal('0')},
+        'by_day': list(rollups.values('day').annotate(**sums).order_by('day')),
+        'by_category': list(
+            rollups.values('category_id', category_name=F('category__name')).annotate(**sums).order_by('-revenue')
+        ),
+        'top_products': list(
+            rollups.values('product_id', product_name=F('product__name'))
+            .annotate(**sums, orders=Sum('order_count')).order_by('-revenue', '-units')[:limit]
+        ),
+    }
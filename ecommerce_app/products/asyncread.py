@@ -0,0 +1,209 @@
+"""
+Async list and retrieve for the catalog viewsets under ASGI.
+
+DRF views are synchronous, so under ASGI Django runs each of them in a thread
+through `sync_to_async`. With `ASYNC_CATALOG_READS = True` (the default when
+served through `ecommerce_app/asgi.py`) the `list` and `retrieve` routes of a
+viewset with `AsyncReadMixin` are async views instead. They go through the
+same steps as `APIView.dispatch`, with the same filter backends, permissions,
+throttles, pagination, catalog cache and fast read path. Everything that only
+builds a query or a response stays on the event loop, and only database and
+cache I/O leaves it:
+
+- authentication uses `aauthenticate` when the class has one
+  (CachedJWTAuthentication looks users up with `aget` on a cache miss);
+- pages are read with `aiterator()` and single objects with `aget()`;
+- filter backends that run queries of their own while filtering (a
+  `ModelChoiceFilter` validating its value, a method filter, the first load of
+  the fallback search index) are run through `sync_to_async`, like throttles,
+  which use the synchronous cache API.
+
+Other actions and methods on the same route, and requests for a renderer other
+than JSON (the browsable API builds forms that query the database), are handed
+to the regular synchronous view.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django import shortcuts
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse
+from django_filters import ModelChoiceFilter, ModelMultipleChoiceFilter
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import exceptions, filters
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+ASYNC_ACTIONS = ('list', 'retrieve')
+
+# Backends whose filter_queryset() only builds the query.
+QUERY_BUILDING_BACKENDS = (filters.SearchFilter, filters.OrderingFilter)
+
+
+def enabled():
+    return getattr(settings, 'ASYNC_CATALOG_READS', False)
+
+
+async def aget_object_or_404(queryset, **kwargs):
+    """DRF's get_object_or_404, async: malformed lookup values are a 404 as well."""
+    try:
+        return await shortcuts.aget_object_or_404(queryset, **kwargs)
+    except (TypeError, ValueError, ValidationError):
+        raise Http404
+
+
+def detach(response):
+    """
+    Render a DRF Response into a plain HttpResponse. Django's async handler
+    renders deferred responses in a thread, so returning the Response itself
+    would cost one more thread hop per request.
+    """
+    if not isinstance(response, Response):
+        return response
+    response.render()
+    plain = HttpResponse(response.content, status=response.status_code)
+    for header, value in response.items():
+        plain[header] = value
+    plain.cookies = response.cookies
+    plain.data = response.data  # as on a DRF response, for test clients
+    return plain
+
+
+def rendering(view):
+    """`view`, rendering its response before returning it, for running through sync_to_async."""
+    @functools.wraps(view)
+    def rendered_view(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if isinstance(response, Response):
+            response.render()
+        return response
+    return rendered_view
+
+
+class AsyncReadMixin:
+    """
+    ViewSet mixin that serves `list` and `retrieve` from async views when
+    ASYNC_CATALOG_READS is on. Put it last, just before the viewset base class,
+    so the `alist` / `aretrieve` of the other mixins wrap the ones here.
+    """
+    async_actions = ASYNC_ACTIONS
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        sync_view = super().as_view(actions, **initkwargs)
+        if not enabled() or not any(action in cls.async_actions for action in (actions or {}).values()):
+            return sync_view
+        threaded_view = sync_to_async(rendering(sync_view))
+        actions = dict(actions)
+        if 'get' in actions and 'head' not in actions:
+            actions['head'] = actions['get']
+
+        async def view(request, *args, **kwargs):
+            if actions.get(request.method.lower()) not in cls.async_actions:
+                return detach(await threaded_view(request, *args, **kwargs))
+            self = cls(**initkwargs)
+            self.action_map = actions
+            self.request = request
+            self.args = args
+            self.kwargs = kwargs
+            return detach(await self.adispatch(request, threaded_view, *args, **kwargs))
+
+        # Keeps .cls, .actions, .initkwargs and csrf_exempt for the router, the schema and the middleware.
+        return functools.update_wrapper(view, sync_view)
+
+    async def adispatch(self, request, threaded_view, *args, **kwargs):
+        """APIView.dispatch for the async actions."""
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            self.negotiate(request, *args, **kwargs)
+            if not isinstance(request.accepted_renderer, JSONRenderer):
+                return await threaded_view(request._request, *args, **kwargs)
+            await self.aperform_authentication(request)
+            self.check_permissions(request)
+            await self.acheck_throttles(request)
+            response = await getattr(self, f'a{self.action}')(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    def negotiate(self, request, *args, **kwargs):
+        # The first half of APIView.initial().
+        self.format_kwarg = self.get_format_suffix(**kwargs)
+        request.accepted_renderer, request.accepted_media_type = self.perform_content_negotiation(request)
+        request.version, request.versioning_scheme = self.determine_version(request, *args, **kwargs)
+
+    async def aperform_authentication(self, request):
+        """Request._authenticate(), awaiting authenticators that have an `aauthenticate`."""
+        for authenticator in request.authenticators:
+            aauthenticate = getattr(authenticator, 'aauthenticate', None)
+            try:
+                if aauthenticate is not None:
+                    user_auth = await aauthenticate(request)
+                else:
+                    user_auth = await sync_to_async(authenticator.authenticate)(request)
+            except exceptions.APIException:
+                request._not_authenticated()
+                raise
+            if user_auth is not None:
+                request._authenticator = authenticator
+                request.user, request.auth = user_auth
+                return
+        request._not_authenticated()
+
+    async def acheck_throttles(self, request):
+        if self.throttle_classes:
+            await sync_to_async(self.check_throttles)(request)
+
+    async def afilter_queryset(self, queryset):
+        if self.filters_query_database(queryset):
+            return await sync_to_async(self.filter_queryset)(queryset)
+        return self.filter_queryset(queryset)
+
+    def filters_query_database(self, queryset):
+        """Whether filter_queryset() may run queries itself for this request, not just build one."""
+        for backend_class in self.filter_backends:
+            backend = backend_class()
+            if hasattr(backend, 'queries_database'):
+                if backend.queries_database(self.request, queryset, self):
+                    return True
+            elif isinstance(backend, DjangoFilterBackend):
+                filterset_class = backend.get_filterset_class(self, queryset)
+                if filterset_class is not None and any(
+                    name in self.request.query_params
+                    and (f.method or isinstance(f, (ModelChoiceFilter, ModelMultipleChoiceFilter)))
+                    for name, f in filterset_class.base_filters.items()
+                ):
+                    return True
+            elif not isinstance(backend, QUERY_BUILDING_BACKENDS):
+                return True
+        return False
+
+    async def apaginate_queryset(self, queryset):
+        if self.paginator is None:
+            return None
+        apaginate = getattr(self.paginator, 'apaginate_queryset', None)
+        if apaginate is None:
+            return await sync_to_async(self.paginator.paginate_queryset)(queryset, self.request, view=self)
+        return await apaginate(queryset, self.request, view=self)
+
+    async def aget_object(self):
+        """GenericAPIView.get_object() with aget()."""
+        queryset = await self.afilter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        obj = await aget_object_or_404(queryset, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = await self.afilter_queryset(self.get_queryset())
+        page = await self.apaginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer([obj async for obj in queryset.aiterator()], many=True).data)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return Response(self.get_serializer(await self.aget_object()).data)
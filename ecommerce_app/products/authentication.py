@@ -0,0 +1,165 @@
+"""
+JWT authentication without a user lookup on every request.
+
+`CachedJWTAuthentication` keeps recently seen users in a bounded, per-process
+LRU cache with a TTL. Entries are dropped as soon as the user is saved or
+deleted (see products/signals.py), and the TTL bounds staleness for writes that
+bypass signals, such as queryset updates.
+
+With `JWT_TRUST_USER_CLAIMS = True` the hot path skips the database entirely:
+the user is built from the `role` and `is_active` claims that
+`ClaimsTokenObtainPairSerializer` signs into the token. A role change or
+deactivation then only takes effect when the token is reissued, so keep
+access tokens short-lived if you enable it.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+ROLE_CLAIM = 'role'
+ACTIVE_CLAIM = 'is_active'
+
+
+def cache_size():
+    return getattr(settings, 'AUTH_USER_CACHE_SIZE', 10000)
+
+
+def cache_ttl():
+    return getattr(settings, 'AUTH_USER_CACHE_TTL', 60)
+
+
+class UserCache:
+    """
+    A thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Without an explicit size or TTL, the settings are read on every write.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user
+
+    def set(self, key, user):
+        ttl = cache_ttl() if self.ttl is None else self.ttl
+        max_size = cache_size() if self.max_size is None else self.max_size
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, user)
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+user_cache = UserCache()
+
+
+def invalidate_user(user_id):
+    user_cache.invalidate(str(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        user = self.get_known_user(validated_token)
+        if user is None:
+            # The parent lookup also runs the is_active and revocation checks.
+            user = super().get_user(validated_token)
+            user_cache.set(str(validated_token[api_settings.USER_ID_CLAIM]), copy.copy(user))
+        return user
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views: only a cache miss touches the database, through the async ORM."""
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        user = self.get_known_user(validated_token)
+        if user is None:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+            try:
+                user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist as e:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+            self.check_user(user, validated_token)
+            user_cache.set(str(user_id), copy.copy(user))
+        return user
+
+    def get_known_user(self, validated_token):
+        """The user from the token's claims or the cache, checked; None if it has to be looked up."""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        if getattr(settings, 'JWT_TRUST_USER_CLAIMS', False) and ROLE_CLAIM in validated_token \
+                and ACTIVE_CLAIM in validated_token:
+            return self.get_user_from_claims(validated_token, user_id)
+
+        cached = user_cache.get(str(user_id))
+        if cached is None:
+            return None
+        self.check_user(cached, validated_token)
+        # Hand out a copy so per-request state never leaks between requests.
+        return copy.copy(cached)
+
+    def check_user(self, user, validated_token):
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM
+        ) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+    def get_user_from_claims(self, validated_token, user_id):
+        if api_settings.CHECK_USER_IS_ACTIVE and not validated_token[ACTIVE_CLAIM]:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        id_field = self.user_model._meta.get_field(api_settings.USER_ID_FIELD)
+        # Load it like a row with every other field deferred: it works in queries
+        # such as filter(user=...), other attributes are fetched when read, and
+        # save() only writes the fields taken from the token.
+        loaded = {
+            id_field.attname: id_field.to_python(user_id),
+            'role': validated_token[ROLE_CLAIM],
+            'is_active': validated_token[ACTIVE_CLAIM],
+        }
+        # from_db() takes the values in field order.
+        names = [field.attname for field in self.user_model._meta.concrete_fields if field.attname in loaded]
+        return self.user_model.from_db(DEFAULT_DB_ALIAS, names, [loaded[name] for name in names])
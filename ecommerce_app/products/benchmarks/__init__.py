@@ -0,0 +1,4 @@
+"""
+Benchmarks that run against the configured database.
+Each module is driven by a `manage.py benchmark_*` command.
+"""
@@ -0,0 +1,218 @@
+"""
+Throughput of the catalog reads under concurrent load, on WSGI and on ASGI.
+
+Requests go straight into Django's own handlers, with no network server in
+front of them, so the numbers compare the request paths and not servers:
+
+- `wsgi`: WSGIHandler called from `concurrency` threads, as a threaded WSGI
+  server would call it;
+- `asgi-sync`: ASGIHandler with `concurrency` requests in flight on one event
+  loop and today's synchronous views, each run in a thread by sync_to_async;
+- `asgi`: the same, with the async catalog views (products/asyncread.py).
+
+Whether the catalog routes are async is decided when the URLconf is loaded, so
+`compare_modes` runs every mode in a fresh `manage.py benchmark_concurrency
+--worker` process with ASYNC_CATALOG_READS set to match. Requests cycle through
+the catalog read scenarios of `scenarios.py`. Each request is made as the next
+seeded customer, so throttling and the user cache behave as under real
+traffic. The catalog cache is off unless asked for.
+"""
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.test.utils import override_settings
+
+from products.models import User
+from products.serializers import ClaimsTokenObtainPairSerializer
+
+from .scenarios import SCENARIOS, _fill, percentile, sample_ids
+from .seed import ADMIN_EMAIL, PREFIX
+
+# mode -> ASYNC_CATALOG_READS for its process
+MODES = {'wsgi': False, 'asgi-sync': False, 'asgi': True}
+CATALOG_PATHS = ('/api/categories/', '/api/products/', '/api/product-images/')
+HOST = 'localhost'
+
+
+def catalog_scenarios(names=None):
+    """The catalog list and retrieve scenarios (all of them by default)."""
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if scenario.method == 'get' and scenario.path.startswith(CATALOG_PATHS) and not scenario.path.endswith('/tree/')
+    ]
+    unknown = set(names or ()) - {scenario.name for scenario in scenarios}
+    if unknown:
+        raise LookupError(f'Unknown catalog scenarios: {", ".join(sorted(unknown))}')
+    return [scenario for scenario in scenarios if not names or scenario.name in names]
+
+
+@dataclass
+class ThroughputResult:
+    mode: str
+    concurrency: int
+    requests: int
+    errors: int
+    seconds: float
+    p50_ms: float
+    p99_ms: float
+
+    @property
+    def per_second(self):
+        return self.requests / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def request_plan(scenarios, total, users=100):
+    """`total` (path, access token) pairs, cycling through the scenarios and the seeded customers."""
+    ids = sample_ids()
+    customers = (
+        User.objects.filter(email__startswith=PREFIX).exclude(email=ADMIN_EMAIL).order_by('email')[:users]
+    )
+    tokens = [str(ClaimsTokenObtainPairSerializer.get_token(user).access_token) for user in customers]
+    paths = [_fill(scenario.path, ids) for scenario in scenarios]
+    return [(paths[i % len(paths)], tokens[i % len(tokens)]) for i in range(total)]
+
+
+def wsgi_environ(path, token):
+    url = urlsplit(path)
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': url.path, 'QUERY_STRING': url.query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': HOST, 'SERVER_PORT': '443', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': HOST, 'HTTP_AUTHORIZATION': f'Bearer {token}', 'HTTP_ACCEPT': 'application/json',
+        'wsgi.url_scheme': 'https', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+
+
+def asgi_scope(path, token):
+    url = urlsplit(path)
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'https',
+        'path': url.path, 'raw_path': url.path.encode(), 'query_string': url.query.encode(), 'root_path': '',
+        'headers': [
+            (b'host', HOST.encode()), (b'authorization', f'Bearer {token}'.encode()), (b'accept', b'application/json'),
+        ],
+        'client': ('127.0.0.1', 50000), 'server': (HOST, 443),
+    }
+
+
+def _summary(mode, concurrency, outcomes, seconds):
+    timings = [duration * 1000 for duration, _ in outcomes]
+    return ThroughputResult(
+        mode=mode, concurrency=concurrency, requests=len(outcomes),
+        errors=sum(1 for _, status in outcomes if status != 200), seconds=seconds,
+        p50_ms=percentile(timings, 50), p99_ms=percentile(timings, 99),
+    )
+
+
+def run_wsgi(plan, concurrency):
+    """[(seconds, status)] for every request, sent from `concurrency` threads."""
+    handler = WSGIHandler()
+
+    def send(item):
+        status = []
+        began = time.perf_counter()
+        response = handler(wsgi_environ(*item), lambda line, headers: status.append(int(line[:3])))
+        b''.join(response)
+        response.close()  # request_finished, as a WSGI server would
+        return time.perf_counter() - began, status[0]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(send, plan))
+
+
+async def run_asgi(plan, concurrency):
+    """[(seconds, status)] for every request, `concurrency` of them in flight at once."""
+    handler = ASGIHandler()
+    queue = iter(plan)
+    outcomes = []
+
+    async def send(item):
+        status = []
+        body_sent = False
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Future()  # the client never disconnects
+
+        async def respond(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        began = time.perf_counter()
+        await handler(asgi_scope(*item), receive, respond)
+        return time.perf_counter() - began, status[0]
+
+    async def client():
+        for item in queue:
+            outcomes.append(await send(item))
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return outcomes
+
+
+def run_mode(mode, concurrency_levels, total, names=None, use_cache=False):
+    """ThroughputResults for `mode` in this process; ASYNC_CATALOG_READS must already match it."""
+    if MODES[mode] != getattr(settings, 'ASYNC_CATALOG_READS', False):
+        raise ValueError(f'The {mode} mode needs ASYNC_CATALOG_READS={MODES[mode]}.')
+    scenarios = catalog_scenarios(names)
+    overrides = {'ALLOWED_HOSTS': [HOST]}
+    if not use_cache:
+        overrides['CATALOG_CACHE_TIMEOUT'] = 0
+    results = []
+    with override_settings(**overrides):
+        warmup = request_plan(scenarios, len(scenarios))
+        for concurrency in concurrency_levels:
+            plan = request_plan(scenarios, total)
+            if mode == 'wsgi':
+                run_wsgi(warmup, 1)
+                began = time.perf_counter()
+                outcomes = run_wsgi(plan, concurrency)
+            else:
+                asyncio.run(run_asgi(warmup, 1))
+                began = time.perf_counter()
+                outcomes = asyncio.run(run_asgi(plan, concurrency))
+            results.append(_summary(mode, concurrency, outcomes, time.perf_counter() - began))
+    return results
+
+
+def compare_modes(modes, concurrency_levels, total, names=None, use_cache=False):
+    """Run every mode in its own `manage.py` process and collect the results."""
+    results = []
+    for mode in modes:
+        if mode not in MODES:
+            raise LookupError(f'Unknown mode {mode!r}; choose from {", ".join(MODES)}.')
+        command = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'benchmark_concurrency', '--worker', mode,
+            '--concurrency', ','.join(map(str, concurrency_levels)), '--requests', str(total),
+            '--scenarios', ','.join(names or ()),
+        ] + (['--use-cache'] if use_cache else [])
+        env = dict(os.environ, ASYNC_CATALOG_READS=str(MODES[mode]))
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        results += [ThroughputResult(**row) for row in json.loads(output)]
+    return results
+
+
+def speedups(results, baseline='wsgi'):
+    """{(mode, concurrency): throughput relative to `baseline` at the same concurrency}."""
+    base = {result.concurrency: result.per_second for result in results if result.mode == baseline}
+    return {
+        (result.mode, result.concurrency): result.per_second / base[result.concurrency]
+        for result in results if base.get(result.concurrency)
+    }
@@ -0,0 +1,41 @@
+import uuid
+from decimal import Decimal
+
+from products.models import Category, Order, Product, User
+
+
+def scratch_catalog(stock_quantity=0, users=1):
+    """Create a throwaway category, product and user(s); returns (product, users)."""
+    tag = uuid.uuid4().hex[:12]
+    category = Category.objects.create(name=f'bench-{tag}')
+    product = Product.objects.create(
+        name=f'bench-{tag}', price=Decimal('1.00'), stock_quantity=stock_quantity, category=category,
+    )
+    people = [
+        User.objects.create_user(email=f'bench-{tag}-{i}@example.com', password=None, first_name='Bench', last_name=str(i))
+        for i in range(users)
+    ]
+    return product, people
+
+
+def scratch_products(product, count):
+    """Add `count` more products to the scratch category of `product`."""
+    return Product.objects.bulk_create([
+        Product(
+            name=f'{product.name}-{i:05}', description='Benchmark product. ' * 20,
+            price=Decimal('9.99') + i, stock_quantity=i, category_id=product.category_id,
+        )
+        for i in range(count)
+    ], batch_size=500)
+
+
+def scratch_orders(user, count):
+    return Order.objects.bulk_create([Order(user=user) for _ in range(count)], batch_size=500)
+
+
+def drop_scratch_catalog(product, users):
+    Order.objects.filter(user__in=users).delete()
+    category = product.category
+    Product.objects.filter(category=category).delete()
+    category.delete()
+    User.objects.filter(pk__in=[user.pk for user in users]).delete()
@@ -0,0 +1,79 @@
+"""
+Query-plan checks for the API's read paths.
+
+Every read scenario from `scenarios.py` is requested once to warm up and once
+more with its queries captured; each SELECT is explained, and any sequential
+scan over one of the large tables is reported. On PostgreSQL the plans are
+taken with `enable_seqscan = off`, so a small seeded database cannot hide a
+missing index: the planner only falls back to a sequential scan when no index
+can serve the query at all. SQLite's `EXPLAIN QUERY PLAN` reports
+`SCAN <table>` (without `USING INDEX`) for the same thing.
+"""
+import re
+from dataclasses import dataclass
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from products.models import Address, Order, OrderItem, Payment, Product, ProductImage, User
+
+from .scenarios import SCENARIOS, _client, _request, sample_ids
+
+LARGE_MODELS = (User, Product, ProductImage, Order, OrderItem, Payment, Address)
+
+_SEQUENTIAL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (\w+)(?!.*\bUSING\b)'),
+}
+
+
+@dataclass
+class PlanProblem:
+    scenario: str
+    table: str
+    sql: str
+    plan: str
+
+    def __str__(self):
+        return f'{self.scenario}: sequential scan on {self.table}\n  {self.sql[:300]}\n  {self.plan}'
+
+
+def explain(sql, using=connection):
+    """The plan of `sql` as text, one line per plan node."""
+    with transaction.atomic(using=using.alias), using.cursor() as cursor:
+        if using.vendor == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute(f'{using.ops.explain_query_prefix()} {sql}')
+        return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+
+def sequential_scans(plan, vendor, tables):
+    pattern = _SEQUENTIAL_SCAN.get(vendor)
+    if pattern is None:
+        return []
+    return [table for line in plan.splitlines() for table in pattern.findall(line) if table in tables]
+
+
+def check_plans(names=None):
+    """PlanProblems for the read scenarios (all of them by default)."""
+    if connection.vendor not in _SEQUENTIAL_SCAN:
+        raise NotImplementedError(f'Plan checks are not supported on {connection.vendor}.')
+    tables = {model._meta.db_table for model in LARGE_MODELS}
+    ids = sample_ids()
+    problems = []
+    with override_settings(CATALOG_CACHE_TIMEOUT=0):
+        for scenario in SCENARIOS:
+            if scenario.method != 'get' or (names and scenario.name not in names):
+                continue
+            client = _client(scenario, ids)
+            _request(client, scenario, ids)  # one-off work such as loading the fallback search index
+            with CaptureQueriesContext(connection) as queries:
+                _request(client, scenario, ids)
+            for query in queries.captured_queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                plan = explain(sql)
+                for table in sequential_scans(plan, connection.vendor, tables):
+                    problems.append(PlanProblem(scenario.name, table, sql, plan))
+    return problems
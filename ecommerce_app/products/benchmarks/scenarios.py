@@ -0,0 +1,228 @@
+"""
+API scenarios over the seeded data set (see `seed.py`).
+
+Every router endpoint in `products/urls.py` has at least one scenario. Each
+scenario is one request, issued through the test client as a seeded customer
+(the default), the seeded admin or anonymously, and repeated `iterations` times after a
+warm-up. Writes run inside a transaction that is rolled back, so every
+iteration sees the same data. The report holds latency percentiles and the
+number of SQL queries per scenario, and can be compared with a stored
+baseline to catch regressions.
+"""
+import json
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from products.metrics import collect
+from products.models import Address, Category, Order, OrderItem, Payment, Product, ProductImage, User
+
+from .seed import ADMIN_EMAIL, PASSWORD, PREFIX
+
+
+class Rollback(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    path: str  # formatted with the sample ids from `sample_ids`
+    method: str = 'get'
+    as_user: str = 'customer'  # 'customer', 'admin' or 'anonymous'
+    data: dict = field(default=None, hash=False)
+
+
+SCENARIOS = [
+    Scenario('users-list', '/api/users/', as_user='admin'),
+    Scenario('users-retrieve', '/api/users/{user}/'),
+    Scenario('users-register', '/api/users/', method='post', as_user='anonymous', data={
+        'email': 'seed-register@example.com', 'password': 'Str0ng-pass!', 'first_name': 'New', 'last_name': 'User',
+    }),
+    Scenario('auth-login', '/api/token/', method='post', as_user='anonymous', data={
+        'email': '{customer_email}', 'password': PASSWORD,
+    }),
+    Scenario('auth-register', '/api/register/', method='post', as_user='anonymous', data={
+        'email': 'seed-register@example.com', 'password': 'Str0ng-pass!', 'first_name': 'New', 'last_name': 'User',
+    }),
+    Scenario('categories-list', '/api/categories/'),
+    Scenario('categories-retrieve', '/api/categories/{category}/'),
+    Scenario('categories-tree', '/api/categories/{root_category}/tree/'),
+    Scenario('products-list', '/api/products/'),
+    Scenario('products-list-sparse', '/api/products/?fields=product_id,name,price'),
+    Scenario('products-list-expand', '/api/products/?expand=category,images'),
+    Scenario('products-search', '/api/products/?q=wireless+speaker'),
+    Scenario('products-filter-tree', '/api/products/?category_tree={root_category}'),
+    Scenario('products-retrieve', '/api/products/{product}/'),
+    Scenario('products-update', '/api/products/{product}/', method='patch', as_user='admin',
+             data={'stock_quantity': 42}),
+    Scenario('product-images-list', '/api/product-images/'),
+    Scenario('product-images-retrieve', '/api/product-images/{image}/'),
+    Scenario('orders-list', '/api/orders/'),
+    Scenario('orders-list-expand', '/api/orders/?expand=items,items.product,payments'),
+    Scenario('orders-retrieve', '/api/orders/{order}/'),
+    Scenario('orders-create', '/api/orders/', method='post', data={
+        'user': '{user}', 'items': [{'product': '{product}', 'quantity': 1}],
+    }),
+    Scenario('order-items-list', '/api/order-items/'),
+    Scenario('order-items-retrieve', '/api/order-items/{order_item}/'),
+    Scenario('payments-list', '/api/payments/'),
+    Scenario('payments-retrieve', '/api/payments/{payment}/'),
+    Scenario('addresses-list', '/api/addresses/'),
+    Scenario('addresses-retrieve', '/api/addresses/{address}/'),
+]
+
+
+def sample_ids():
+    """Ids the scenario paths refer to, all belonging to one seeded customer with orders."""
+    customer = (
+        User.objects.filter(email__startswith=PREFIX, orders__payments__isnull=False, addresses__isnull=False)
+        .exclude(email=ADMIN_EMAIL).order_by('email').first()
+    )
+    if customer is None:
+        raise LookupError('No seeded customer with paid orders; run manage.py seed_catalog first.')
+    order = Order.objects.filter(user=customer, payments__isnull=False).order_by('created_at', 'pk').first()
+    product = Product.objects.filter(name__startswith=PREFIX, is_active=True, stock_quantity__gt=0).order_by('pk')[0]
+    return {
+        'customer': customer,
+        'admin': User.objects.get(email=ADMIN_EMAIL),
+        'user': customer.pk,
+        'customer_email': customer.email,
+        'root_category': Category.objects.filter(name__startswith=PREFIX, depth=0).order_by('name')[0].pk,
+        'category': Category.objects.filter(name__startswith=PREFIX).order_by('-depth', 'name')[0].pk,
+        'product': product.pk,
+        'image': ProductImage.objects.filter(product__name__startswith=PREFIX).order_by('pk')[0].pk,
+        'order': order.pk,
+        'order_item': OrderItem.objects.filter(order=order).order_by('pk')[0].pk,
+        'payment': Payment.objects.filter(order=order).order_by('pk')[0].pk,
+        'address': Address.objects.filter(user=customer).order_by('pk')[0].pk,
+    }
+
+
+def _fill(value, ids):
+    if isinstance(value, str):
+        return value.format(**ids)
+    if isinstance(value, dict):
+        return {key: _fill(item, ids) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill(item, ids) for item in value]
+    return value
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    iterations: int
+    status: int
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    mean_ms: float
+    queries: int
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _client(scenario, ids):
+    client = APIClient()
+    if scenario.as_user != 'anonymous':
+        client.force_authenticate(ids[scenario.as_user])
+    return client
+
+
+def _request(client, scenario, ids):
+    path = _fill(scenario.path, ids)
+    send = getattr(client, scenario.method)
+    if scenario.data is None:
+        return send(path, secure=True)
+    return send(path, _fill(scenario.data, ids), format='json', secure=True)
+
+
+def _run_once(client, scenario, ids):
+    """(response, seconds, queries) for one request; writes are rolled back."""
+    with collect() as stats:
+        began = time.perf_counter()
+        if scenario.method == 'get':
+            response = _request(client, scenario, ids)
+        else:
+            try:
+                with transaction.atomic():
+                    response = _request(client, scenario, ids)
+                    raise Rollback
+            except Rollback:
+                pass
+        seconds = time.perf_counter() - began
+    return response, seconds, stats.queries
+
+
+def run_scenario(scenario, ids, iterations=30, warmup=3):
+    client = _client(scenario, ids)
+    for _ in range(warmup):
+        _run_once(client, scenario, ids)
+    timings, queries, status = [], 0, None
+    for _ in range(iterations):
+        response, seconds, count = _run_once(client, scenario, ids)
+        timings.append(seconds * 1000)
+        queries = max(queries, count)
+        status = response.status_code
+    return ScenarioResult(
+        name=scenario.name, iterations=iterations, status=status,
+        p50_ms=percentile(timings, 50), p90_ms=percentile(timings, 90), p99_ms=percentile(timings, 99),
+        mean_ms=statistics.fmean(timings), queries=queries,
+    )
+
+
+def run_scenarios(names=None, iterations=30, warmup=3, use_cache=False):
+    """Run the selected scenarios (all by default). The catalog cache is bypassed unless `use_cache`."""
+    scenarios = [scenario for scenario in SCENARIOS if not names or scenario.name in names]
+    unknown = set(names or ()) - {scenario.name for scenario in scenarios}
+    if unknown:
+        raise LookupError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    ids = sample_ids()
+    overrides = {} if use_cache else {'CATALOG_CACHE_TIMEOUT': 0}
+    with override_settings(**overrides):
+        return [run_scenario(scenario, ids, iterations, warmup) for scenario in scenarios]
+
+
+def save_baseline(results, path):
+    with open(path, 'w') as handle:
+        json.dump({result.name: result.as_dict() for result in results}, handle, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Regressions against `baseline`: a p50 or p90 more than `tolerance` (a
+    fraction) slower, or any extra query. Returns a list of messages.
+    """
+    problems = []
+    for result in results:
+        before = baseline.get(result.name)
+        if before is None:
+            continue
+        if result.queries > before['queries']:
+            problems.append(f'{result.name}: {result.queries} queries, was {before["queries"]}')
+        for key in ('p50_ms', 'p90_ms'):
+            if before[key] and getattr(result, key) > before[key] * (1 + tolerance):
+                problems.append(f'{result.name}: {key} {getattr(result, key):.2f}, was {before[key]:.2f}')
+    return problems
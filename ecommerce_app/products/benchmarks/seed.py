@@ -0,0 +1,189 @@
+"""
+Scale data for benchmarks and load tests.
+
+`seed_catalog` bulk-creates users, a category tree, products, images, orders
+with items, payments and addresses from a fixed random seed, so two runs with
+the same volumes produce the same shape of data. Rows are written with
+`bulk_create`; the derived data that save() would normally maintain (category
+paths, order totals, sales rollups) is rebuilt in bulk afterwards.
+
+Everything seeded is named or addressed with the `seed-` prefix and can be
+removed again with `clear_seed`.
+"""
+import random
+from dataclasses import asdict, dataclass
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from products.analytics import COUNTED_STATUSES, rebuild_rollups
+from products.models import (
+    Address, Category, Order, OrderItem, OrderStatus, Payment, PaymentMethod, PaymentStatus, Product, ProductImage,
+    User, UserRole,
+)
+
+PREFIX = 'seed-'
+ADMIN_EMAIL = f'{PREFIX}admin@example.com'
+PASSWORD = 'seed-password'
+
+ORDER_STATUS_WEIGHTS = {
+    OrderStatus.PENDING: 3, OrderStatus.PAID: 3, OrderStatus.SHIPPED: 2,
+    OrderStatus.DELIVERED: 4, OrderStatus.CANCELLED: 1,
+}
+
+
+@dataclass
+class SeedVolumes:
+    users: int = 100
+    categories: int = 20
+    depth: int = 3
+    products: int = 2000
+    images: int = 2
+    orders: int = 1000
+    items: int = 3
+    addresses: int = 1
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def _bulk(model, rows, batch_size):
+    return model.objects.bulk_create(rows, batch_size=batch_size)
+
+
+def _seed_users(rnd, volumes, batch_size):
+    password = make_password(PASSWORD)  # hash once, not once per user
+    users = [User(
+        email=ADMIN_EMAIL, password=password, first_name='Seed', last_name='Admin',
+        role=UserRole.ADMIN, is_staff=True,
+    )]
+    users += [
+        User(
+            email=f'{PREFIX}{i:06}@example.com', password=password,
+            first_name='Seed', last_name=f'Customer {i}', phone_number=f'+2547{rnd.randrange(10**8):08}',
+        )
+        for i in range(volumes.users)
+    ]
+    return _bulk(User, users, batch_size)
+
+
+def _seed_categories(rnd, volumes, batch_size):
+    """`volumes.categories` categories spread over `volumes.depth` levels."""
+    levels = max(volumes.depth, 1)
+    categories, parents = [], []
+    for level in range(levels):
+        # Roots first, then about an even share per level.
+        count = max(1, volumes.categories // levels) if level < levels - 1 else volumes.categories - len(categories)
+        created = [
+            Category(
+                name=f'{PREFIX}{level}-{i:05}', description=f'Seeded category {i} at depth {level}.',
+                parent=rnd.choice(parents) if parents else None,
+            )
+            for i in range(max(count, 0))
+        ]
+        categories += _bulk(Category, created, batch_size)
+        parents = created or parents
+    Category.objects.rebuild_paths(batch_size=batch_size)
+    return categories
+
+
+def _seed_products(rnd, volumes, categories, batch_size):
+    words = ('wireless', 'compact', 'premium', 'smart', 'classic', 'portable', 'organic', 'ultra', 'eco', 'pro')
+    nouns = ('speaker', 'charger', 'lamp', 'kettle', 'backpack', 'watch', 'blender', 'camera', 'jacket', 'router')
+    products = [
+        Product(
+            name=f'{PREFIX}{rnd.choice(words)} {rnd.choice(nouns)} {i:06}',
+            description=' '.join(rnd.choice(words + nouns) for _ in range(30)),
+            price=Decimal(rnd.randrange(100, 100000)) / 100,
+            stock_quantity=rnd.randrange(0, 500),
+            category=rnd.choice(categories),
+            is_active=rnd.random() > 0.05,
+        )
+        for i in range(volumes.products)
+    ]
+    # ProductQuerySet.bulk_create keeps the search data in step.
+    products = _bulk(Product, products, batch_size)
+    images = [
+        ProductImage(product=product, image_url=f'https://images.example.com/{product.pk}/{n}.jpg',
+                     alt_text=f'{product.name} ({n})')
+        for product in products for n in range(volumes.images)
+    ]
+    _bulk(ProductImage, images, batch_size)
+    return products
+
+
+def _seed_orders(rnd, volumes, customers, products, batch_size):
+    statuses, weights = zip(*ORDER_STATUS_WEIGHTS.items())
+    orders = [Order(user=rnd.choice(customers), status=rnd.choices(statuses, weights)[0])
+              for _ in range(volumes.orders)]
+    orders = _bulk(Order, orders, batch_size)
+
+    items, totals = [], {}
+    for order in orders:
+        for product in rnd.sample(products, min(volumes.items, len(products))):
+            quantity = rnd.randrange(1, 5)
+            item = OrderItem(order=order, product=product, quantity=quantity, unit_price=product.price,
+                             subtotal=product.price * quantity)
+            items.append(item)
+            totals[order.pk] = totals.get(order.pk, Decimal('0')) + item.subtotal
+    _bulk(OrderItem, items, batch_size)
+
+    for order in orders:
+        order.total_amount = totals.get(order.pk, Decimal('0'))
+    Order.objects.bulk_update(orders, ['total_amount'], batch_size=batch_size)
+
+    payments = [
+        Payment(
+            order=order, amount=order.total_amount, transaction_id=f'{PREFIX}{order.pk.hex}',
+            payment_method=rnd.choice(PaymentMethod.values),
+            payment_status=PaymentStatus.COMPLETED if order.status in COUNTED_STATUSES else PaymentStatus.FAILED,
+        )
+        for order in orders if order.status != OrderStatus.PENDING
+    ]
+    _bulk(Payment, payments, batch_size)
+    return orders, items, payments
+
+
+def _seed_addresses(rnd, volumes, customers, batch_size):
+    cities = ('Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret')
+    addresses = [
+        Address(
+            user=user, street=f'{rnd.randrange(1, 999)} Seed Street', city=rnd.choice(cities), state='Seed County',
+            postal_code=f'{rnd.randrange(10000, 99999)}', country='Kenya', is_default=n == 0,
+        )
+        for user in customers for n in range(volumes.addresses)
+    ]
+    return _bulk(Address, addresses, batch_size)
+
+
+def seed_catalog(volumes=None, seed=42, batch_size=1000):
+    """Create the seeded data set; returns {model name: rows created}."""
+    volumes = volumes or SeedVolumes()
+    rnd = random.Random(seed)
+    with transaction.atomic():
+        users = _seed_users(rnd, volumes, batch_size)
+        customers = users[1:] or users
+        categories = _seed_categories(rnd, volumes, batch_size)
+        products = _seed_products(rnd, volumes, categories, batch_size) if categories else []
+        orders, items, payments = _seed_orders(rnd, volumes, customers, products, batch_size) if products else ([], [], [])
+        addresses = _seed_addresses(rnd, volumes, customers, batch_size)
+        rebuild_rollups(batch_size=batch_size)
+    return {
+        'users': len(users), 'categories': len(categories), 'products': len(products),
+        'images': len(products) * volumes.images, 'orders': len(orders), 'items': len(items),
+        'payments': len(payments), 'addresses': len(addresses),
+    }
+
+
+def seeded():
+    return User.objects.filter(email=ADMIN_EMAIL).exists()
+
+
+def clear_seed():
+    """Delete everything `seed_catalog` created."""
+    with transaction.atomic():
+        Order.objects.filter(user__email__startswith=PREFIX).delete()
+        Product.objects.filter(name__startswith=PREFIX).delete()
+        Category.objects.filter(name__startswith=PREFIX).delete()
+        User.objects.filter(email__startswith=PREFIX).delete()
@@ -0,0 +1,78 @@
+"""
+Read-path benchmark: DRF ModelSerializer against the ReadPlan fast path.
+
+For each page size both paths run the same query shape (ordered, limited) and
+render the page to JSON bytes; the outputs are compared so the speedup is only
+reported for identical responses. Times are medians over `repeat` runs and
+include the query.
+"""
+import statistics
+import time
+from dataclasses import dataclass
+
+from rest_framework.renderers import JSONRenderer
+
+from products.fastread import ReadPlan
+from products.models import Order, Product
+from products.serializers import OrderSerializer, ProductSerializer
+
+from .fixtures import drop_scratch_catalog, scratch_catalog, scratch_orders, scratch_products
+
+
+@dataclass
+class ReadPathResult:
+    endpoint: str
+    rows: int
+    serializer_ms: float
+    plan_ms: float
+    identical: bool
+
+    @property
+    def speedup(self):
+        return self.serializer_ms / self.plan_ms if self.plan_ms else 0.0
+
+
+def _median_ms(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        began = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - began) * 1000)
+    return statistics.median(timings)
+
+
+def _compare(endpoint, serializer_class, queryset, rows, repeat):
+    renderer = JSONRenderer()
+    plan = ReadPlan.for_serializer(serializer_class())
+
+    def with_serializer():
+        return renderer.render(serializer_class(list(queryset[:rows]), many=True).data)
+
+    def with_plan():
+        return renderer.render(plan.render_many(plan.values(queryset)[:rows]))
+
+    identical = with_serializer() == with_plan()
+    return ReadPathResult(
+        endpoint=endpoint,
+        rows=rows,
+        serializer_ms=_median_ms(with_serializer, repeat),
+        plan_ms=_median_ms(with_plan, repeat),
+        identical=identical,
+    )
+
+
+def run_read_path_benchmark(sizes=(20, 100, 1000), repeat=20):
+    largest = max(sizes)
+    product, users = scratch_catalog(users=1)
+    try:
+        scratch_products(product, largest)
+        scratch_orders(users[0], largest)
+        products = Product.objects.filter(category_id=product.category_id).order_by('name', 'pk')
+        orders = Order.objects.filter(user=users[0]).order_by('-created_at', 'pk')
+        results = []
+        for rows in sizes:
+            results.append(_compare('products', ProductSerializer, products, rows, repeat))
+            results.append(_compare('orders', OrderSerializer, orders, rows, repeat))
+        return results
+    finally:
+        drop_scratch_catalog(product, users)
@@ -0,0 +1,218 @@
+"""
+Contention benchmarks on a single hot product.
+
+`run_reservation_contention`: many threads, each with its own database
+connection, keep reserving one unit of the same product until the stock is
+gone. The run checks that exactly the initial stock was handed out (no
+oversell, no lost units) and reports reservations per second.
+
+`run_restock_contention`: many threads add stock to the same product, each
+movement in a transaction that stays open for `hold` seconds after the write,
+as a return does while it releases its reservations. `single-row` updates
+`stock_quantity` in place, so every transaction waits for the previous one's
+row lock. `sharded` records the movement in the ledger and on one of the
+product's counter shards (products/stock.py), while two more threads keep
+compacting the counters, as the cron job and checkouts do. The run checks that
+no unit was lost and none was folded into `stock_quantity` twice, and reports
+movements per second.
+"""
+import threading
+import time
+from dataclasses import dataclass
+
+from django.db import connection, connections, transaction
+from django.db.models import F, Sum
+from django.test.utils import override_settings
+
+from products.models import Order, OrderItem, Product, StockMovementReason, StockReservation
+from products.reservations import InsufficientStock, reserve_items
+from products.stock import available, compact_stock, record_movement
+
+from .fixtures import drop_scratch_catalog, scratch_catalog
+
+RESTOCK_MODES = ('single-row', 'sharded')
+
+
+@dataclass
+class ContentionResult:
+    threads: int
+    initial_stock: int
+    attempts: int
+    reserved: int
+    rejected: int
+    errors: int
+    final_stock: int
+    reserved_rows: int
+    seconds: float
+
+    @property
+    def oversold(self):
+        return self.reserved > self.initial_stock or self.final_stock < 0
+
+    @property
+    def consistent(self):
+        return self.reserved == self.reserved_rows == self.initial_stock - self.final_stock
+
+    @property
+    def per_second(self):
+        return self.reserved / self.seconds if self.seconds else 0.0
+
+
+def run_reservation_contention(threads=16, stock=1000, attempts_per_thread=None):
+    attempts_per_thread = attempts_per_thread or (stock // threads) * 2 + 1
+    product, users = scratch_catalog(stock_quantity=stock, users=1)
+    order = Order.objects.create(user=users[0])
+    counts = {'reserved': 0, 'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker():
+        reserved = rejected = errors = 0
+        try:
+            start.wait()
+            for _ in range(attempts_per_thread):
+                line = OrderItem(order_id=order.pk, product_id=product.pk, quantity=1)
+                try:
+                    reserve_items(order, [line])
+                    reserved += 1
+                except InsufficientStock:
+                    rejected += 1
+                except Exception:
+                    errors += 1
+        finally:
+            with lock:
+                counts['reserved'] += reserved
+                counts['rejected'] += rejected
+                counts['errors'] += errors
+            connection.close()
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    try:
+        reservations = StockReservation.objects.filter(order=order)
+        return ContentionResult(
+            threads=threads,
+            initial_stock=stock,
+            attempts=threads * attempts_per_thread,
+            reserved=counts['reserved'],
+            rejected=counts['rejected'],
+            errors=counts['errors'],
+            final_stock=Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk),
+            reserved_rows=reservations.aggregate(total=Sum('quantity'))['total'] or 0,
+            seconds=elapsed,
+        )
+    finally:
+        reservations.delete()
+        drop_scratch_catalog(product, users)
+        connections.close_all()
+
+
+@dataclass
+class RestockResult:
+    mode: str
+    threads: int
+    shards: int
+    movements: int
+    errors: int
+    seconds: float
+    final_stock: int
+    folded_stock: int
+    expected_stock: int
+    compactions: int = 0
+    compaction_errors: int = 0
+
+    @property
+    def consistent(self):
+        # folded_stock is stock_quantity once everything is folded: more means a delta was folded twice.
+        return self.final_stock == self.folded_stock == self.expected_stock
+
+    @property
+    def per_second(self):
+        return (self.movements - self.errors) / self.seconds if self.seconds else 0.0
+
+
+def _add_in_place(product_id):
+    Product.objects.filter(pk=product_id).update(stock_quantity=F('stock_quantity') + 1)
+
+
+def _add_to_shard(product_id):
+    record_movement(product_id, 1, StockMovementReason.RETURN)
+
+
+def run_restock_contention(mode, threads=16, movements=2000, shards=8, hold=0.002):
+    """Add `movements` single units to one product from `threads` threads; returns a RestockResult."""
+    if mode not in RESTOCK_MODES:
+        raise LookupError(f'Unknown mode {mode!r}; choose from {", ".join(RESTOCK_MODES)}.')
+    add = _add_in_place if mode == 'single-row' else _add_to_shard
+    per_thread = movements // threads
+    product, users = scratch_catalog(stock_quantity=0, users=0)
+    errors = []
+    compactions, compaction_errors = [], []
+    start = threading.Barrier(threads + 1)
+    done = threading.Event()
+
+    def compactor():
+        runs = failed = 0
+        try:
+            while not done.is_set():
+                try:
+                    compact_stock([product.pk])
+                    runs += 1
+                except Exception:
+                    failed += 1  # e.g. a deadlock; the transaction rolled back, no unit is lost
+                time.sleep(0.01)
+        finally:
+            compactions.append(runs)
+            compaction_errors.append(failed)
+            connection.close()
+
+    def worker():
+        failed = 0
+        try:
+            start.wait()
+            for _ in range(per_thread):
+                try:
+                    with transaction.atomic():
+                        add(product.pk)
+                        if hold:
+                            time.sleep(hold)  # the rest of the transaction
+                except Exception:
+                    failed += 1
+        finally:
+            errors.append(failed)
+            connection.close()
+
+    with override_settings(STOCK_COUNTER_SHARDS=shards):
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        compactors = [threading.Thread(target=compactor) for _ in range(2 if mode == 'sharded' else 0)]
+        for thread in pool + compactors:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        done.set()
+        for thread in compactors:
+            thread.join()
+        try:
+            final_stock = available([product.pk])[product.pk]
+            compact_stock([product.pk])
+            return RestockResult(
+                mode=mode, threads=threads, shards=shards if mode == 'sharded' else 1,
+                movements=per_thread * threads, errors=sum(errors), seconds=elapsed,
+                final_stock=final_stock,
+                folded_stock=Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk),
+                expected_stock=per_thread * threads - sum(errors),
+                compactions=sum(compactions), compaction_errors=sum(compaction_errors),
+            )
+        finally:
+            drop_scratch_catalog(product, users)
+            connections.close_all()
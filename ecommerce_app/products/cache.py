@@ -0,0 +1,228 @@
+"""
+Read-through cache for the catalog endpoints (categories, products, product images).
+
+A cached response is keyed by the endpoint, the normalized query string and the
+current *generation* of every model the endpoint depends on. Writing to one of
+those models bumps its generation (see `invalidate`), so every older entry simply
+stops being looked up; nothing has to be deleted and nothing waits for a TTL.
+The TTL (`CATALOG_CACHE_TIMEOUT`) only bounds how long dead entries linger.
+
+Reads routed to a replica (`products/routers.py`) can miss a write the primary
+has already committed. A response read from a replica is therefore only stored
+when every generation it depends on is older than `REPLICA_STICKY_SECONDS`, the
+lag the router already allows for; otherwise a stale body would be stored under
+the generation that was started to get rid of it. Until then, replica reads of
+that endpoint are served uncached.
+
+Stock is no exception: checkouts and stock compaction write `stock_quantity`
+through `ProductQuerySet`, which starts a new product generation like any other
+write, so cached product responses carry the `stock_quantity` the database
+holds. Only the product endpoints depend on that generation; cached categories
+and images survive every order. Restocks still waiting in the counters of
+`products/stock.py` are in neither; `/api/products/availability/` adds them.
+
+Any Django cache backend works; local-memory and file-based caches are fine for
+tests and single-host deployments.
+"""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from .routers import read_from_replica, sticky_seconds
+
+GENERATION_KEY = 'catalog:generation:{}'
+BUMPED_KEY = 'catalog:bumped:{}'
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def generations(labels):
+    """Current generation of each model label, initialising any that are missing."""
+    cache = get_cache()
+    keys = {label: GENERATION_KEY.format(label) for label in labels}
+    found = cache.get_many(keys.values())
+    result = {}
+    for label, key in keys.items():
+        if key not in found:
+            # Start from the clock rather than 1 so a generation that was evicted
+            # can never come back with a number an old entry was stored under.
+            cache.add(key, time.time_ns(), None)
+            found[key] = cache.get(key)
+        result[label] = found[key]
+    return result
+
+
+async def agenerations(labels):
+    """generations() through the cache's async API, for async views."""
+    cache = get_cache()
+    keys = {label: GENERATION_KEY.format(label) for label in labels}
+    found = await cache.aget_many(keys.values())
+    result = {}
+    for label, key in keys.items():
+        if key not in found:
+            await cache.aadd(key, time.time_ns(), None)
+            found[key] = await cache.aget(key)
+        result[label] = found[key]
+    return result
+
+
+def bump_generation(label):
+    cache = get_cache()
+    key = GENERATION_KEY.format(label)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+    cache.set(BUMPED_KEY.format(label), time.time(), None)
+
+
+def settled(labels):
+    """Whether no model in `labels` was written within the replica lag window."""
+    bumped = get_cache().get_many([BUMPED_KEY.format(label) for label in labels])
+    return all(at <= time.time() - sticky_seconds() for at in bumped.values())
+
+
+async def asettled(labels):
+    """settled() through the cache's async API, for async views."""
+    bumped = await get_cache().aget_many([BUMPED_KEY.format(label) for label in labels])
+    return all(at <= time.time() - sticky_seconds() for at in bumped.values())
+
+
+def invalidate(model):
+    """Drop every cached response that depends on `model`, once the current transaction commits."""
+    label = model._meta.label_lower
+    transaction.on_commit(lambda: bump_generation(label))
+
+
+class CacheStats:
+    """Per-process hit/miss counters, by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def record(self, endpoint, hit):
+        with self.lock:
+            self.counts[endpoint]['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {endpoint: dict(counts) for endpoint, counts in self.counts.items()}
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+stats = CacheStats()
+
+
+class CachedReadMixin:
+    """
+    Serve `list` and `retrieve` from the catalog cache.
+
+    `cache_dependencies` lists the models (as 'app_label.modelname') whose writes
+    can change the response. Only JSON responses with status 200 are cached
+    (replica reads only once the replica has caught up, see above), and the
+    cached value is the rendered body, so a hit skips the database, the
+    serializer and the renderer. Headers named in `cached_headers` are stored
+    with the body and sent again on a hit.
+    """
+    cache_dependencies = ()
+    cached_headers = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
+
+    async def alist(self, request, *args, **kwargs):
+        return await self.acached(super().alist, request, *args, **kwargs)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return await self.acached(super().aretrieve, request, *args, **kwargs)
+
+    def cached(self, handler, request, *args, **kwargs):
+        if not isinstance(getattr(request, 'accepted_renderer', None), JSONRenderer):
+            return handler(request, *args, **kwargs)
+
+        endpoint = f'{self.basename}-{self.action}'
+        cache = get_cache()
+        key = self.get_cache_key(request, endpoint)
+        entry = cache.get(key)
+        if entry is not None:
+            return self.cache_hit(request, endpoint, entry)
+
+        stats.record(endpoint, hit=False)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200 and (not read_from_replica() or settled(self.cache_dependencies)):
+            cache.set(key, self.cache_entry(request, response), cache_timeout())
+        response['X-Cache'] = 'MISS'
+        return response
+
+    async def acached(self, handler, request, *args, **kwargs):
+        """cached() for the async read path (see products/asyncread.py)."""
+        if not isinstance(getattr(request, 'accepted_renderer', None), JSONRenderer):
+            return await handler(request, *args, **kwargs)
+
+        endpoint = f'{self.basename}-{self.action}'
+        cache = get_cache()
+        key = self.cache_key(request, endpoint, await agenerations(self.cache_dependencies))
+        entry = await cache.aget(key)
+        if entry is not None:
+            return self.cache_hit(request, endpoint, entry)
+
+        stats.record(endpoint, hit=False)
+        response = await handler(request, *args, **kwargs)
+        if response.status_code == 200 and (not read_from_replica() or await asettled(self.cache_dependencies)):
+            await cache.aset(key, self.cache_entry(request, response), cache_timeout())
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def cache_hit(self, request, endpoint, entry):
+        stats.record(endpoint, hit=True)
+        content, headers = entry
+        response = HttpResponse(content, content_type=self.cached_content_type(request))
+        for name, value in headers.items():
+            response[name] = value
+        response['X-Cache'] = 'HIT'
+        return response
+
+    def cache_entry(self, request, response):
+        renderer_context = self.get_renderer_context()
+        renderer_context['response'] = response
+        content = request.accepted_renderer.render(response.data, request.accepted_media_type, renderer_context)
+        return content, {name: response[name] for name in self.cached_headers if response.has_header(name)}
+
+    def get_cache_key(self, request, endpoint):
+        return self.cache_key(request, endpoint, generations(self.cache_dependencies))
+
+    def cache_key(self, request, endpoint, generations):
+        params = sorted((key, sorted(request.query_params.getlist(key))) for key in request.query_params)
+        versions = sorted(generations.items())
+        # Links in the body are absolute and admins may get page-number pagination.
+        audience = (request.get_host(), request.is_secure(), getattr(request.user, 'role', None))
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        fingerprint = repr((endpoint, lookup, params, versions, audience, request.accepted_media_type))
+        return 'catalog:entry:' + hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    def cached_content_type(self, request):
+        # Same header DRF's Response would have produced.
+        renderer = request.accepted_renderer
+        if renderer.charset:
+            return f'{renderer.media_type}; charset={renderer.charset}'
+        return renderer.media_type
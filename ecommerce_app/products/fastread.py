@@ -0,0 +1,211 @@
+"""
+Fast read path for list and retrieve.
+
+Rendering a page through `ModelSerializer` builds a model instance per row and
+then dispatches through every field's `get_attribute` / `to_representation`.
+For flat serializers whose fields map straight onto columns none of that is
+needed: a `ReadPlan` lists (output name, column, formatter) once per serializer
+shape, the rows come from `.values()`, and each value goes through the same
+field's `to_representation`, so the output is identical to the serializer's.
+
+Anything the plan cannot express (nested or expanded serializers, method
+fields, properties, dotted sources) makes `FastReadMixin` fall back to the
+regular serializer. `alist` / `aretrieve` are the same for the async read path
+(products/asyncread.py).
+"""
+import threading
+
+from django.core.exceptions import FieldDoesNotExist
+from django.utils import timezone
+from django.db.models import F, OrderBy
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework import serializers
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import BasePermission
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField, RelatedField
+from rest_framework.response import Response
+from rest_framework.settings import ISO_8601, api_settings
+
+from .asyncread import aget_object_or_404
+from .metrics import serializer_timer
+
+
+def _identity(value):
+    return value
+
+
+def _datetime_formatter(field):
+    """DateTimeField.to_representation with the timezone lookup done once per page."""
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    tz = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if output_format is None or output_format.lower() != ISO_8601 or tz is None:
+        return field.to_representation
+
+    def to_representation(value):
+        if not value or not timezone.is_aware(value):
+            return field.to_representation(value)
+        value = value.astimezone(tz).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return to_representation
+
+
+def page_formatter(field):
+    """Formatter for one page of rows, equivalent to `field.to_representation`."""
+    if field is None:
+        return _identity
+    if isinstance(field, serializers.DateTimeField):
+        return _datetime_formatter(field)
+    return field.to_representation
+
+
+class ReadPlan:
+    """Field extractors for one serializer shape."""
+
+    def __init__(self, model, steps):
+        self.model = model
+        # (output name, column, field); the field is None for raw values
+        self.steps = steps
+
+    @classmethod
+    def for_serializer(cls, serializer):
+        """Build a plan from a (possibly pruned) serializer, or return None if it is not flat."""
+        model = serializer.Meta.model
+        opts = model._meta
+        steps = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, (serializers.BaseSerializer, serializers.SerializerMethodField,
+                                  serializers.HiddenField, ManyRelatedField)):
+                return None
+            if len(field.source_attrs) != 1:
+                return None
+            try:
+                model_field = opts.get_field(field.source_attrs[0])
+            except FieldDoesNotExist:
+                return None
+            if not model_field.concrete or model_field.many_to_many:
+                return None
+            if isinstance(field, RelatedField):
+                if not isinstance(field, PrimaryKeyRelatedField) or not model_field.is_relation:
+                    return None
+                # PrimaryKeyRelatedField renders the raw foreign key value.
+                field = field.pk_field
+            elif model_field.is_relation:
+                return None
+            steps.append((name, model_field.attname, field))
+        return cls(model, steps)
+
+    @property
+    def columns(self):
+        return [column for _, column, _ in self.steps]
+
+    def values(self, queryset):
+        """`queryset.values()` with the plan's columns plus whatever the ordering needs."""
+        columns = dict.fromkeys(self.columns)
+        columns[self.model._meta.pk.attname] = None
+        for item in queryset.query.order_by:
+            if isinstance(item, OrderBy) and isinstance(item.expression, F):
+                item = item.expression.name
+            if isinstance(item, str):
+                name = item.lstrip('-')
+                if name in queryset.query.annotations:
+                    columns[name] = None
+                elif name != 'pk' and LOOKUP_SEP not in name:
+                    columns[self.model._meta.get_field(name).attname] = None
+        return queryset.values(*columns)
+
+    def render(self, row):
+        return self.render_many([row])[0]
+
+    def render_many(self, rows):
+        with serializer_timer():
+            steps = [(name, column, page_formatter(field)) for name, column, field in self.steps]
+            return [
+                {name: None if (value := row[column]) is None else formatter(value) for name, column, formatter in steps}
+                for row in rows
+            ]
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def get_read_plan(serializer, key=None):
+    """Plan for `serializer`, memoized on `key` (which must identify its field set)."""
+    if key is None:
+        return ReadPlan.for_serializer(serializer)
+    try:
+        return _plans[key]
+    except KeyError:
+        plan = ReadPlan.for_serializer(serializer)
+        with _plans_lock:
+            _plans[key] = plan
+        return plan
+
+
+class FastReadMixin:
+    """
+    Serve `list` and `retrieve` from `.values()` rows through a `ReadPlan`.
+    Put it after CachedReadMixin and before SparseFieldsMixin / ExpandMixin.
+    """
+    fast_read = True
+
+    def get_read_plan(self):
+        if not self.fast_read:
+            return None
+        expand = self.get_expand() if hasattr(self, 'get_expand') else None
+        if expand:
+            return None
+        sparse = self.get_sparse_fields() if hasattr(self, 'get_sparse_fields') else None
+        key = (self.get_serializer_class(), tuple(sparse) if sparse is not None else None)
+        if key in _plans:
+            return _plans[key]
+        return get_read_plan(self.get_serializer(), key)
+
+    def list(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        rows = plan.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(plan.render_many(page))
+        return Response(plan.render_many(rows))
+
+    def retrieve(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None or self.checks_object_permissions():
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        rows = plan.values(self.filter_queryset(self.get_queryset()))
+        row = get_object_or_404(rows, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return Response(plan.render(row))
+
+    async def alist(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None:
+            return await super().alist(request, *args, **kwargs)
+        rows = plan.values(await self.afilter_queryset(self.get_queryset()))
+        page = await self.apaginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(plan.render_many(page))
+        return Response(plan.render_many([row async for row in rows.aiterator()]))
+
+    async def aretrieve(self, request, *args, **kwargs):
+        plan = self.get_read_plan()
+        if plan is None or self.checks_object_permissions():
+            return await super().aretrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        rows = plan.values(await self.afilter_queryset(self.get_queryset()))
+        row = await aget_object_or_404(rows, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return Response(plan.render(row))
+
+    def checks_object_permissions(self):
+        # Object permissions need a model instance; use the regular path for them.
+        return any(
+            type(permission).has_object_permission is not BasePermission.has_object_permission
+            for permission in self.get_permissions()
+        )
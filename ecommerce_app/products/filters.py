@@ -0,0 +1,20 @@
+import django_filters
+
+from .models import Category, Product
+
+
+class ProductFilter(django_filters.FilterSet):
+    category_tree = django_filters.UUIDFilter(
+        method='filter_category_tree',
+        label='Category (including every subcategory)',
+    )
+
+    class Meta:
+        model = Product
+        fields = ['category', 'is_active', 'price', 'stock_quantity']
+
+    def filter_category_tree(self, queryset, name, value):
+        path = Category.objects.filter(pk=value).values_list('path', flat=True).first()
+        if path is None:
+            return queryset.none()
+        return queryset.filter(category__path__startswith=path)
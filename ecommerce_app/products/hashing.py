@@ -0,0 +1,106 @@
+"""
+Password hashing off the request workers.
+
+PBKDF2 is slow on purpose: every login and registration spends tens of
+milliseconds of CPU on it. Instead of hashing in the worker that serves the
+request, login and registration hand the work to a small, dedicated thread
+pool. At most `PASSWORD_HASHING_WORKERS` hashes run at once and at most
+`PASSWORD_HASHING_QUEUE` more wait for a worker; a request that finds every
+slot taken is answered 503 with `Retry-After` straight away. A login burst
+therefore lengthens login latency only, and never holds the workers or the
+CPU that the catalog is served from.
+
+The async login and registration views await the result without tying up a
+thread; `POST /api/users/` blocks on it but counts against the same limit.
+Time spent waiting for a worker and time spent hashing are recorded in
+`products.metrics` as `password_hash_queue_seconds` and `password_hash_seconds`,
+labelled by operation.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from . import metrics
+
+HASH = 'hash'
+CHECK = 'check'
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Too many sign-ins in progress; try again shortly.')
+    default_code = 'hashing_busy'
+
+    def __init__(self, detail=None, code=None, wait=1):
+        super().__init__(detail, code)
+        self.wait = wait  # DRF's exception handler turns this into Retry-After
+
+
+class HashingExecutor:
+    """A thread pool that refuses work, rather than queueing it, once `workers + queue` jobs are pending."""
+
+    def __init__(self, workers=2, queue=32):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hashing')
+        self.slots = threading.BoundedSemaphore(workers + queue)
+
+    def submit(self, operation, func, *args):
+        """A concurrent.futures.Future for func(*args); raises HashingBusy when the queue is full."""
+        if not self.slots.acquire(blocking=False):
+            if metrics.enabled():
+                metrics.registry.increment('password_hash_rejected_total', (operation,))
+            raise HashingBusy()
+        queued = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                if metrics.enabled():
+                    metrics.registry.observe('password_hash_queue_seconds', (operation,), started - queued)
+                    metrics.registry.observe('password_hash_seconds', (operation,), time.perf_counter() - started)
+                self.slots.release()
+
+        try:
+            return self.pool.submit(run)
+        except BaseException:
+            self.slots.release()
+            raise
+
+
+executor = HashingExecutor(
+    workers=getattr(settings, 'PASSWORD_HASHING_WORKERS', 2),
+    queue=getattr(settings, 'PASSWORD_HASHING_QUEUE', 32),
+)
+
+
+def _check(password, encoded):
+    """(matches, new encoding if the stored one uses outdated hasher parameters, else None)."""
+    upgraded = []
+    matches = hashers.check_password(password, encoded, setter=upgraded.append)
+    return matches, hashers.make_password(upgraded[0]) if upgraded else None
+
+
+def make_password(password):
+    return executor.submit(HASH, hashers.make_password, password).result()
+
+
+async def amake_password(password):
+    return await asyncio.wrap_future(executor.submit(HASH, hashers.make_password, password))
+
+
+async def acheck_password(password, encoded):
+    """
+    (matches, upgraded encoding or None). Pass `encoded=None` for an unknown
+    user: Django then hashes a random password, so the response time does not
+    reveal whether the account exists.
+    """
+    encoded = encoded or hashers.UNUSABLE_PASSWORD_PREFIX
+    return await asyncio.wrap_future(executor.submit(CHECK, _check, password, encoded))
@@ -0,0 +1,198 @@
+"""
+Uploaded product images and their resized variants.
+
+An upload is hashed (SHA-256) while it is read. Every file is stored once per
+hash as an `ImageAsset`, under `product-images/<hash>/`, so uploading the same
+picture for many products, or twice, stores and processes it once.
+
+Resizing happens off the request path. Once the upload's transaction commits,
+the asset goes to a small thread pool, `PRODUCT_IMAGE_WORKERS` threads per
+process. The pool writes one recompressed variant per width in
+`PRODUCT_IMAGE_WIDTHS` that is narrower than the original, plus one at the
+original width, in `PRODUCT_IMAGE_FORMAT` at `PRODUCT_IMAGE_QUALITY`. The
+variant URLs are then copied onto every `ProductImage` using the asset, so
+list pages read them straight from the row and clients can pick the
+smallest size that fits (`srcset`) instead of the original. With
+`PRODUCT_IMAGE_WORKERS = 0` variants are made in the committing thread.
+
+Assets whose variants are missing or failed, for instance after a restart
+or when the widths change, are processed with `manage.py process_images`.
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import OuterRef, Subquery
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .cache import invalidate
+from .models import ImageAsset, ImageAssetStatus, ProductImage
+
+logger = logging.getLogger(__name__)
+
+# Pillow format -> (content type, file extension)
+UPLOAD_FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+    'WEBP': ('image/webp', 'webp'),
+    'GIF': ('image/gif', 'gif'),
+}
+ROOT = 'product-images'
+
+
+def variant_widths():
+    return sorted(getattr(settings, 'PRODUCT_IMAGE_WIDTHS', (160, 320, 640, 1280)))
+
+
+def variant_format():
+    return getattr(settings, 'PRODUCT_IMAGE_FORMAT', 'WEBP')
+
+
+def max_upload_bytes():
+    return getattr(settings, 'PRODUCT_IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def _read(upload):
+    """(content, sha256 hex digest) of an uploaded file, refusing files over the size limit."""
+    if upload.size > max_upload_bytes():
+        raise ValidationError(f'Images may be at most {max_upload_bytes() // (1024 * 1024)} MB.')
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+        buffer.write(chunk)
+    return buffer.getvalue(), digest.hexdigest()
+
+
+def _inspect(content):
+    """(Pillow format, width, height) of an image, or ValidationError for anything else."""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.verify()
+        with Image.open(io.BytesIO(content)) as image:
+            image_format, (width, height) = image.format, image.size
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValidationError('Upload a valid JPEG, PNG, WebP or GIF image.')
+    if image_format not in UPLOAD_FORMATS:
+        raise ValidationError('Upload a valid JPEG, PNG, WebP or GIF image.')
+    return image_format, width, height
+
+
+def store_upload(upload):
+    """
+    (ImageAsset, created) for an uploaded file: the existing asset when the same
+    bytes were uploaded before, else a new one whose variants are made once the
+    transaction commits.
+    """
+    content, sha256 = _read(upload)
+    asset = ImageAsset.objects.filter(sha256=sha256).first()
+    if asset is not None:
+        if asset.status == ImageAssetStatus.FAILED:
+            schedule(asset.pk)
+        return asset, False
+    image_format, width, height = _inspect(content)
+    content_type, extension = UPLOAD_FORMATS[image_format]
+    name = default_storage.save(f'{ROOT}/{sha256}/original.{extension}', ContentFile(content))
+    try:
+        with transaction.atomic():
+            asset = ImageAsset.objects.create(
+                sha256=sha256, original=name, content_type=content_type, width=width, height=height,
+                size=len(content),
+            )
+    except IntegrityError:
+        # The same file was uploaded concurrently; keep theirs.
+        default_storage.delete(name)
+        return ImageAsset.objects.get(sha256=sha256), False
+    schedule(asset.pk)
+    return asset, True
+
+
+def _variant(image, width):
+    """`image` scaled down to `width` and recompressed, as bytes."""
+    if width < image.width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, variant_format(), quality=getattr(settings, 'PRODUCT_IMAGE_QUALITY', 80), optimize=True)
+    return output.getvalue()
+
+
+def make_variants(asset):
+    """Write the variants of `asset` to storage; returns {width: URL}."""
+    with default_storage.open(asset.original.name, 'rb') as original, Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)  # phone photos carry their rotation in EXIF
+        keeps_alpha = image.mode in ('RGBA', 'LA', 'P') and variant_format() != 'JPEG'
+        image = image.convert('RGBA' if keeps_alpha else 'RGB')
+        widths = [width for width in variant_widths() if width < image.width] + [image.width]
+        extension = variant_format().lower()
+        variants = {}
+        for width in widths:
+            name = f'{ROOT}/{asset.sha256}/{width}.{extension}'
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            variants[str(width)] = default_storage.url(default_storage.save(name, ContentFile(_variant(image, width))))
+    return variants
+
+
+def process_asset(asset_id):
+    """Make the variants of one asset and hand them to every product image that uses it."""
+    asset = ImageAsset.objects.get(pk=asset_id)
+    try:
+        variants = make_variants(asset)
+    except Exception as exc:
+        logger.exception('Could not make variants of image asset %s', asset_id)
+        ImageAsset.objects.filter(pk=asset_id).update(status=ImageAssetStatus.FAILED, error=str(exc)[:255])
+        return None
+    with transaction.atomic():
+        ImageAsset.objects.filter(pk=asset_id).update(status=ImageAssetStatus.READY, variants=variants, error='')
+        ProductImage.objects.filter(asset_id=asset_id).update(variants=variants)
+        invalidate(ProductImage)  # queryset updates send no post_save
+    return variants
+
+
+def copy_variants(product_image_ids):
+    """
+    Copy the current variants of their assets onto these product images. For
+    rows created while their asset was still being processed: a row that
+    commits after the worker has copied the variants would otherwise keep none.
+    """
+    variants = ImageAsset.objects.filter(pk=OuterRef('asset_id')).values('variants')[:1]
+    updated = ProductImage.objects.filter(pk__in=product_image_ids, asset__isnull=False).update(
+        variants=Subquery(variants),
+    )
+    if updated:
+        invalidate(ProductImage)
+    return updated
+
+
+def _run(asset_id):
+    close_old_connections()
+    try:
+        process_asset(asset_id)
+    finally:
+        close_old_connections()
+
+
+def workers():
+    return getattr(settings, 'PRODUCT_IMAGE_WORKERS', 2)
+
+
+executor = ThreadPoolExecutor(max_workers=max(workers(), 1), thread_name_prefix='image-variants')
+
+
+def schedule(asset_id):
+    """Make the asset's variants in the background once the current transaction commits."""
+    if workers() <= 0:
+        transaction.on_commit(lambda: process_asset(asset_id))
+    else:
+        transaction.on_commit(lambda: executor.submit(_run, asset_id))
+
+
+def pending_assets(include_ready=False):
+    assets = ImageAsset.objects.order_by('created_at')
+    return assets if include_ready else assets.exclude(status=ImageAssetStatus.READY)
@@ -0,0 +1,413 @@
+"""
+Bulk import (insert or update) of categories, products and product images.
+
+The input (CSV with a header row, or NDJSON) is read as a stream and handled in
+batches of `IMPORT_BATCH_SIZE` rows. For each batch:
+
+* every reference (product -> category, image -> product, existing keys) is
+  resolved with one query per kind, never one per row;
+* each row is validated in memory with the model's own field validation and
+  `clean()` (no uniqueness queries: conflicts are resolved by the upsert);
+* valid rows are written inside a transaction, grouped by the set of columns
+  the row supplies, so a row only overwrites the columns it actually carries:
+  rows whose key already exists go through `bulk_update` of those columns,
+  new rows through `bulk_create(update_conflicts=True)`. An upsert would not
+  do for the former, since its INSERT half needs every NOT NULL column.
+
+Rows that fail are collected in an `ImportReport` with their line number and
+errors; the rest of the batch is still imported.
+
+Rows are matched on: categories by `name`, products by `product_id`, images by
+`image_id`. Rows without a key are inserted. Category parents (by name or id) are
+applied once every row has been read, then the category paths are rebuilt.
+"""
+import csv
+import io
+import json
+import uuid
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from .cache import invalidate
+from .models import Category, Product, ProductImage
+
+FORMATS = ('csv', 'ndjson')
+TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
+FALSE_VALUES = {'false', 'f', 'no', 'n', '0'}
+
+
+def default_batch_size():
+    return getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+
+
+def read_rows(stream, file_format):
+    """Yield (line number, dict) from a text stream; malformed lines yield (line, None)."""
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # Short rows leave None for the missing columns; extra cells land under the None key.
+            yield reader.line_num, row if None not in row else None
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def text_stream(binary):
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+
+def _uuid(value):
+    try:
+        return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+class ImportReport:
+    """Running totals and the per-row errors of one import."""
+
+    def __init__(self):
+        self.processed = 0
+        self.imported = 0
+        self.errors = []
+
+    def fail(self, line, errors):
+        self.errors.append({'line': line, 'errors': errors})
+
+    def sorted_errors(self):
+        return sorted(self.errors, key=lambda error: error['line'])
+
+    @property
+    def failed(self):
+        return len({error['line'] for error in self.errors})
+
+    def as_dict(self, max_errors=None):
+        errors = self.sorted_errors()[:max_errors]
+        return {
+            'processed': self.processed,
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': errors,
+            'errors_truncated': len(errors) < len(self.errors),
+        }
+
+
+class Importer:
+    """
+    Shared batch pipeline. Subclasses name the model, the accepted `columns`,
+    the upsert `key` and resolve their references in `prepare_batch`.
+    """
+    model = None
+    columns = ()
+    key = None
+    # Model fields filled from references rather than raw columns.
+    reference_fields = ()
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or default_batch_size()
+        self.report = ImportReport()
+
+    def run(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+        self.finish()
+        invalidate(self.model)
+        return self.report
+
+    def import_batch(self, batch):
+        self.report.processed += len(batch)
+        parsed = []
+        for line, row in batch:
+            if row is None:
+                self.report.fail(line, {'__all__': ['Malformed row.']})
+                continue
+            unknown = sorted(set(row) - set(self.columns))
+            if unknown:
+                self.report.fail(line, {name: ['Unknown column.'] for name in unknown})
+                continue
+            parsed.append((line, row))
+
+        context = self.prepare_batch([row for _, row in parsed])
+        groups = {}
+        seen = {}
+        for line, row in parsed:
+            try:
+                obj, fields = self.build(row, context)
+            except ValidationError as exc:
+                self.report.fail(line, exc.message_dict)
+                continue
+            identity = getattr(obj, self.key)
+            if identity in seen:
+                self.report.fail(line, {self.key: [f'Duplicate of line {seen[identity]}.']})
+                continue
+            seen[identity] = line
+            groups.setdefault((fields, self.is_new(obj, context)), []).append((line, obj))
+
+        for (fields, new), members in groups.items():
+            objs = [obj for _, obj in members]
+            try:
+                with transaction.atomic():
+                    self.write(objs, fields, new)
+            except DatabaseError as exc:
+                for line, _ in members:
+                    self.report.fail(line, {'__all__': [str(exc)]})
+                continue
+            self.report.imported += len(objs)
+            self.after_write(members)
+
+    def prepare_batch(self, rows):
+        return {}
+
+    def build(self, row, context):
+        """Return (unsaved instance, frozenset of the fields the row supplies)."""
+        raw = {name: self.coerce(name, value) for name, value in row.items() if name in self.field_columns()}
+        try:
+            raw[self.key] = self.model._meta.get_field(self.key).clean(raw.get(self.key), None)
+        except ValidationError as exc:
+            raise ValidationError({self.key: exc.messages})
+        obj = self.model(**raw)
+        is_new = self.is_new(obj, context)
+        if not is_new:
+            # Existing rows are updated by primary key, whatever the import key is.
+            obj.pk = context['existing'][raw[self.key]]
+        errors = {}
+        self.resolve(obj, row, context, errors)
+        present = set(raw) | {name for name in self.reference_fields if name in row}
+        # Rows that update an existing record only need to be valid for the columns they carry.
+        exclude = [
+            field.name for field in self.model._meta.concrete_fields
+            if field.name in self.reference_fields or field.name == self.key or not field.editable
+            or (not is_new and field.name not in present)
+        ]
+        # full_clean() without the uniqueness checks (one query per row); clean()
+        # only runs on values that passed field validation.
+        try:
+            obj.clean_fields(exclude=exclude)
+            if not errors:
+                obj.clean()
+        except ValidationError as exc:
+            for name, messages in exc.update_error_dict({}).items():
+                errors.setdefault(name, []).extend(messages)
+        if errors:
+            raise ValidationError(errors)
+        return obj, frozenset(present - {self.key})
+
+    def field_columns(self):
+        return [name for name in self.columns if name not in self.reference_fields]
+
+    def coerce(self, name, value):
+        field = self.model._meta.get_field(name)
+        if isinstance(value, str) and field.get_internal_type() == 'BooleanField':
+            lowered = value.strip().lower()
+            if lowered in TRUE_VALUES:
+                return True
+            if lowered in FALSE_VALUES:
+                return False
+        if value == '' and field.null:
+            return None
+        return value
+
+    def resolve(self, obj, row, context, errors):
+        pass
+
+    def is_new(self, obj, context):
+        return getattr(obj, self.key) not in context.get('existing', ())
+
+    def write(self, objs, fields, new):
+        """Write rows that all supply `fields`; `new` rows are inserted, the others updated."""
+        update_fields = sorted(fields)
+        if not update_fields and not new:
+            return
+        touched = [
+            field for field in self.model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) and field.name not in fields
+        ]
+        update_fields += [field.name for field in touched]
+        if not new:
+            # bulk_update() writes the attributes as they are and skips pre_save().
+            for obj in objs:
+                for field in touched:
+                    field.pre_save(obj, add=False)
+            self.model.objects.bulk_update(objs, update_fields)
+        elif fields:
+            self.model.objects.bulk_create(
+                objs, update_conflicts=True, unique_fields=[self.key], update_fields=update_fields,
+            )
+        else:
+            self.model.objects.bulk_create(objs, ignore_conflicts=True)
+
+    def after_write(self, members):
+        pass
+
+    def finish(self):
+        pass
+
+
+class CategoryImporter(Importer):
+    model = Category
+    columns = ('name', 'description', 'parent')
+    key = 'name'
+    reference_fields = ('parent',)
+
+    def __init__(self, batch_size=None):
+        super().__init__(batch_size)
+        # name -> (line, parent reference); applied once every category exists.
+        self.parents = {}
+
+    def prepare_batch(self, rows):
+        names = {row.get('name') for row in rows if row.get('name')}
+        return {'existing': dict(Category.objects.filter(name__in=names).values_list('name', 'pk'))}
+
+    def after_write(self, members):
+        for line, obj in members:
+            if hasattr(obj, '_parent_reference'):
+                self.parents[obj.name] = (line, obj._parent_reference)
+
+    def resolve(self, obj, row, context, errors):
+        if 'parent' in row:
+            obj._parent_reference = row['parent'] or None
+
+    def write(self, objs, fields, new):
+        # The parent is applied in finish(); the path is rebuilt there as well.
+        super().write(objs, fields - {'parent'}, new)
+
+    def finish(self):
+        if self.parents:
+            self.apply_parents()
+        Category.objects.rebuild_paths()
+        invalidate(Category)
+
+    def apply_parents(self):
+        references = {reference for _, reference in self.parents.values() if reference}
+        ids = {_uuid(reference) for reference in references} - {None}
+        found = Category.objects.filter(name__in=references) | Category.objects.filter(pk__in=ids)
+        by_reference = {}
+        for pk, name in found.values_list('pk', 'name'):
+            by_reference[name] = pk
+            by_reference[str(pk)] = pk
+        by_name = dict(Category.objects.filter(name__in=self.parents).values_list('name', 'pk'))
+        tree = dict(Category.objects.values_list('pk', 'parent_id'))
+
+        changed = []
+        for name, (line, reference) in self.parents.items():
+            pk = by_name[name]
+            parent_id = None
+            if reference:
+                parent_id = by_reference.get(reference) or by_reference.get(str(_uuid(reference)))
+                if parent_id is None:
+                    self.report.fail(line, {'parent': [f'Category "{reference}" does not exist.']})
+                    continue
+                if self.creates_cycle(tree, pk, parent_id):
+                    self.report.fail(line, {'parent': ['A category cannot be moved under one of its own subcategories.']})
+                    continue
+            tree[pk] = parent_id
+            changed.append(Category(pk=pk, parent_id=parent_id))
+        Category.objects.bulk_update(changed, ['parent'], batch_size=self.batch_size)
+
+    @staticmethod
+    def creates_cycle(tree, pk, parent_id):
+        seen = set()
+        while parent_id is not None and parent_id not in seen:
+            if parent_id == pk:
+                return True
+            seen.add(parent_id)
+            parent_id = tree.get(parent_id)
+        return False
+
+
+class ProductImporter(Importer):
+    model = Product
+    columns = ('product_id', 'name', 'description', 'price', 'stock_quantity', 'is_active',
+               'category', 'category_name')
+    key = 'product_id'
+    reference_fields = ('category', 'category_name')
+
+    def prepare_batch(self, rows):
+        ids = {_uuid(row['product_id']) for row in rows if row.get('product_id')} - {None}
+        category_ids = {_uuid(row['category']) for row in rows if row.get('category')} - {None}
+        category_names = {row['category_name'] for row in rows if row.get('category_name')}
+        categories = {}
+        if category_ids:
+            categories.update({pk: pk for pk in Category.objects.filter(pk__in=category_ids).values_list('pk', flat=True)})
+        if category_names:
+            categories.update(Category.objects.filter(name__in=category_names).values_list('name', 'pk'))
+        return {
+            'existing': {pk: pk for pk in Product.objects.filter(pk__in=ids).values_list('pk', flat=True)},
+            'categories': categories,
+        }
+
+    def build(self, row, context):
+        if not row.get('product_id'):
+            row = dict(row, product_id=str(uuid.uuid4()))
+        obj, fields = super().build(row, context)
+        if {'category', 'category_name'} & fields:
+            fields = fields - {'category_name'} | {'category'}
+        return obj, fields
+
+    def resolve(self, obj, row, context, errors):
+        for column, value in (('category', _uuid(row.get('category'))), ('category_name', row.get('category_name'))):
+            if row.get(column):
+                category_id = context['categories'].get(value)
+                if category_id is None:
+                    errors[column] = [f'Category "{row[column]}" does not exist.']
+                else:
+                    obj.category_id = category_id
+        if obj.category_id is None and self.is_new(obj, context) and 'category' not in errors \
+                and 'category_name' not in errors:
+            errors['category'] = ['This field is required.']
+
+
+class ProductImageImporter(Importer):
+    model = ProductImage
+    columns = ('image_id', 'product', 'image_url', 'alt_text')
+    key = 'image_id'
+    reference_fields = ('product',)
+
+    def prepare_batch(self, rows):
+        ids = {_uuid(row['image_id']) for row in rows if row.get('image_id')} - {None}
+        product_ids = {_uuid(row['product']) for row in rows if row.get('product')} - {None}
+        return {
+            'existing': {pk: pk for pk in ProductImage.objects.filter(pk__in=ids).values_list('pk', flat=True)},
+            'products': set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True)),
+        }
+
+    def build(self, row, context):
+        if not row.get('image_id'):
+            row = dict(row, image_id=str(uuid.uuid4()))
+        return super().build(row, context)
+
+    def resolve(self, obj, row, context, errors):
+        if row.get('product'):
+            product_id = _uuid(row['product'])
+            if product_id not in context['products']:
+                errors['product'] = [f'Product "{row["product"]}" does not exist.']
+            else:
+                obj.product_id = product_id
+        elif self.is_new(obj, context):
+            errors['product'] = ['This field is required.']
+
+
+IMPORTERS = {
+    'categories': CategoryImporter,
+    'products': ProductImporter,
+    'product-images': ProductImageImporter,
+}
+
+
+def import_rows(dataset, stream, file_format, batch_size=None):
+    """Import a text stream into `dataset` and return the ImportReport."""
+    importer = IMPORTERS[dataset](batch_size)
+    return importer.run(read_rows(stream, file_format))
@@ -0,0 +1,26 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.analytics import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the sales rollups from paid, shipped and delivered orders, "
+        "for every day or for a date range."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild (YYYY-MM-DD, inclusive).')
+        parser.add_argument('--end', help='Last day to rebuild (YYYY-MM-DD, inclusive).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else None
+        except ValueError:
+            raise CommandError('--start and --end must be dates (YYYY-MM-DD).')
+        written = rebuild_rollups(start, end, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup rows.'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.scenarios import compare, load_baseline, run_scenarios, save_baseline
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the API scenarios against data from seed_catalog and report latency "
+        "percentiles and query counts, optionally against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default='', help='Comma-separated scenario names (default: all).')
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--use-cache', action='store_true', help='Leave the catalog response cache on.')
+        parser.add_argument('--baseline', help='JSON baseline to compare against; fails on regressions.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed p50/p90 slowdown against the baseline, as a fraction.')
+        parser.add_argument('--save-baseline', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        names = [name for name in options['scenarios'].split(',') if name]
+        try:
+            results = run_scenarios(names, options['iterations'], options['warmup'], options['use_cache'])
+        except LookupError as exc:
+            raise CommandError(str(exc))
+
+        self.stdout.write(f"{'scenario':<26}{'status':>7}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'queries':>9}")
+        for result in results:
+            self.stdout.write(
+                f"{result.name:<26}{result.status:>7}{result.p50_ms:>9.2f}{result.p90_ms:>9.2f}"
+                f"{result.p99_ms:>9.2f}{result.queries:>9}"
+            )
+        if options['save_baseline']:
+            save_baseline(results, options['save_baseline'])
+            self.stdout.write(f"Baseline written to {options['save_baseline']}.")
+
+        failed = [result.name for result in results if not result.ok]
+        if failed:
+            raise CommandError(f'Scenarios did not succeed: {", ".join(failed)}')
+        if options['baseline']:
+            problems = compare(results, load_baseline(options['baseline']), options['tolerance'])
+            if problems:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(problems))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.concurrency import MODES, compare_modes, run_mode, speedups
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the throughput of concurrent catalog reads on WSGI, on ASGI with the "
+        "synchronous views and on ASGI with the async catalog views (needs seed_catalog data)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default=','.join(MODES), help=f'Comma-separated, from {", ".join(MODES)}.')
+        parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated requests in flight.')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per mode and concurrency level.')
+        parser.add_argument('--scenarios', default='', help='Comma-separated catalog scenarios (default: all).')
+        parser.add_argument('--use-cache', action='store_true', help='Leave the catalog response cache on.')
+        parser.add_argument('--worker', choices=list(MODES), help='Run one mode in this process and print JSON.')
+
+    def handle(self, *args, **options):
+        names = [name for name in options['scenarios'].split(',') if name]
+        levels = [int(level) for level in options['concurrency'].split(',') if level]
+        try:
+            if options['worker']:
+                results = run_mode(options['worker'], levels, options['requests'], names, options['use_cache'])
+                self.stdout.write(json.dumps([result.as_dict() for result in results]))
+                return
+            modes = [mode for mode in options['modes'].split(',') if mode]
+            results = compare_modes(modes, levels, options['requests'], names, options['use_cache'])
+        except (LookupError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        relative = speedups(results)
+        self.stdout.write(f"{'mode':<11}{'in flight':>10}{'req/s':>9}{'vs wsgi':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+        for result in results:
+            ratio = relative.get((result.mode, result.concurrency))
+            self.stdout.write(
+                f"{result.mode:<11}{result.concurrency:>10}{result.per_second:>9.1f}"
+                f"{f'{ratio:.2f}x' if ratio else '-':>9}{result.p50_ms:>9.2f}{result.p99_ms:>9.2f}{result.errors:>8}"
+            )
+        if any(result.errors for result in results):
+            raise CommandError('Some requests did not return 200.')
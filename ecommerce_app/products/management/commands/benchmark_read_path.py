@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.serializers import run_read_path_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rendering product and order pages through the DRF serializers "
+        "with the fast ReadPlan path used by list/retrieve."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='20,100,1000', help='Comma-separated rows per page.')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of integers.')
+        results = run_read_path_benchmark(sizes, options['repeat'])
+        self.stdout.write(f"{'endpoint':<10}{'rows':>7}{'serializer ms':>16}{'plan ms':>10}{'speedup':>10}")
+        for result in results:
+            self.stdout.write(
+                f"{result.endpoint:<10}{result.rows:>7}{result.serializer_ms:>16.2f}"
+                f"{result.plan_ms:>10.2f}{result.speedup:>9.1f}x"
+            )
+        if not all(result.identical for result in results):
+            raise CommandError('The fast path rendered different output than the serializer.')
+        self.stdout.write(self.style.SUCCESS('Outputs identical.'))
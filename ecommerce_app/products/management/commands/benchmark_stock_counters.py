@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.stock import RESTOCK_MODES, run_restock_contention
+
+
+class Command(BaseCommand):
+    help = (
+        "Add stock to one hot product from many threads, updating the product row in place and through the "
+        "sharded stock counters, and compare throughput. Run against PostgreSQL for meaningful numbers: "
+        "SQLite locks the whole database for every write."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--movements', type=int, default=2000, help='Stock movements in total, per mode.')
+        parser.add_argument('--shards', type=int, default=8)
+        parser.add_argument('--hold-ms', type=float, default=2.0,
+                            help='How long each transaction stays open after its write.')
+        parser.add_argument('--modes', default=','.join(RESTOCK_MODES))
+
+    def handle(self, *args, **options):
+        results = []
+        for mode in options['modes'].split(','):
+            try:
+                result = run_restock_contention(
+                    mode, options['threads'], options['movements'], options['shards'], options['hold_ms'] / 1000,
+                )
+            except LookupError as exc:
+                raise CommandError(str(exc))
+            results.append(result)
+            self.stdout.write(
+                f"{result.mode:>10}: {result.threads} threads, {result.shards} shards, {result.movements} movements, "
+                f"{result.errors} errors; {result.per_second:.0f} movements/s over {result.seconds:.2f}s"
+            )
+            if result.compactions or result.compaction_errors:
+                self.stdout.write(f"{'':>12}{result.compactions} concurrent compactions, {result.compaction_errors} failed")
+        if len(results) == 2 and results[0].per_second:
+            self.stdout.write(f"sharded / single-row: {results[1].per_second / results[0].per_second:.2f}x")
+        if any(not result.consistent for result in results):
+            raise CommandError('Stock accounting is inconsistent: units were lost or folded twice.')
+        self.stdout.write(self.style.SUCCESS('No units lost.'))
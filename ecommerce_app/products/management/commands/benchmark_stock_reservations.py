@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.stock import run_reservation_contention
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer one product with concurrent stock reservations and check that it is "
+        "never oversold. Run against PostgreSQL for meaningful numbers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--stock', type=int, default=1000)
+        parser.add_argument('--attempts', type=int, default=None,
+                            help='Reservation attempts per thread (default: enough to exhaust the stock).')
+
+    def handle(self, *args, **options):
+        result = run_reservation_contention(options['threads'], options['stock'], options['attempts'])
+        self.stdout.write(
+            f"{result.threads} threads, {result.attempts} attempts on {result.initial_stock} units: "
+            f"{result.reserved} reserved, {result.rejected} rejected, {result.errors} errors, "
+            f"final stock {result.final_stock}"
+        )
+        self.stdout.write(f"{result.per_second:.0f} reservations/s over {result.seconds:.2f}s")
+        if result.oversold or not result.consistent:
+            raise CommandError('Stock accounting is inconsistent: the product was oversold or units were lost.')
+        self.stdout.write(self.style.SUCCESS('No oversell.'))
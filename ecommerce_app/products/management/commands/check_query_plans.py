@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.plans import check_plans
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN every query the read scenarios run against the seeded data and fail "
+        "on sequential scans over the large tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default='', help='Comma-separated scenario names (default: all reads).')
+
+    def handle(self, *args, **options):
+        names = [name for name in options['scenarios'].split(',') if name]
+        try:
+            problems = check_plans(names)
+        except (LookupError, NotImplementedError) as exc:
+            raise CommandError(str(exc))
+        for problem in problems:
+            self.stdout.write(str(problem))
+        if problems:
+            raise CommandError(f'{len(problems)} queries scan a large table sequentially.')
+        self.stdout.write(self.style.SUCCESS('Every read path uses an index.'))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.stock import compact_stock
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold the sharded stock counters (restocks, returns and adjustments recorded in the stock ledger) "
+        "into Product.stock_quantity. Run it periodically, e.g. every minute from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Products per transaction (default: STOCK_COMPACTION_BATCH_SIZE).')
+        parser.add_argument('--forever', action='store_true', help='Keep compacting instead of exiting.')
+        parser.add_argument('--interval', type=float, default=30.0, help='Seconds between runs with --forever.')
+
+    def handle(self, *args, **options):
+        while True:
+            compacted = compact_stock(batch_size=options['batch_size'])
+            if compacted or not options['forever']:
+                self.stdout.write(self.style.SUCCESS(f'Compacted the stock counters of {compacted} products.'))
+            if not options['forever']:
+                return
+            time.sleep(options['interval'])
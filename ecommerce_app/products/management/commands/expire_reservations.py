@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from products.reservations import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Cancel pending orders whose stock reservation has expired and put the stock back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Orders handled per sweep (default: 500).')
+
+    def handle(self, *args, **options):
+        cancelled, settled = expire_reservations(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Cancelled {cancelled} unpaid orders; settled {settled} expired reservations.'
+        ))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.exports import DATASETS, FORMATS, iter_export
+from products.serializers import ExportParamsSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream orders, order items or payments as NDJSON or CSV, "
+        "optionally limited to a created_at range and a status."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', dest='file_format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--start', help='Created at or after (ISO date or datetime).')
+        parser.add_argument('--end', help='Created before (ISO date or datetime).')
+        parser.add_argument('--status')
+        parser.add_argument('--output', help='File to write (default: stdout).')
+
+    def handle(self, *args, **options):
+        spec = DATASETS[options['dataset']]
+        data = {key: options[key] for key in ('start', 'end', 'status', 'file_format') if options[key]}
+        params = ExportParamsSerializer(data=data, context={'dataset': spec})
+        if not params.is_valid():
+            raise CommandError('; '.join(f'{field}: {" ".join(errors)}' for field, errors in params.errors.items()))
+        file_format = params.validated_data.pop('file_format')
+        lines = iter_export(spec, spec.queryset(**params.validated_data), file_format)
+
+        if options['output']:
+            count = 0
+            with open(options['output'], 'w', newline='', encoding='utf-8') as out:
+                for line in lines:
+                    out.write(line)
+                    count += 1
+            self.stderr.write(f'Wrote {count} lines to {options["output"]}.')
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
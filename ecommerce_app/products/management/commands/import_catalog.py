@@ -0,0 +1,47 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.imports import FORMATS, IMPORTERS, import_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Insert or update categories, products or product images from a CSV or NDJSON "
+        "file, in batches, and report the rows that failed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(IMPORTERS))
+        parser.add_argument('path', help="File to read, or '-' for stdin.")
+        parser.add_argument('--format', dest='file_format', choices=FORMATS,
+                            help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows validated and written per batch (default: IMPORT_BATCH_SIZE).')
+        parser.add_argument('--errors', help='Write the per-row error report (NDJSON) to this file.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['file_format'] or path.rsplit('.', 1)[-1].lower()
+        if file_format not in FORMATS:
+            raise CommandError('Cannot tell the format from the file name; pass --format.')
+
+        if path == '-':
+            report = import_rows(options['dataset'], sys.stdin, file_format, options['batch_size'])
+        else:
+            with open(path, newline='', encoding='utf-8-sig') as stream:
+                report = import_rows(options['dataset'], stream, file_format, options['batch_size'])
+
+        if options['errors']:
+            with open(options['errors'], 'w', encoding='utf-8') as out:
+                for error in report.sorted_errors():
+                    out.write(json.dumps(error) + '\n')
+        else:
+            for error in report.sorted_errors()[:20]:
+                self.stderr.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+            if len(report.errors) > 20:
+                self.stderr.write(f'... {len(report.errors) - 20} more; use --errors to save them all.')
+
+        message = f'Processed {report.processed} rows: {report.imported} imported, {report.failed} failed.'
+        self.stdout.write(self.style.SUCCESS(message) if not report.failed else self.style.WARNING(message))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from products.images import pending_assets, process_asset
+
+
+class Command(BaseCommand):
+    help = (
+        "Make the resized variants of uploaded product images that have none yet or whose processing failed, "
+        "for instance after a restart. With --all, remake every image's variants (after changing the widths)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Remake the variants of processed images too.')
+
+    def handle(self, *args, **options):
+        processed = failed = 0
+        for asset_id in pending_assets(include_ready=options['all']).values_list('pk', flat=True).iterator():
+            if process_asset(asset_id) is None:
+                failed += 1
+            else:
+                processed += 1
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} images; {failed} failed.'))
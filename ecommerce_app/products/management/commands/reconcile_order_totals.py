@@ -0,0 +1,66 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from products.models import Order, item_total_subquery
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare every Order.total_amount with the sum of its item subtotals, "
+        "in batched aggregate queries, and report (or fix) any drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Orders checked per aggregate query (default: 5000).')
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite drifted totals instead of only reporting them.')
+        parser.add_argument('--show', type=int, default=10,
+                            help='How many drifted orders to list (default: 10).')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        checked = drifted = fixed = 0
+        total_drift = Decimal('0')
+        examples = []
+
+        last_pk = None
+        while True:
+            # Walk the orders by primary key so each batch is an index range scan.
+            orders = Order.objects.order_by('pk')
+            if last_pk is not None:
+                orders = orders.filter(pk__gt=last_pk)
+            bounds = list(orders.values_list('pk', flat=True)[batch_size - 1:batch_size])
+            batch = orders if not bounds else orders.filter(pk__lte=bounds[0])
+
+            rows = list(
+                batch.annotate(actual=item_total_subquery())
+                .exclude(total_amount=F('actual'))
+                .values_list('pk', 'total_amount', 'actual')
+            )
+            checked += batch_size if bounds else orders.count()
+            drifted += len(rows)
+            for pk, stored, actual in rows:
+                total_drift += abs(stored - actual)
+                if len(examples) < options['show']:
+                    examples.append((pk, stored, actual))
+            if rows and options['fix']:
+                fixed += Order.objects.filter(pk__in=[pk for pk, _, _ in rows]).recompute_totals()
+
+            if not bounds:
+                break
+            last_pk = bounds[0]
+
+        for pk, stored, actual in examples:
+            self.stdout.write(f'  order {pk}: stored {stored}, items sum to {actual}')
+        summary = (
+            f'Checked {checked} orders in {time.monotonic() - started:.2f}s: '
+            f'{drifted} drifted (total drift {total_drift})'
+        )
+        if options['fix']:
+            summary += f', {fixed} fixed'
+        self.stdout.write(self.style.WARNING(summary) if drifted and not options['fix'] else self.style.SUCCESS(summary))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmarks.seed import SeedVolumes, clear_seed, seed_catalog, seeded
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-create a reproducible data set (users, a category tree, products, images, "
+        "orders with items, payments and addresses) for benchmarks and load tests."
+    )
+
+    def add_arguments(self, parser):
+        defaults = SeedVolumes()
+        for name, default in defaults.as_dict().items():
+            parser.add_argument(f'--{name}', type=int, default=default)
+        parser.add_argument('--seed', type=int, default=42, help='Random seed; the same seed gives the same data.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--clear', action='store_true', help='Delete previously seeded data first.')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            clear_seed()
+        elif seeded():
+            raise CommandError('Seeded data already exists; pass --clear to replace it.')
+        volumes = SeedVolumes(**{name: options[name] for name in SeedVolumes().as_dict()})
+        counts = seed_catalog(volumes, seed=options['seed'], batch_size=options['batch_size'])
+        for name, count in counts.items():
+            self.stdout.write(f'{name:<12}{count:>10}')
+        self.stdout.write(self.style.SUCCESS('Seeded.'))
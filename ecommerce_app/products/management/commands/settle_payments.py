@@ -0,0 +1,41 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from products.settlement import get_gateway, settle_payments
+
+
+class Command(BaseCommand):
+    help = (
+        "Capture pending payments through the payment gateway in batches, then mark them completed or failed "
+        "and their orders paid. Several workers can run at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gateway', help='Dotted path of the gateway client class (default: PAYMENT_GATEWAY).')
+        parser.add_argument('--batch-size', type=int, help='Payments claimed per batch (default: PAYMENT_SETTLEMENT_BATCH_SIZE).')
+        parser.add_argument('--concurrency', type=int, help='Gateway calls in flight (default: PAYMENT_SETTLEMENT_CONCURRENCY).')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches.')
+        parser.add_argument('--forever', action='store_true', help='Keep polling for due payments instead of exiting.')
+        parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between polls with --forever.')
+
+    def handle(self, *args, **options):
+        try:
+            gateway = get_gateway(options['gateway'])
+        except (ImproperlyConfigured, ImportError) as exc:
+            raise CommandError(str(exc))
+        batch = {'batch_size': options['batch_size'], 'concurrency': options['concurrency']}
+        while True:
+            stats = settle_payments(gateway, max_batches=options['max_batches'], **batch)
+            if stats.claimed or stats.failed or not options['forever']:
+                self.report(stats)
+            if not options['forever']:
+                return
+            time.sleep(options['poll_interval'])
+
+    def report(self, stats):
+        self.stdout.write(self.style.SUCCESS(
+            f'Claimed {stats.claimed} payments: {stats.completed} completed, {stats.failed} failed, '
+            f'{stats.retried} rescheduled; {stats.orders_paid} orders paid ({stats.per_second:.1f} payments/s).'
+        ))
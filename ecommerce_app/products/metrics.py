@@ -0,0 +1,323 @@
+"""
+Per-endpoint request metrics in Prometheus text format.
+
+`MetricsMiddleware` times every request served by an API view and, through a
+database execute wrapper, counts its SQL queries and the time spent in them.
+Serializer time is collected by `TimedSerializerMixin` and the fast read path.
+Everything is labelled with the view class and viewset action and aggregated
+into fixed-bucket histograms, per worker process, which
+`GET /api/metrics/` renders for Prometheus.
+
+A request that runs the same query shape (the SQL with its parameters left out
+and `IN (...)` lists collapsed) `METRICS_N_PLUS_ONE_THRESHOLD` times or more is
+counted as an N+1 and logged with the offending SQL.
+
+`products.hashing` reports its queue and hashing times here as well, labelled
+by operation rather than by view, and `products.settlement` its gateway calls
+and settled payments, labelled by outcome.
+
+Each query costs one `perf_counter` pair and a dictionary update; each
+response one lock acquisition. Set `METRICS_ENABLED = False` to switch it off.
+"""
+import bisect
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+_LITERAL_NUMBER = re.compile(r'\b(LIMIT|OFFSET) \d+')
+
+
+def enabled():
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+def n_plus_one_threshold():
+    return getattr(settings, 'METRICS_N_PLUS_ONE_THRESHOLD', 5)
+
+
+def query_shape(sql):
+    """The SQL with `IN (%s, %s, ...)` lists and LIMIT/OFFSET values collapsed."""
+    return _LITERAL_NUMBER.sub(r'\1 N', _IN_LIST.sub('(%s...)', sql))
+
+
+class Histogram:
+    """Cumulative-bucket histogram; not locked, the registry holds the lock."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class RequestStats:
+    """What one request did; filled in while it runs."""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.shapes = Counter()
+        self.in_serializer = False
+
+    def record_query(self, sql, seconds):
+        stats = self
+        while stats is not None:
+            stats.query_seconds += seconds
+            stats.queries += 1
+            stats.shapes[sql] += 1
+            stats = stats.parent
+
+    def repeated_queries(self, threshold):
+        """{shape: count} for every query shape run at least `threshold` times."""
+        shapes = Counter()
+        for sql, count in self.shapes.items():
+            shapes[query_shape(sql)] += count
+        return {shape: count for shape, count in shapes.items() if count >= threshold}
+
+
+_current = contextvars.ContextVar('products_request_stats', default=None)
+
+
+def record_queries(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every connection. It looks the collecting
+    block up in a context variable, so queries that sync_to_async runs in
+    another thread are still attributed to the request that issued them.
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - start)
+
+
+def install(connection, **kwargs):
+    if record_queries not in connection.execute_wrappers:
+        # First, so that execute_wrapper() blocks, which pop the last wrapper, leave it alone.
+        connection.execute_wrappers.insert(0, record_queries)
+
+
+connection_created.connect(install)
+
+
+@contextmanager
+def collect():
+    """Record the queries run inside the block, including those of enclosing blocks."""
+    for connection in connections.all(initialized_only=True):
+        install(connection)
+    stats = RequestStats(parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def serializer_timer():
+    """Add the time spent inside the block to the current request's serializer time."""
+    stats = _current.get()
+    if stats is None or stats.in_serializer:
+        yield
+        return
+    stats.in_serializer = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serializer_seconds += time.perf_counter() - start
+        stats.in_serializer = False
+
+
+class TimedSerializerMixin:
+    """Serializer mixin that counts (de)serialization towards the request's serializer time."""
+
+    def to_representation(self, instance):
+        with serializer_timer():
+            return super().to_representation(instance)
+
+    def run_validation(self, *args, **kwargs):
+        with serializer_timer():
+            return super().run_validation(*args, **kwargs)
+
+
+REQUEST_LABELS = ('view', 'action')
+HISTOGRAMS = {
+    'api_request_duration_seconds': ('Time spent serving the request.', SECONDS_BUCKETS, REQUEST_LABELS),
+    'api_request_queries': ('SQL queries run by the request.', QUERY_BUCKETS, REQUEST_LABELS),
+    'api_request_query_duration_seconds': ('Time spent in SQL queries.', SECONDS_BUCKETS, REQUEST_LABELS),
+    'api_request_serializer_duration_seconds': ('Time spent in serializers.', SECONDS_BUCKETS, REQUEST_LABELS),
+    'api_response_size_bytes': (
+        'Size of the response body (streamed responses are not counted).', BYTES_BUCKETS, REQUEST_LABELS,
+    ),
+    'password_hash_queue_seconds': (
+        'Time a password hash or check waited for a hashing worker.', SECONDS_BUCKETS, ('operation',),
+    ),
+    'password_hash_seconds': ('Time spent hashing or checking a password.', SECONDS_BUCKETS, ('operation',)),
+    'payment_gateway_seconds': ('Time spent in one payment gateway call.', SECONDS_BUCKETS, ('outcome',)),
+}
+COUNTERS = {
+    'api_requests_total': ('Requests served, by response status.', REQUEST_LABELS + ('status',)),
+    'api_n_plus_one_total': (
+        'Requests that repeated one query shape at least METRICS_N_PLUS_ONE_THRESHOLD times.', REQUEST_LABELS,
+    ),
+    'password_hash_rejected_total': (
+        'Password hashes refused because every hashing worker and queue slot was taken.', ('operation',),
+    ),
+    'payments_settled_total': ('Claimed payments completed, failed or rescheduled by settlement.', ('outcome',)),
+}
+
+
+def _format_labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class MetricsRegistry:
+    """Per-process histograms and counters, keyed by their label values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {
+                name: defaultdict(lambda buckets=buckets: Histogram(buckets))
+                for name, (_, buckets, _) in HISTOGRAMS.items()
+            }
+            self.counters = {name: Counter() for name in COUNTERS}
+
+    def observe(self, name, labels, value):
+        """Add `value` to histogram `name`; `labels` is a tuple in the metric's label order."""
+        with self.lock:
+            self.histograms[name][labels].observe(value)
+
+    def increment(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[name][labels] += amount
+
+    def record(self, view, action, status, duration, stats, size=None, repeated=False):
+        key = (view, action)
+        with self.lock:
+            self.histograms['api_request_duration_seconds'][key].observe(duration)
+            self.histograms['api_request_queries'][key].observe(stats.queries)
+            self.histograms['api_request_query_duration_seconds'][key].observe(stats.query_seconds)
+            self.histograms['api_request_serializer_duration_seconds'][key].observe(stats.serializer_seconds)
+            if size is not None:
+                self.histograms['api_response_size_bytes'][key].observe(size)
+            self.counters['api_requests_total'][key + (str(status),)] += 1
+            if repeated:
+                self.counters['api_n_plus_one_total'][key] += 1
+
+    def render(self):
+        """Everything recorded so far, in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, (help_text, _, label_names) in HISTOGRAMS.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for key, histogram in sorted(self.histograms[name].items()):
+                    labels = _format_labels(label_names, key)
+                    for bound, count in histogram.samples():
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+            for name, (help_text, label_names) in COUNTERS.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for key, count in sorted(self.counters[name].items()):
+                    lines.append(f'{name}{{{_format_labels(label_names, key)}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def view_labels(view_func, method):
+    """(view class name, action) for a DRF view or one of our class-based views, or None for anything else."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        # Plain Django views are only counted when they are ours (not the admin's, say).
+        view_class = getattr(view_func, 'view_class', None)
+        if view_class is None or not view_class.__module__.startswith('products.'):
+            return None
+    actions = getattr(view_func, 'actions', None) or {}
+    return view_class.__name__, actions.get(method.lower(), method.lower())
+
+
+class MetricsMiddleware:
+    """
+    Collect per-request metrics for API views; put it first in MIDDLEWARE.
+    It runs natively under both WSGI and ASGI, so async views are not moved
+    onto the sync thread on its account.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not enabled():
+            return self.get_response(request)
+        start = time.perf_counter()
+        with collect() as stats:
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    async def __acall__(self, request):
+        if not enabled():
+            return await self.get_response(request)
+        start = time.perf_counter()
+        with collect() as stats:
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    def record(self, request, response, duration, stats):
+        match = getattr(request, 'resolver_match', None)
+        labels = match and view_labels(match.func, request.method)
+        if labels is None:
+            return
+        repeated = stats.repeated_queries(n_plus_one_threshold())
+        for shape, count in repeated.items():
+            logger.warning('Possible N+1 in %s.%s: %d x %s', *labels, count, shape[:500])
+        size = None if response.streaming else len(response.content)
+        registry.record(*labels, response.status_code, duration, stats, size=size, repeated=bool(repeated))
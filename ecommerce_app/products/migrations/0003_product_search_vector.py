@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:46
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # tsvector/GIN only exist on PostgreSQL; other backends use the in-process index.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "UPDATE products_product SET search_vector = "
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+    )
+    schema_editor.execute(
+        "CREATE INDEX products_product_search_vector_gin "
+        "ON products_product USING gin (search_vector)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS products_product_search_vector_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_alter_order_total_amount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    Category = apps.get_model('products', 'Category')
+    parents = dict(Category.objects.values_list('pk', 'parent_id'))
+    children = {}
+    for pk, parent_id in parents.items():
+        children.setdefault(parent_id if parent_id in parents else None, []).append(pk)
+
+    paths = {}
+    queue = [(pk, '', 0) for pk in children.get(None, [])]
+    while queue:
+        pk, prefix, depth = queue.pop()
+        paths[pk] = (prefix + pk.hex + '/', depth)
+        queue.extend((child, paths[pk][0], depth + 1) for child in children.get(pk, []))
+    # Anything left over sits in a parent cycle; treat it as a root.
+    for pk in parents.keys() - paths.keys():
+        paths[pk] = (pk.hex + '/', 0)
+
+    categories = list(Category.objects.all())
+    for category in categories:
+        category.path, category.depth = paths[category.pk]
+    Category.objects.bulk_update(categories, ['path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
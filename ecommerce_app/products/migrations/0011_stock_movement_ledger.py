@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:12
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_product_image_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCounterShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('delta', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('delta', 0), _negated=True), fields=['product'], name='stock_shard_pending_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'shard'), name='stock_shard_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('movement_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('quantity', models.IntegerField()),
+                ('reason', models.CharField(choices=[('restock', 'Restock'), ('return', 'Return'), ('release', 'Released reservation'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'created_at'], name='stockmovement_product_idx')],
+            },
+        ),
+    ]
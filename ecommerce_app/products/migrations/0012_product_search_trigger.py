@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:05
+
+from django.db import migrations
+
+
+def create_search_trigger(apps, schema_editor):
+    # tsvector only exists on PostgreSQL; other backends use the in-process index.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # Rows written by code that skipped the index; done before the trigger,
+    # which would keep their NULL vector.
+    schema_editor.execute(
+        "UPDATE products_product SET search_vector = "
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B') "
+        "WHERE search_vector IS NULL"
+    )
+    # Django's UPDATE also writes the vector it holds in memory, which may be
+    # stale, so keep the stored one whenever the text did not change.
+    schema_editor.execute(
+        "CREATE OR REPLACE FUNCTION products_product_search_vector_update() RETURNS trigger AS $$ "
+        "BEGIN "
+        "IF TG_OP = 'UPDATE' AND NEW.name IS NOT DISTINCT FROM OLD.name "
+        "AND NEW.description IS NOT DISTINCT FROM OLD.description THEN "
+        "NEW.search_vector := OLD.search_vector; "
+        "ELSE "
+        "NEW.search_vector := "
+        "setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B'); "
+        "END IF; "
+        "RETURN NEW; "
+        "END "
+        "$$ LANGUAGE plpgsql"
+    )
+    # Stock and price updates leave these columns out and skip the trigger.
+    schema_editor.execute(
+        "CREATE TRIGGER products_product_search_vector_trigger "
+        "BEFORE INSERT OR UPDATE OF name, description, search_vector ON products_product "
+        "FOR EACH ROW EXECUTE FUNCTION products_product_search_vector_update()"
+    )
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP TRIGGER IF EXISTS products_product_search_vector_trigger ON products_product")
+    schema_editor.execute("DROP FUNCTION IF EXISTS products_product_search_vector_update()")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_stock_movement_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
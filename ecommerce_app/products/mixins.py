@@ -0,0 +1,227 @@
+"""
+Query-string controls over the shape of read responses.
+
+?expand= renders related objects inline instead of as primary keys.
+
+A serializer lists what may be expanded in `expandable_fields`:
+
+    expandable_fields = {
+        'category': ('CategorySerializer', {}),
+        'images': ('ProductImageSerializer', {'many': True}),
+    }
+
+Serializer classes may be given by name (looked up in the serializer's own
+module), which avoids ordering problems between serializers that expand each
+other. Nested expansions use dots, e.g. ?expand=items,items.product.
+
+`ExpandMixin` parses the parameter on read requests, hands it to the serializer
+and adds the matching `select_related` / `prefetch_related` to the queryset, so
+the number of queries depends on what is expanded, not on the page size.
+
+?fields= and ?omit= (`SparseFieldsMixin`) pick which fields are rendered and
+narrow the SELECT to the columns those fields read.
+"""
+import sys
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, OrderBy
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+EXPAND_PARAM = 'expand'
+FIELDS_PARAM = 'fields'
+OMIT_PARAM = 'omit'
+
+
+def parse_expand(value):
+    """'items,items.product,payments' -> {'items': {'product': {}}, 'payments': {}}"""
+    tree = {}
+    for path in (value or '').split(','):
+        node = tree
+        for name in filter(None, (part.strip() for part in path.split('.'))):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def parse_names(value):
+    return [name for name in (part.strip() for part in (value or '').split(',')) if name]
+
+
+def resolve_serializer(owner, serializer_class):
+    if isinstance(serializer_class, str):
+        return getattr(sys.modules[owner.__module__], serializer_class)
+    return serializer_class
+
+
+def validate_expand(serializer_class, tree, prefix=''):
+    """Raise a ValidationError for any name the serializers do not allow to expand."""
+    expandable = getattr(serializer_class, 'expandable_fields', {})
+    for name, nested in tree.items():
+        if name not in expandable:
+            raise serializers.ValidationError({EXPAND_PARAM: [f'"{prefix}{name}" cannot be expanded.']})
+        child = resolve_serializer(serializer_class, expandable[name][0])
+        validate_expand(child, nested, prefix=f'{prefix}{name}.')
+
+
+def expand_lookups(serializer_class, tree, model, prefix='', single_valued=True):
+    """Yield (lookup, single_valued) for every relation the expansion will render."""
+    expandable = getattr(serializer_class, 'expandable_fields', {})
+    for name, nested in tree.items():
+        child, options = expandable[name]
+        child = resolve_serializer(serializer_class, child)
+        source = options.get('source', name)
+        field = model._meta.get_field(source)
+        lookup = f'{prefix}{source}'
+        single = single_valued and (field.many_to_one or field.one_to_one)
+        yield lookup, single
+        yield from expand_lookups(child, nested, field.related_model, lookup + LOOKUP_SEP, single)
+
+
+class ExpandableFieldsMixin:
+    """Serializer mixin that swaps the fields named in `expand` for nested serializers."""
+    expandable_fields = {}
+
+    def __init__(self, *args, expand=None, **kwargs):
+        self.expand = expand or {}
+        super().__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for name, nested in self.expand.items():
+            serializer_class, options = self.expandable_fields[name]
+            serializer_class = resolve_serializer(type(self), serializer_class)
+            if nested:
+                options = dict(options, expand=nested)
+            fields[name] = serializer_class(read_only=True, **options)
+        return fields
+
+
+class ExpandMixin:
+    """
+    ViewSet mixin for ?expand=. Only read requests are expanded; writes keep
+    accepting and returning primary keys.
+    """
+    expand_param = EXPAND_PARAM
+
+    def get_expand(self):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return {}
+        if not hasattr(self, '_expand'):
+            tree = parse_expand(request.query_params.get(self.expand_param))
+            validate_expand(self.get_serializer_class(), tree)
+            self._expand = tree
+        return self._expand
+
+    def get_serializer(self, *args, **kwargs):
+        expand = self.get_expand()
+        if expand:
+            kwargs.setdefault('expand', expand)
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        return self.expand_queryset(super().filter_queryset(queryset))
+
+    def expand_queryset(self, queryset):
+        expand = self.get_expand()
+        if not expand:
+            return queryset
+        select, prefetch = [], []
+        for lookup, single in expand_lookups(self.get_serializer_class(), expand, queryset.model):
+            (select if single else prefetch).append(lookup)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+class SparseFieldsMixin:
+    """
+    ViewSet mixin for ?fields=a,b and ?omit=c on list and retrieve.
+
+    Unwanted fields are dropped from the serializer and the queryset is
+    narrowed with `.only()` to the columns the remaining fields read, plus the
+    primary key and the ordering columns the pagination cursor needs. If a kept
+    field reads something other than a model field (a property, a method, the
+    whole object), every column is still selected.
+    """
+    fields_param = FIELDS_PARAM
+    omit_param = OMIT_PARAM
+    sparse_actions = ('list', 'retrieve')
+
+    def get_sparse_fields(self):
+        """Names of the serializer fields to render, or None for all of them."""
+        request = getattr(self, 'request', None)
+        if request is None or getattr(self, 'action', None) not in self.sparse_actions:
+            return None
+        if not hasattr(self, '_sparse_fields'):
+            requested = parse_names(request.query_params.get(self.fields_param))
+            omitted = parse_names(request.query_params.get(self.omit_param))
+            self._sparse_fields = None
+            if requested or omitted:
+                available = list(self.unpruned_serializer().fields)
+                for param, names in ((self.fields_param, requested), (self.omit_param, omitted)):
+                    unknown = [name for name in names if name not in available]
+                    if unknown:
+                        raise serializers.ValidationError({param: [f'Unknown field "{name}".' for name in unknown]})
+                keep = requested or available
+                self._sparse_fields = [name for name in available if name in keep and name not in omitted]
+        return self._sparse_fields
+
+    def unpruned_serializer(self):
+        self._pruning = False
+        try:
+            return self.get_serializer()
+        finally:
+            del self._pruning
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if getattr(self, '_pruning', True):
+            keep = self.get_sparse_fields()
+            if keep is not None:
+                fields = getattr(serializer, 'child', serializer).fields
+                for name in list(fields):
+                    if name not in keep:
+                        fields.pop(name)
+        return serializer
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        keep = self.get_sparse_fields()
+        if keep is None:
+            return queryset
+        columns = self.sparse_columns(queryset, keep)
+        return queryset if columns is None else queryset.only(*columns)
+
+    def sparse_columns(self, queryset, keep):
+        """Model fields read by the `keep` serializer fields, or None if that cannot be narrowed."""
+        opts = queryset.model._meta
+        columns = {opts.pk.name}
+        fields = self.unpruned_serializer().fields
+        for name in keep:
+            source_attrs = getattr(fields[name], 'source_attrs', None)
+            if not source_attrs:
+                return None
+            try:
+                field = opts.get_field(source_attrs[0])
+            except FieldDoesNotExist:
+                return None
+            if field.concrete and not field.many_to_many:
+                columns.add(field.name)
+            elif not field.auto_created:
+                return None
+            # Reverse relations are rendered from prefetches keyed on the primary key.
+        for item in queryset.query.order_by:
+            if isinstance(item, OrderBy) and isinstance(item.expression, F):
+                item = item.expression.name
+            if isinstance(item, str):
+                name = item.lstrip('-')
+                if name != 'pk' and LOOKUP_SEP not in name and name not in queryset.query.annotations:
+                    columns.add(name)
+        # A relation followed with select_related cannot be deferred.
+        if isinstance(queryset.query.select_related, dict):
+            columns.update(queryset.query.select_related)
+        return columns
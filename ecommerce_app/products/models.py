@@ -1,11 +1,18 @@
 import uuid
 import re
 from decimal import Decimal
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Concat, Substr
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.base_user import BaseUserManager
 from django.utils.translation import gettext_lazy as _
-from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.dispatch import Signal
+from django.contrib.postgres.search import SearchVectorField
+from .cache import invalidate
+from .search import SEARCH_FIELDS, index_products, needs_indexing
 
 
 class UserRole(models.TextChoices):
@@ -21,6 +28,36 @@ class OrderStatus(models.TextChoices):
     CANCELLED = 'cancelled', 'Cancelled'
 
 
+# The statuses an order may move to from each status. Order.save() and
+# products.transitions refuse every other change.
+ORDER_TRANSITIONS = {
+    OrderStatus.PENDING: (OrderStatus.PAID, OrderStatus.CANCELLED),
+    OrderStatus.PAID: (OrderStatus.SHIPPED, OrderStatus.CANCELLED),
+    OrderStatus.SHIPPED: (OrderStatus.DELIVERED, OrderStatus.CANCELLED),  # e.g. returned to sender
+    OrderStatus.DELIVERED: (),
+    OrderStatus.CANCELLED: (),
+}
+
+
+def order_status_sources(status):
+    """The statuses an order may move to `status` from."""
+    return tuple(source for source, targets in ORDER_TRANSITIONS.items() if status in targets)
+
+
+class StockMovementReason(models.TextChoices):
+    RESTOCK = 'restock', 'Restock'
+    RETURN = 'return', 'Return'
+    RELEASE = 'release', 'Released reservation'
+    ADJUSTMENT = 'adjustment', 'Adjustment'
+
+
+class ReservationStatus(models.TextChoices):
+    ACTIVE = 'active', 'Active'
+    CONSUMED = 'consumed', 'Consumed'
+    RELEASED = 'released', 'Released'
+    EXPIRED = 'expired', 'Expired'
+
+
 class PaymentMethod(models.TextChoices):
     CREDIT_CARD = 'credit_card', 'Credit card'
     DEBIT_CARD = 'debit_card', 'Debit card'
@@ -34,6 +71,70 @@ class PaymentStatus(models.TextChoices):
     FAILED = 'failed', 'Failed'
 
 
+# Columns named by a unique violation: PostgreSQL's DETAIL line, SQLite's message.
+UNIQUE_VIOLATION_PATTERNS = (
+    re.compile(r'Key \((?P<columns>[^)]+)\)=\('),
+    re.compile(r'UNIQUE constraint failed: (?P<columns>[^\n]+)'),
+)
+
+
+class ValidatedSaveMixin:
+    """
+    Validation on save() without extra queries. Field rules and clean() run in
+    memory; uniqueness and constraints are left to the database, and a violation
+    is raised as the ValidationError full_clean() would have raised.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = (field_names, values)
+        return instance
+
+    def validate_for_save(self):
+        # A related object assigned as an instance, or the id the row was loaded
+        # with, is known to exist; only a newly set bare id is looked up.
+        loaded = dict(zip(*self._loaded_values)) if hasattr(self, '_loaded_values') else {}
+        exclude = {
+            field.name for field in self._meta.concrete_fields
+            if field.is_relation and (
+                field.is_cached(self) or loaded.get(field.attname, models.DEFERRED) == getattr(self, field.attname)
+            )
+        }
+        self.full_clean(exclude=exclude, validate_unique=False, validate_constraints=False)
+
+    def save_base(self, *args, **kwargs):
+        try:
+            return super().save_base(*args, **kwargs)
+        except IntegrityError as exc:
+            error = self.unique_violation_error(exc)
+            if error is None:
+                raise
+            raise error from exc
+
+    def unique_violation_error(self, exc):
+        """The ValidationError for a unique violation reported by the database, or None."""
+        for pattern in UNIQUE_VIOLATION_PATTERNS:
+            match = pattern.search(str(exc))
+            if match:
+                break
+        else:
+            return None
+        columns = {field.column: field.name for field in self._meta.concrete_fields}
+        names = {columns.get(column.strip().strip('"').rsplit('.', 1)[-1]) for column in match['columns'].split(',')}
+        unique_checks, _ = self._get_unique_checks(include_meta_constraints=True)
+        for model_class, unique_check in unique_checks:
+            if set(unique_check) == names:
+                key = unique_check[0] if len(unique_check) == 1 else NON_FIELD_ERRORS
+                return ValidationError({key: [self.unique_error_message(model_class, unique_check)]})
+        for constraint in self._meta.constraints:
+            if isinstance(constraint, models.UniqueConstraint) and set(constraint.fields) == names:
+                return ValidationError({NON_FIELD_ERRORS: [ValidationError(
+                    constraint.get_violation_error_message(), code=constraint.violation_error_code,
+                )]})
+        return None
+
+
 class UserManager(BaseUserManager):
     use_in_migrations = True
 
@@ -60,8 +161,8 @@ class UserManager(BaseUserManager):
         return self.create_user(email, password, **extra_fields)
 
 
-class User(AbstractUser):
-    user_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
+class User(ValidatedSaveMixin, AbstractUser):
+    user_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     username = None
     first_name = models.CharField(max_length=150)
     last_name = models.CharField(max_length=150)
@@ -85,35 +186,182 @@ class User(AbstractUser):
             raise ValidationError({'phone_number': 'Phone number must be 7–15 digits and may start with +.'})
 
     def save(self, *args, **kwargs):
-        self.full_clean()
+        self.validate_for_save()
         super().save(*args, **kwargs)
 
 
-class Category(models.Model):
-    category_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
+class CategoryQuerySet(models.QuerySet):
+
+    def subtree(self, category, include_self=True):
+        """The category and all of its descendants, at any depth, in one indexed prefix query."""
+        queryset = self.filter(path__startswith=category.path)
+        return queryset if include_self else queryset.exclude(pk=category.pk)
+
+    def reroot_orphans(self):
+        """
+        Rewrite the subtrees of categories that lost their parent without a save()
+        (on_delete=SET_NULL), making each of them a root again.
+        """
+        while True:
+            # One at a time: re-rooting one subtree can change the paths of the others.
+            orphan = self.filter(parent__isnull=True, depth__gt=0).values_list('pk', 'path', 'depth').first()
+            if orphan is None:
+                return
+            pk, path, depth = orphan
+            self.model._move_subtree(path, depth, pk.hex + self.model.PATH_SEPARATOR, 0)
+
+    def rebuild_paths(self, batch_size=1000):
+        """
+        Recompute `path` and `depth` of every category from `parent`, for writes
+        that bypass save() such as bulk imports. Returns the number of rows changed.
+        """
+        rows = {pk: (parent_id, path, depth) for pk, parent_id, path, depth
+                in self.values_list('pk', 'parent_id', 'path', 'depth')}
+        children = {}
+        for pk, (parent_id, _, _) in rows.items():
+            children.setdefault(parent_id if parent_id in rows else None, []).append(pk)
+
+        separator = self.model.PATH_SEPARATOR
+        positions = {}
+        queue = [(pk, '', 0) for pk in children.get(None, [])]
+        while queue:
+            pk, prefix, depth = queue.pop()
+            positions[pk] = (prefix + pk.hex + separator, depth)
+            queue.extend((child, positions[pk][0], depth + 1) for child in children.get(pk, []))
+        # Anything left over sits in a parent cycle; treat it as a root.
+        for pk in rows.keys() - positions.keys():
+            positions[pk] = (pk.hex + separator, 0)
+
+        changed = [
+            self.model(pk=pk, path=path, depth=depth)
+            for pk, (path, depth) in positions.items()
+            if (path, depth) != rows[pk][1:]
+        ]
+        self.bulk_update(changed, ['path', 'depth'], batch_size=batch_size)
+        return len(changed)
+
+
+class Category(ValidatedSaveMixin, models.Model):
+    PATH_SEPARATOR = '/'
+
+    category_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     parent = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="subcategories")
+    # Materialized path: the hex ids of every ancestor and of the category itself,
+    # each followed by '/'. A subtree is a single `path LIKE 'prefix%'` index scan.
+    path = models.CharField(max_length=1024, db_index=True, editable=False, default='')
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CategoryQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        self.full_clean()
-        super().save(*args, **kwargs)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_path = instance.__dict__.get('path')
+        return instance
+
+    @classmethod
+    def _move_subtree(cls, old_path, old_depth, new_path, new_depth):
+        cls._base_manager.filter(path__startswith=old_path).update(
+            path=Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=models.CharField()),
+            depth=F('depth') + (new_depth - old_depth),
+        )
 
+    def clean(self):
+        super().clean()
+        if self.parent_id is not None and self.parent_id == self.pk:
+            raise ValidationError({'parent': 'A category cannot be its own parent.'})
+
+    def get_descendants(self, include_self=False):
+        return Category.objects.subtree(self, include_self=include_self)
 
-class Product(models.Model):
-    product_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
+    def save(self, *args, **kwargs):
+        self.validate_for_save()
+        own = self.pk.hex + self.PATH_SEPARATOR
+        if self.parent_id is None:
+            path, depth = own, 0
+        else:
+            # Read the parent's position from the database; an in-memory parent may be stale.
+            parent_path, parent_depth = Category._base_manager.filter(pk=self.parent_id).values_list('path', 'depth').get()
+            path, depth = parent_path + own, parent_depth + 1
+        if len(path) > self._meta.get_field('path').max_length:
+            raise ValidationError({'parent': 'The category tree is too deep.'})
+
+        old_path, old_depth = getattr(self, '_saved_path', None), self.depth
+        if old_path is None and not self._state.adding:
+            old_path, old_depth = Category._base_manager.filter(pk=self.pk).values_list('path', 'depth').first() or (None, 0)
+        if old_path and path != old_path and path.startswith(old_path):
+            raise ValidationError({'parent': 'A category cannot be moved under one of its own subcategories.'})
+
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'path', 'depth'}
+        self.path, self.depth = path, depth
+        if old_path and old_path != path:
+            with transaction.atomic(using=kwargs.get('using')):
+                super().save(*args, **kwargs)
+                # Re-parented: move every descendant with one UPDATE.
+                Category._move_subtree(old_path, old_depth, path, depth)
+        else:
+            super().save(*args, **kwargs)
+        self._saved_path = path
+
+
+class ProductQuerySet(models.QuerySet):
+    """Keeps the product search index and the catalog cache in sync with bulk writes."""
+
+    def update(self, **kwargs):
+        invalidate(self.model)
+        if not SEARCH_FIELDS.intersection(kwargs) or not needs_indexing(self.model):
+            return super().update(**kwargs)
+        pks = list(self.values_list('pk', flat=True))
+        rows = super().update(**kwargs)
+        index_products(self.model, pks)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        invalidate(self.model)
+        index_products(self.model, [obj.pk for obj in objs])
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        invalidate(self.model)
+        if SEARCH_FIELDS.intersection(fields):
+            index_products(self.model, [obj.pk for obj in objs])
+        return rows
+
+
+class Product(ValidatedSaveMixin, models.Model):
+    product_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock_quantity = models.IntegerField(default=0)
-    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
+    # Indexed as the leading column of the composite indexes below.
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products', db_index=False)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Written by a database trigger (products/search.py); GIN-indexed on PostgreSQL.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Catalog pages: ordered by name (the keyset tiebreaker is the pk), optionally within a category.
+            models.Index(fields=['name', 'product_id'], name='product_name_idx'),
+            models.Index(fields=['category', 'name', 'product_id'], name='product_category_name_idx'),
+            # Browsing the active products of a category by price.
+            models.Index(fields=['category', 'price', 'product_id'], condition=models.Q(is_active=True),
+                         name='product_active_cat_price_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -126,29 +374,98 @@ class Product(models.Model):
             raise ValidationError({'stock_quantity': 'Stock quantity cannot be negative.'})
 
     def save(self, *args, **kwargs):
-        self.full_clean()
+        self.validate_for_save()
         super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or SEARCH_FIELDS.intersection(update_fields):
+            index_products(Product, [self.pk])
+
+
+class ImageAssetStatus(models.TextChoices):
+    PENDING = 'pending', 'Pending'
+    READY = 'ready', 'Ready'
+    FAILED = 'failed', 'Failed'
+
+
+class ImageAsset(models.Model):
+    """One uploaded image file, stored once per content hash, and its resized variants (see products/images.py)."""
+    asset_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sha256 = models.CharField(max_length=64, unique=True)
+    original = models.FileField(max_length=255)
+    content_type = models.CharField(max_length=50)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=ImageAssetStatus.choices, default=ImageAssetStatus.PENDING)
+    # {width: URL}, filled in by the variant workers
+    variants = models.JSONField(default=dict, blank=True)
+    error = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Image asset {self.sha256[:12]}'
 
 
 class ProductImage(models.Model):
-    image_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
+    image_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image_url = models.URLField(max_length=200, blank=True)
     alt_text = models.CharField(max_length=100, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Uploaded images: the shared file, and a copy of its variants so reads need no join.
+    asset = models.ForeignKey(ImageAsset, on_delete=models.PROTECT, null=True, blank=True, related_name='product_images')
+    variants = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'image_id'], name='productimage_created_idx'),
+        ]
 
     def __str__(self):
         return f'Image {self.image_id}'
 
 
-class Order(models.Model):
-    order_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders')
+# Sent whenever orders move from one status to another, either by Order.save()
+# or by a set-based UPDATE. Arguments: order_ids, previous, status.
+order_status_changed = Signal()
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def add_to_totals(self, deltas):
+        """Add {order_id: amount} to total_amount in one UPDATE, without reading any items."""
+        deltas = {order_id: delta for order_id, delta in deltas.items() if delta}
+        if not deltas:
+            return 0
+        amount = Case(
+            *[When(pk=order_id, then=Value(delta)) for order_id, delta in deltas.items()],
+            default=Value(Decimal('0')),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        )
+        return self.filter(pk__in=deltas).update(total_amount=F('total_amount') + amount)
+
+    def recompute_totals(self):
+        """Set total_amount to the sum of item subtotals, aggregated in the database."""
+        return self.update(total_amount=item_total_subquery())
+
+
+class Order(ValidatedSaveMixin, models.Model):
+    order_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders', db_index=False)
     status = models.CharField(max_length=20, choices=OrderStatus.choices, default=OrderStatus.PENDING)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # A customer's orders, oldest first; also serves every lookup by user.
+            models.Index(fields=['user', 'created_at', 'order_id'], name='order_user_created_idx'),
+        ]
+
     def __str__(self):
         return f'Order {self.order_id} by {self.user}'
 
@@ -156,31 +473,138 @@ class Order(models.Model):
         super().clean()
         if self.total_amount < 0:
             raise ValidationError({'total_amount': 'Total amount cannot be negative.'})
+        previous = getattr(self, '_saved_status', None)
+        if previous is not None and previous != self.status and self.status not in ORDER_TRANSITIONS.get(previous, ()):
+            raise ValidationError({'status': f'An order cannot go from {previous} to {self.status}.'})
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_status = instance.__dict__.get('status')
+        return instance
 
     def update_total_amount(self):
         """Recalculate total_amount from all related order items."""
-        total = sum(item.subtotal for item in self.items.all())
-        self.total_amount = total
-        super().save(update_fields=['total_amount'])
+        Order.objects.filter(pk=self.pk).recompute_totals()
+        self.refresh_from_db(fields=['total_amount'])
 
     def save(self, *args, **kwargs):
         """Save the order itself; total_amount will be updated by order items."""
-        self.full_clean()
-        super().save(*args, **kwargs)
+        self.validate_for_save()
+        previous = getattr(self, '_saved_status', None)
+        if previous is not None and previous != self.status:
+            with transaction.atomic(using=kwargs.get('using')):
+                super().save(*args, **kwargs)
+                order_status_changed.send(sender=Order, order_ids=[self.pk], previous=previous, status=self.status)
+        else:
+            super().save(*args, **kwargs)
+        self._saved_status = self.status
+
+
+def item_total_subquery(order_ref='pk'):
+    """SUM(subtotal) of an order's items as a correlated subquery (0 when it has none)."""
+    totals = (
+        OrderItem.objects.filter(order=OuterRef(order_ref)).order_by()
+        .values('order').annotate(total=Sum('subtotal')).values('total')
+    )
+    return Coalesce(
+        Subquery(totals), Value(Decimal('0')),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+class OrderItemQuerySet(models.QuerySet):
+    """
+    Keeps Order.total_amount in step with set-based writes.
+    Totals are adjusted in the database; item rows are never loaded to do it.
+    """
+    PRICE_FIELDS = frozenset({'quantity', 'unit_price', 'subtotal', 'order', 'order_id'})
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.subtotal = Decimal(obj.unit_price) * obj.quantity
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+            # We cannot tell which rows were inserted, so recount the affected orders.
+            Order.objects.filter(pk__in={obj.order_id for obj in objs}).recompute_totals()
+        else:
+            deltas = {}
+            for obj in objs:
+                deltas[obj.order_id] = deltas.get(obj.order_id, Decimal('0')) + obj.subtotal
+            Order.objects.add_to_totals(deltas)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if not self.PRICE_FIELDS.intersection(fields):
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        for obj in objs:
+            obj.subtotal = Decimal(obj.unit_price) * obj.quantity
+        fields = list({*fields, 'subtotal'})
+        with transaction.atomic(using=self.db):
+            order_ids = set(self.model._base_manager.filter(pk__in=[obj.pk for obj in objs]).values_list('order_id', flat=True))
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+            order_ids.update(obj.order_id for obj in objs)
+            Order.objects.filter(pk__in=order_ids).recompute_totals()
+        return rows
+
+    def update(self, **kwargs):
+        if not self.PRICE_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            affected = list(self.values_list('pk', 'order_id'))
+            rows = super().update(**kwargs)
+            item_ids = [pk for pk, _ in affected]
+            if 'subtotal' not in kwargs and {'quantity', 'unit_price'}.intersection(kwargs):
+                self.model._base_manager.filter(pk__in=item_ids).update(subtotal=F('unit_price') * F('quantity'))
+            order_ids = {order_id for _, order_id in affected}
+            order_ids.update(self.model._base_manager.filter(pk__in=item_ids).values_list('order_id', flat=True).distinct())
+            Order.objects.filter(pk__in=order_ids).recompute_totals()
+        return rows
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            removed = (
+                self.filter(order=OuterRef('pk')).order_by()
+                .values('order').annotate(total=Sum('subtotal')).values('total')
+            )
+            Order.objects.filter(pk__in=self.order_by().values('order')).update(
+                total_amount=F('total_amount') - Coalesce(
+                    Subquery(removed), Value(Decimal('0')),
+                    output_field=models.DecimalField(max_digits=10, decimal_places=2),
+                )
+            )
+            # The pre_delete handler ignores deletions that originate from this queryset.
+            return super().delete()
 
 
-class OrderItem(models.Model):
-    order_item_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
-    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
+class OrderItem(ValidatedSaveMixin, models.Model):
+    order_item_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items', db_index=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='order_items')
     quantity = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     subtotal = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = OrderItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order', 'created_at', 'order_item_id'], name='orderitem_order_created_idx'),
+        ]
+
     def __str__(self):
         return f'Order Item {self.order_item_id} for Order {self.order}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this row currently contributes to its order's total.
+        instance._saved_contribution = (instance.__dict__.get('order_id'), instance.__dict__.get('subtotal'))
+        return instance
+
     def clean(self):
         super().clean()
         if self.quantity < 1:
@@ -189,23 +613,109 @@ class OrderItem(models.Model):
             raise ValidationError({'unit_price': 'Unit price cannot be negative.'})
 
     def save(self, *args, **kwargs):
-        """Calculate subtotal and update parent order total automatically."""
+        """Calculate subtotal and apply the change to the parent order total automatically."""
         self.subtotal = Decimal(self.unit_price) * self.quantity
-        self.full_clean()
-        super().save(*args, **kwargs)
-        # Update parent order's total_amount
-        self.order.update_total_amount()
+        self.validate_for_save()
+        adding = self._state.adding
+        previous_order_id, previous_subtotal = getattr(self, '_saved_contribution', (None, None))
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if adding:
+                Order.objects.add_to_totals({self.order_id: self.subtotal})
+            elif previous_subtotal is None:
+                # Not loaded from the database, so we don't know the old amount.
+                Order.objects.filter(pk=self.order_id).recompute_totals()
+            elif previous_order_id == self.order_id:
+                Order.objects.add_to_totals({self.order_id: self.subtotal - previous_subtotal})
+            else:
+                Order.objects.add_to_totals({previous_order_id: -previous_subtotal, self.order_id: self.subtotal})
+        self._saved_contribution = (self.order_id, self.subtotal)
+
+
+class StockReservation(models.Model):
+    """Stock held for one order line until the order is paid, cancelled or the hold expires."""
+    reservation_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    order_item = models.ForeignKey(OrderItem, on_delete=models.SET_NULL, null=True, blank=True, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=ReservationStatus.choices, default=ReservationStatus.ACTIVE)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f'Reservation of {self.quantity} x {self.product_id} for Order {self.order_id}'
+
+
+class StockMovement(models.Model):
+    """One change to a product's stock outside checkout, kept for good (products/stock.py)."""
+    movement_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_movements', db_index=False)
+    quantity = models.IntegerField()  # negative for adjustments that remove stock
+    reason = models.CharField(max_length=20, choices=StockMovementReason.choices)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at'], name='stockmovement_product_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.reason} of {self.quantity} x {self.product_id}'
+
+
+class StockCounterShard(models.Model):
+    """
+    One of a product's STOCK_COUNTER_SHARDS counters: the movements added to it
+    that have not been folded into Product.stock_quantity yet.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards', db_index=False)
+    shard = models.PositiveSmallIntegerField()
+    delta = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='stock_shard_unique'),
+        ]
+        indexes = [
+            # The compaction job's scan for counters with something to fold.
+            models.Index(fields=['product'], condition=~models.Q(delta=0), name='stock_shard_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'Stock shard {self.shard} of {self.product_id}: {self.delta:+d}'
 
 
 class Payment(models.Model):
-    payment_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
-    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='payments')
+    payment_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='payments', db_index=False)
     payment_method = models.CharField(max_length=20, choices=PaymentMethod.choices)
     payment_status = models.CharField(max_length=20, choices=PaymentStatus.choices, default=PaymentStatus.PENDING)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     transaction_id = models.CharField(max_length=100, unique=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Settlement queue (products/settlement.py). A pending payment is due once
+    # next_attempt_at has passed; a claimed one has its lease_token set and
+    # next_attempt_at pushed to the end of the lease.
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    lease_token = models.CharField(max_length=32, blank=True, default='')
+    last_error = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order', 'created_at', 'payment_id'], name='payment_order_created_idx'),
+            models.Index(
+                fields=['next_attempt_at'], condition=models.Q(payment_status='pending'), name='payment_settle_queue_idx',
+            ),
+        ]
 
     def __str__(self):
         return f'Payment {self.payment_id} for Order {self.order.order_id}'
@@ -221,9 +731,9 @@ class Payment(models.Model):
         super().save(*args, **kwargs)
 
 
-class Address(models.Model):
-    address_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, db_index=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='addresses')
+class Address(ValidatedSaveMixin, models.Model):
+    address_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='addresses', db_index=False)
     street = models.CharField(max_length=100)
     city = models.CharField(max_length=100)
     state = models.CharField(max_length=100)
@@ -241,6 +751,9 @@ class Address(models.Model):
                 name='unique_default_address_per_user'
             )
         ]
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'address_id'], name='address_user_created_idx'),
+        ]
 
     def __str__(self):
         return f'{self.street}, {self.city}, {self.country}'
@@ -252,7 +765,34 @@ class Address(models.Model):
 
     def save(self, *args, **kwargs):
         if self.is_default:
-            Address.objects.filter(user=self.user, is_default=True).update(is_default=False)
-        self.full_clean()
+            Address.objects.filter(user_id=self.user_id, is_default=True).exclude(pk=self.pk).update(is_default=False)
+        self.validate_for_save()
         super().save(*args, **kwargs)
 
+
+
+class SalesRollup(models.Model):
+    """
+    Paid sales of one product on one day (the day the order was placed), kept up
+    to date by products/analytics.py as orders are paid or cancelled.
+    """
+    rollup_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales_rollups')
+    # Denormalized so revenue per category never has to touch the product table.
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='sales_rollups')
+    units_sold = models.IntegerField(default=0)
+    gross_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    order_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'], name='sales_rollup_day_product_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'category'], name='sales_rollup_day_category_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.day}: {self.units_sold} x {self.product_id}'
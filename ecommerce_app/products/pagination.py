@@ -0,0 +1,348 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db.models import F, OrderBy, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.settings import api_settings
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .models import UserRole
+
+
+class AdminPageNumberPagination(PageNumberPagination):
+    """
+    Classic page-number pagination (with a total count).
+    Only used for admin screens that explicitly ask for it with ?page=.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class KeysetTerm:
+    """One column of a keyset ordering, e.g. '-created_at'."""
+
+    def __init__(self, name, descending, field=None):
+        self.name = name
+        self.descending = descending
+        # Model field backing the term, or None for queryset annotations.
+        self.field = field
+
+    @property
+    def nullable(self):
+        return self.field is not None and self.field.null
+
+    @property
+    def lookup(self):
+        return self.field.attname if self.field is not None else self.name
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        if not self.nullable:
+            return f'-{self.lookup}' if descending else self.lookup
+        # NULLs always sort after every value when walking forwards, so that
+        # the keyset predicate below behaves the same on every database.
+        nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        return F(self.lookup).desc(**nulls) if descending else F(self.lookup).asc(**nulls)
+
+    def value_of(self, item):
+        if isinstance(item, dict):
+            return item.get(self.lookup, item.get(self.name))
+        return getattr(item, self.lookup)
+
+    def encode(self, value):
+        if value is None or self.field is None:
+            return value
+        return str(value.isoformat() if hasattr(value, 'isoformat') else value)
+
+    def decode(self, value):
+        if value is None or self.field is None:
+            return value
+        field = self.field.target_field if self.field.is_relation else self.field
+        return field.to_python(value)
+
+    def after(self, value, reverse=False):
+        """Q matching rows strictly after `value` on this column."""
+        descending = self.descending != reverse
+        if value is None:
+            # NULLs are last going forwards and first going backwards.
+            return Q(**{f'{self.lookup}__isnull': False}) if reverse else Q(pk__in=[])
+        q = Q(**{f'{self.lookup}__{"lt" if descending else "gt"}': value})
+        if self.nullable and not reverse:
+            q |= Q(**{f'{self.lookup}__isnull': True})
+        return q
+
+    def equal(self, value):
+        if value is None:
+            return Q(**{f'{self.lookup}__isnull': True})
+        return Q(**{self.lookup: value})
+
+    def __str__(self):
+        return f'-{self.name}' if self.descending else self.name
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque-cursor pagination keyed on the queryset ordering plus the primary key.
+
+    Each page is fetched with a `WHERE (ordering columns) > (last row)` predicate
+    and a `LIMIT page_size + 1`, so the cost of a page does not depend on how deep
+    it is and no COUNT(*) is issued. The ordering is whatever the view produced
+    (OrderingFilter, `ordering`, or the queryset's own `order_by`), with the UUID
+    primary key appended as a tie-breaker.
+
+    Every ordering term must be a column of the model itself or a queryset
+    annotation, not a related lookup (`category__name`) or another expression;
+    `check_keyset_orderings` reports views that break this at startup. A cursor
+    records the ordering it was made for, and is refused (404, like any invalid
+    cursor) when ?ordering= has changed since.
+
+    Admins can still ask for classic page numbers with ?page=N.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    page_number_class = AdminPageNumberPagination
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.fallback = None
+        if self.use_page_numbers(request):
+            self.fallback = self.page_number_class()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        queryset, self.reverse = self.prepare_queryset(queryset, request, view)
+        results = list(queryset[:self.page_size + 1])
+        return self.finish_page(results)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset() for async views; the page is read with aiterator()."""
+        self.request = request
+        self.fallback = None
+        if self.use_page_numbers(request):
+            self.fallback = self.page_number_class()
+            # Django's Paginator (a COUNT, then the page) only runs synchronously.
+            return await sync_to_async(self.fallback.paginate_queryset)(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        queryset, self.reverse = self.prepare_queryset(queryset, request, view)
+        limit = self.page_size + 1
+        results = [row async for row in queryset[:limit].aiterator(chunk_size=limit)]
+        return self.finish_page(results)
+
+    def prepare_queryset(self, queryset, request, view=None):
+        """Apply the keyset ordering and cursor predicate to `queryset`."""
+        self.base_url = request.build_absolute_uri()
+        self.terms = self.get_terms(queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.get('r'))
+
+        queryset = queryset.order_by(*[term.order_by(reverse) for term in self.terms])
+        if self.cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(self.cursor['v'], reverse))
+        return queryset, reverse
+
+    def finish_page(self, results):
+        """Trim the look-ahead row and work out the next/previous links."""
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        self.page = results
+        return results
+
+    def use_page_numbers(self, request):
+        user = getattr(request, 'user', None)
+        return (
+            self.page_number_class is not None
+            and self.page_number_class.page_query_param in request.query_params
+            and getattr(user, 'role', None) == UserRole.ADMIN
+        )
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                size = int(request.query_params[self.page_size_query_param])
+                if size > 0:
+                    return min(size, self.max_page_size) if self.max_page_size else size
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_terms(self, queryset, view=None):
+        ordering = list(queryset.query.order_by)
+        if not ordering and view is not None and getattr(view, 'ordering', None):
+            ordering = list(view.ordering)
+
+        terms = [self.build_term(queryset, item) for item in ordering]
+        pk = queryset.model._meta.pk
+        if not any(term.field is pk for term in terms):
+            descending = terms[-1].descending if terms else False
+            terms.append(KeysetTerm(pk.name, descending, pk))
+        return terms
+
+    def build_term(self, queryset, item):
+        if isinstance(item, OrderBy) and isinstance(item.expression, F):
+            name, descending = item.expression.name, item.descending
+        elif isinstance(item, str):
+            name, descending = item.lstrip('-'), item.startswith('-')
+        else:
+            raise ImproperlyConfigured(f'Cannot paginate by ordering expression {item!r}.')
+
+        opts = queryset.model._meta
+        if name == 'pk':
+            return KeysetTerm(opts.pk.name, descending, opts.pk)
+        if name in queryset.query.annotations:
+            return KeysetTerm(name, descending)
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured(f'Cannot paginate by ordering {name!r}.')
+        if not field.concrete or field.many_to_many:
+            raise ImproperlyConfigured(f'Cannot paginate by ordering {name!r}.')
+        return KeysetTerm(name, descending, field)
+
+    def ordering_key(self):
+        return ','.join(map(str, self.terms))
+
+    def keyset_filter(self, values, reverse):
+        if len(values) != len(self.terms) or self.cursor.get('o') != self.ordering_key():
+            raise NotFound(self.invalid_cursor_message)
+        if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            values = [term.decode(value) for term, value in zip(self.terms, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+        # (a, b, c) > (x, y, z)  <=>  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q(pk__in=[])
+        prefix = Q()
+        for term, value in zip(self.terms, values):
+            condition |= prefix & term.after(value, reverse)
+            prefix &= term.equal(value)
+        return condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(cursor, dict) or not isinstance(cursor.get('v'), list):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, item, reverse):
+        cursor = {'v': [term.encode(term.value_of(item)) for term in self.terms], 'o': self.ordering_key()}
+        if reverse:
+            cursor['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode('ascii').rstrip('='))
+
+    def get_next_link(self):
+        if self.fallback is not None:
+            return self.fallback.get_next_link()
+        if not self.has_next:
+            return None
+        if not self.page:
+            # Walked backwards past the first row; restart from the beginning.
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if self.fallback is not None:
+            return self.fallback.get_previous_link()
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+@checks.register(checks.Tags.compatibility)
+def check_keyset_orderings(app_configs=None, **kwargs):
+    """Every ordering a keyset-paginated API view can be asked for must be a plain column."""
+    from .urls import router
+
+    errors = []
+    for prefix, viewset, basename in router.registry:
+        pagination_class = getattr(viewset, 'pagination_class', None)
+        queryset = getattr(viewset, 'queryset', None)
+        if queryset is None or pagination_class is None or not issubclass(pagination_class, KeysetPagination):
+            continue
+        orderings = list(queryset.query.order_by) + list(getattr(viewset, 'ordering', None) or [])
+        ordering_fields = getattr(viewset, 'ordering_fields', None)
+        if isinstance(ordering_fields, (list, tuple)):
+            orderings += list(ordering_fields)
+        for item in orderings:
+            try:
+                pagination_class().build_term(queryset, item)
+            except ImproperlyConfigured as exc:
+                errors.append(checks.Error(
+                    f'{viewset.__name__} is paginated by keyset but may be ordered by {item!r}: {exc}',
+                    hint='Order keyset-paginated views by columns of the model itself or by annotations.',
+                    obj=viewset, id='products.E001',
+                ))
+    return errors
@@ -11,4 +11,12 @@ class IsAdminOrReadOnly(BasePermission):
         if request.method in SAFE_METHODS:
             return request.user and request.user.is_authenticated
         # For other methods, user must be admin
-        return request.user.is_authenticated and request.user.role == 'admin'
\ No newline at end of file
+        return request.user.is_authenticated and request.user.role == 'admin'
+
+class IsAdminRole(BasePermission):
+    """
+    Only authenticated users with the admin role, for every method.
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated and request.user.role == 'admin')
@@ -0,0 +1,193 @@
+"""
+Stock reservations for order lines.
+
+Stock is taken with one conditional UPDATE per order (`stock_quantity >= n` for
+every product), never by reading the rows and writing them back, so concurrent
+checkouts on the same product cannot oversell and do not need an
+application-level lock. The products are locked in primary key order first
+(`SELECT ... FOR UPDATE`): an UPDATE over `pk IN (...)` locks its rows in
+whatever order the plan visits them, and two orders sharing products could
+deadlock. Every reservation is then in one of these states:
+
+    active    stock is held for a pending order
+    consumed  the order was paid; the stock is gone for good
+    released  the order (or line) was cancelled; the stock was put back
+    expired   the order was not paid in time; the stock was put back
+
+State changes are also conditional UPDATEs (`WHERE status = 'active'`), so a
+reservation is released at most once even if two workers race on it. Released
+stock goes back through the stock ledger and its sharded counters
+(products/stock.py) rather than the product row.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from .models import (
+    Order, OrderStatus, Product, ReservationStatus, StockMovementReason, StockReservation, order_status_changed,
+)
+from .stock import compact_stock, record_movements
+
+DEFAULT_TTL = timedelta(minutes=15)
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, requested):
+        self.product_id = product_id
+        self.requested = requested
+        super().__init__(f'Not enough stock for product {product_id} (requested {requested}).')
+
+
+def reservation_ttl():
+    return getattr(settings, 'STOCK_RESERVATION_TTL', DEFAULT_TTL)
+
+
+class _PartialUpdate(Exception):
+    """Rolls back the savepoint of a take_stock() that could not take everything."""
+
+
+def take_stock(quantities):
+    """
+    Atomically decrement {product_id: quantity} in a single conditional UPDATE.
+    Either every product had enough stock and all of them are decremented, or
+    nothing changes and InsufficientStock names a product that ran out. Stock
+    still on the products' counter shards is folded in before giving up.
+    """
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity}
+    if not quantities:
+        return
+    try:
+        _take_stock(quantities)
+    except InsufficientStock:
+        if not compact_stock(list(quantities)):
+            raise
+        _take_stock(quantities)
+
+
+def _take_stock(quantities):
+    wanted = Case(
+        *[When(pk=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        output_field=models.IntegerField(),
+    )
+    try:
+        with transaction.atomic():
+            list(Product.objects.filter(pk__in=quantities).select_for_update().order_by('pk').values_list('pk'))
+            updated = Product.objects.filter(pk__in=quantities, stock_quantity__gte=wanted).update(
+                stock_quantity=F('stock_quantity') - wanted,
+            )
+            if updated != len(quantities):
+                raise _PartialUpdate
+    except _PartialUpdate:
+        stock = dict(Product.objects.filter(pk__in=quantities).values_list('pk', 'stock_quantity'))
+        short = next(
+            (product_id for product_id in sorted(quantities, key=str) if stock.get(product_id, 0) < quantities[product_id]),
+            next(iter(quantities)),
+        )
+        raise InsufficientStock(short, quantities[short])
+
+
+def return_stock(quantities, reason=StockMovementReason.RELEASE):
+    """Put {product_id: quantity} back on the shelf."""
+    record_movements(quantities, reason)
+
+
+def reserve_items(order, items, ttl=None):
+    """
+    Reserve stock for order items. Raises InsufficientStock (and the caller's
+    transaction should roll back) if any product runs out.
+    """
+    items = [item for item in items if item.quantity]
+    expires_at = timezone.now() + (ttl or reservation_ttl())
+    quantities = defaultdict(int)
+    for item in items:
+        quantities[item.product_id] += item.quantity
+    with transaction.atomic():
+        take_stock(quantities)
+        return StockReservation.objects.bulk_create([
+            StockReservation(
+                order_id=order.pk, order_item_id=None if item._state.adding else item.pk,
+                product_id=item.product_id, quantity=item.quantity, expires_at=expires_at,
+            )
+            for item in items
+        ])
+
+
+def release_reservations(reservations, status=ReservationStatus.RELEASED):
+    """
+    Return the stock of every active reservation in the queryset and mark it `status`.
+    Returns the number of reservations released.
+    """
+    candidates = list(
+        reservations.filter(status=ReservationStatus.ACTIVE)
+        .values_list('pk', 'product_id', 'quantity')
+    )
+    quantities = defaultdict(int)
+    released = 0
+    with transaction.atomic():
+        for pk, product_id, quantity in candidates:
+            # Only the caller that flips the row from active gets to return the stock.
+            claimed = StockReservation.objects.filter(pk=pk, status=ReservationStatus.ACTIVE).update(
+                status=status, updated_at=timezone.now(),
+            )
+            if claimed:
+                quantities[product_id] += quantity
+                released += 1
+        return_stock(quantities)
+    return released
+
+
+def consume_reservations(order_ids):
+    """The orders were paid: their held stock is now sold."""
+    return StockReservation.objects.filter(
+        order_id__in=order_ids, status=ReservationStatus.ACTIVE,
+    ).update(status=ReservationStatus.CONSUMED, updated_at=timezone.now())
+
+
+def replace_item_reservation(item):
+    """Re-reserve a line whose product or quantity changed."""
+    with transaction.atomic():
+        release_reservations(StockReservation.objects.filter(order_item=item))
+        return reserve_items(item.order, [item])
+
+
+def expire_reservations(now=None, batch_size=500):
+    """
+    Sweep active reservations whose hold has run out.
+
+    Pending orders are cancelled (which releases their stock); a conditional
+    UPDATE makes sure an order that was paid in the meantime is left alone.
+    Reservations of orders that already moved on are consumed or released to
+    match the order. Returns (orders cancelled, reservations settled).
+    """
+    now = now or timezone.now()
+    cancelled = settled = 0
+    while True:
+        order_ids = list(
+            StockReservation.objects.filter(status=ReservationStatus.ACTIVE, expires_at__lte=now)
+            .order_by().values_list('order_id', flat=True).distinct()[:batch_size]
+        )
+        if not order_ids:
+            return cancelled, settled
+        for order_id in order_ids:
+            with transaction.atomic():
+                if Order.objects.filter(pk=order_id, status=OrderStatus.PENDING).update(
+                    status=OrderStatus.CANCELLED, updated_at=now,
+                ):
+                    cancelled += 1
+                    settled += release_reservations(
+                        StockReservation.objects.filter(order_id=order_id), status=ReservationStatus.EXPIRED,
+                    )
+                    order_status_changed.send(
+                        sender=Order, order_ids=[order_id], previous=OrderStatus.PENDING, status=OrderStatus.CANCELLED,
+                    )
+                    continue
+                status = Order.objects.filter(pk=order_id).values_list('status', flat=True).first()
+                expired = StockReservation.objects.filter(order_id=order_id, expires_at__lte=now)
+                if status in (OrderStatus.PAID, OrderStatus.SHIPPED, OrderStatus.DELIVERED):
+                    settled += consume_reservations([order_id])
+                else:
+                    settled += release_reservations(expired, status=ReservationStatus.EXPIRED)
@@ -0,0 +1,194 @@
+"""
+Read replicas with read-your-writes stickiness.
+
+`ReplicaRouter` sends every write to `default`, the primary. Reads go to the
+primary as well, except while `ReplicaRoutingMiddleware` is serving a GET,
+HEAD or OPTIONS request to one of the API views in `products/views.py`: those
+read from one of the `DATABASE_REPLICAS`, picked at random once per request.
+
+Replicas lag behind the primary, so a client that has just written must not
+read from them for a while. When a request writes anything, the middleware
+pins the writer to the primary for `REPLICA_STICKY_SECONDS`: an authenticated
+user through a cache entry keyed by their user id (set CACHE_BACKEND to a
+shared cache when running several workers), an anonymous client through a
+cookie. A request that writes reads from the primary for the rest of the
+request too.
+
+A request counts as writing once anything asks the router for the write
+database, which Django does for every INSERT, UPDATE, DELETE and SELECT ... FOR
+UPDATE. Code that only needs to know the backend reads it from the `default`
+connection instead, so that it does not pin the reader.
+
+The catalog cache (`products/cache.py`) asks `read_from_replica` before it
+stores a response, so that a replica that has not caught up with a write yet
+cannot store its body under the generation that write started.
+
+The pin is looked up from the user id claim of the request's access token
+before the token has been verified, because authentication itself already
+reads the database. A forged token can only move its own reads to the
+primary; the view still authenticates the request as usual.
+"""
+import contextvars
+import random
+import time
+
+import jwt
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'primary_reads_until'
+ROUTED_VIEW_MODULE = 'products.views'
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+
+
+def pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def token_user_id(request):
+    """The user id claim of the request's access token, unverified; None without a readable token."""
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = header and authentication.get_raw_token(header)
+    if not raw_token:
+        return None
+    try:
+        payload = jwt.decode(raw_token, options={'verify_signature': False})
+    except jwt.PyJWTError:
+        return None
+    return payload.get(api_settings.USER_ID_CLAIM)
+
+
+class ReadRouting:
+    """Where the reads of one request go."""
+
+    def __init__(self, request):
+        self.request = request
+        self.wrote = False
+        self.alias = None
+        self.replica = False
+
+    def read_alias(self):
+        if self.wrote:
+            return DEFAULT_DB_ALIAS
+        if self.alias is None:
+            match = getattr(self.request, 'resolver_match', None)
+            if match is None:
+                return DEFAULT_DB_ALIAS  # not resolved yet, decide on a later read
+            replicas = replica_aliases()
+            use_replica = replicas and self.routed(match.func) and not self.pinned()
+            self.alias = random.choice(replicas) if use_replica else DEFAULT_DB_ALIAS
+            self.replica = bool(use_replica)
+        return self.alias
+
+    def routed(self, view_func):
+        view_class = getattr(view_func, 'cls', None)
+        return self.request.method in SAFE_METHODS and view_class is not None \
+            and view_class.__module__ == ROUTED_VIEW_MODULE
+
+    def pinned(self):
+        try:
+            if float(self.request.COOKIES.get(PIN_COOKIE, 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        user_id = token_user_id(self.request)
+        return user_id is not None and cache.get(pin_key(user_id)) is not None
+
+    def pin(self, response):
+        """Keep the client that made this request on the primary for the sticky window."""
+        seconds = sticky_seconds()
+        if seconds <= 0:
+            return
+        user = getattr(self.request, 'user', None)  # DRF sets it once the view has authenticated
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            user = None  # the session user nobody asked for; loading it now would query the database
+        if user is not None and user.is_authenticated:
+            cache.set(pin_key(getattr(user, api_settings.USER_ID_FIELD)), True, seconds)
+        else:
+            response.set_cookie(PIN_COOKIE, f'{time.time() + seconds:.0f}', max_age=seconds,
+                                secure=self.request.is_secure(), httponly=True, samesite='Lax')
+
+
+_routing = contextvars.ContextVar('products_read_routing', default=None)
+
+
+def read_from_replica():
+    """Whether reads of the current request have gone to a replica."""
+    routing = _routing.get()
+    return routing is not None and routing.replica
+
+
+class ReplicaRouter:
+    """Writes go to the primary; reads too, unless ReplicaRoutingMiddleware says otherwise."""
+
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        return DEFAULT_DB_ALIAS if routing is None else routing.read_alias()
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.wrote = True
+        # Explicitly: left to Django, a row read from a replica would be saved back to it.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Route the reads of safe API requests to a replica; put it right after
+    MetricsMiddleware. Like it, it runs natively under WSGI and ASGI, and the
+    routing decision follows the request into sync_to_async threads.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        routing = ReadRouting(request)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if routing.wrote:
+            routing.pin(response)
+        return response
+
+    async def __acall__(self, request):
+        routing = ReadRouting(request)
+        token = _routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if routing.wrote:
+            routing.pin(response)
+        return response
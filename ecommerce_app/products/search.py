@@ -0,0 +1,238 @@
+"""
+Full-text search for products.
+
+On PostgreSQL each product carries a weighted `tsvector` (name = A, description = B)
+in `Product.search_vector`, backed by a GIN index, and queries are ranked with
+`ts_rank`. A trigger (migration 0012) computes the vector in the same INSERT or
+UPDATE that writes the name or description, so saves and bulk writes need no
+second statement.
+
+Other databases (SQLite test runs) fall back to an in-process inverted index
+with the same behaviour: every query word must match, each word also matches as
+a prefix, and results are ordered by relevance. That index is kept in sync by
+`Product.save()`, the bulk methods of `ProductQuerySet` and the product delete
+signal. It hands the database the ids of the `SEARCH_FALLBACK_RESULT_LIMIT`
+best matches only; when a query matches more, the response says so in an
+`X-Search-Truncated` header carrying the limit.
+"""
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Case, F, FloatField, Value, When
+from rest_framework.filters import BaseFilterBackend
+
+SEARCH_CONFIG = 'english'
+SEARCH_FIELDS = frozenset({'name', 'description'})
+FIELD_WEIGHTS = {'name': 1.0, 'description': 0.4}  # mirrors ts_rank's A/B weights
+FALLBACK_RESULT_LIMIT = 1000
+RANK_ANNOTATION = 'search_rank'
+TRUNCATED_HEADER = 'X-Search-Truncated'
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def uses_postgres(model):
+    # Replicas run the same backend as the primary. Asking the router for the
+    # write database would count as a write and pin the reader to the primary.
+    return connections[DEFAULT_DB_ALIAS].vendor == 'postgresql'
+
+
+def fallback_result_limit():
+    return getattr(settings, 'SEARCH_FALLBACK_RESULT_LIMIT', FALLBACK_RESULT_LIMIT)
+
+
+class InvertedIndex:
+    """Token -> {product pk: weight} postings with a sorted vocabulary for prefix lookups."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.vocabulary = []
+        self.built = False
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.documents.clear()
+            self.vocabulary.clear()
+            self.built = False
+
+    def add(self, pk, name, description):
+        weights = defaultdict(float)
+        for field, text in (('name', name), ('description', description)):
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        with self.lock:
+            self._remove(pk)
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    self.vocabulary.insert(bisect_left(self.vocabulary, token), token)
+                self.postings[token][pk] = weight
+            self.documents[pk] = frozenset(weights)
+
+    def remove(self, pk):
+        with self.lock:
+            self._remove(pk)
+
+    def _remove(self, pk):
+        for token in self.documents.pop(pk, ()):
+            docs = self.postings[token]
+            docs.pop(pk, None)
+            if not docs:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def expand(self, term, prefix):
+        if not prefix:
+            return [term] if term in self.postings else []
+        start = bisect_left(self.vocabulary, term)
+        matches = []
+        for token in self.vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            matches.append(token)
+        return matches
+
+    def search(self, terms, prefix=True, limit=FALLBACK_RESULT_LIMIT):
+        """Return [(pk, score)] for documents matching every term, best first."""
+        with self.lock:
+            total = len(self.documents) or 1
+            scores = None
+            for term in terms:
+                term_scores = defaultdict(float)
+                for token in self.expand(term, prefix):
+                    docs = self.postings[token]
+                    idf = math.log(1 + total / len(docs))
+                    for pk, weight in docs.items():
+                        term_scores[pk] = max(term_scores[pk], weight * idf)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pk: score + term_scores[pk] for pk, score in scores.items() if pk in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted((scores or {}).items(), key=lambda item: (-item[1], str(item[0])))
+        return ranked[:limit]
+
+
+_fallback_index = InvertedIndex()
+
+
+def get_fallback_index(model):
+    """Return the in-process index, loading it from the database on first use."""
+    if not _fallback_index.built:
+        with _fallback_index.lock:
+            if not _fallback_index.built:
+                rows = model._base_manager.values_list('pk', 'name', 'description')
+                for pk, name, description in rows.iterator(chunk_size=2000):
+                    _fallback_index.add(pk, name, description)
+                _fallback_index.built = True
+    return _fallback_index
+
+
+def reset_fallback_index():
+    _fallback_index.clear()
+
+
+def needs_indexing(model):
+    """Whether writes have to call index_products(); PostgreSQL's trigger does it itself."""
+    return not uses_postgres(model) and _fallback_index.built
+
+
+def index_products(model, pks):
+    """Refresh the fallback index entries of the given products."""
+    pks = list(pks)
+    if pks and needs_indexing(model):
+        rows = model._base_manager.filter(pk__in=pks).values_list('pk', 'name', 'description')
+        found = set()
+        for pk, name, description in rows:
+            _fallback_index.add(pk, name, description)
+            found.add(pk)
+        for pk in set(pks) - found:
+            _fallback_index.remove(pk)
+
+
+def unindex_products(model, pks):
+    if needs_indexing(model):
+        for pk in pks:
+            _fallback_index.remove(pk)
+
+
+def search_products(queryset, text):
+    """
+    Restrict `queryset` to products matching `text` and annotate `search_rank`.
+    The caller decides whether to order by the rank. Returns (queryset,
+    truncated): `truncated` is true when the fallback index dropped matches
+    beyond `fallback_result_limit()`.
+    """
+    terms = tokenize(text)
+    if not terms:
+        return queryset.none().annotate(**{RANK_ANNOTATION: Value(0.0, output_field=FloatField())}), False
+
+    if uses_postgres(queryset.model):
+        # Only word characters reach to_tsquery, so the raw syntax is safe.
+        query = SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG)
+        return queryset.filter(search_vector=query).annotate(
+            **{RANK_ANNOTATION: SearchRank(F('search_vector'), query)}
+        ), False
+
+    limit = fallback_result_limit()
+    results = get_fallback_index(queryset.model).search(terms, limit=limit + 1)
+    truncated = len(results) > limit
+    results = results[:limit]
+    if not results:
+        return queryset.none().annotate(**{RANK_ANNOTATION: Value(0.0, output_field=FloatField())}), False
+    return queryset.filter(pk__in=[pk for pk, _ in results]).annotate(**{
+        RANK_ANNOTATION: Case(
+            *[When(pk=pk, then=Value(score)) for pk, score in results],
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    }), truncated
+
+
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    Ranked full-text search with ?q=.
+    Results are ordered by relevance unless the client also passes ?ordering=.
+    Must come after OrderingFilter in `filter_backends`. When the fallback index
+    cut the matches short, `request.search_truncated` holds the limit.
+    """
+    search_param = 'q'
+    ordering_param = 'ordering'
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, '').strip()
+        if not text:
+            return queryset
+        queryset, truncated = search_products(queryset, text)
+        if truncated:
+            request.search_truncated = fallback_result_limit()
+        if not request.query_params.get(self.ordering_param):
+            queryset = queryset.order_by(f'-{RANK_ANNOTATION}')
+        return queryset
+
+    def queries_database(self, request, queryset, view):
+        """Whether filter_queryset() runs a query itself: only to load the fallback index the first time."""
+        text = request.query_params.get(self.search_param, '').strip()
+        return bool(text) and not uses_postgres(queryset.model) and not _fallback_index.built
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Full-text search over name and description, ranked by relevance.',
+            'schema': {'type': 'string'},
+        }]
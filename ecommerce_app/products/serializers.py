@@ -1,7 +1,71 @@
+from decimal import Decimal
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError as DjangoValidationError
+from django.db import transaction
 from rest_framework import serializers
-from .models import User, Category, Product, ProductImage, Order, OrderItem, Payment, Address, UserRole
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .exports import FORMATS
+from .hashing import make_password
+from .images import copy_variants, store_upload
+from .imports import FORMATS as IMPORT_FORMATS
+from .metrics import TimedSerializerMixin
+from .mixins import ExpandableFieldsMixin
+from .models import (
+    User, Category, Product, ProductImage, Order, OrderItem, Payment, Address, UserRole, ImageAssetStatus,
+    OrderStatus, order_status_sources, StockMovementReason,
+)
+from .reservations import InsufficientStock, replace_item_reservation, reserve_items
 
-class UserSerializer(serializers.ModelSerializer):
+class DatabaseUniquenessMixin:
+    """
+    Leave uniqueness to the database instead of running a SELECT per unique field
+    before every write. The model reports a violation as a ValidationError on
+    save() (see ValidatedSaveMixin), which is returned worded as DRF's
+    UniqueValidator would have; other model validation errors become a 400 too.
+    """
+
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super().build_standard_field(field_name, model_field)
+        if 'validators' in field_kwargs:
+            field_kwargs['validators'] = [
+                validator for validator in field_kwargs['validators'] if not isinstance(validator, UniqueValidator)
+            ]
+        return field_class, field_kwargs
+
+    def get_unique_together_validators(self):
+        return []
+
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(self.model_error_detail(exc))
+
+    def model_error_detail(self, exc):
+        opts = self.Meta.model._meta
+        detail = {}
+        for key, errors in exc.update_error_dict({}).items():
+            key = api_settings.NON_FIELD_ERRORS_KEY if key == NON_FIELD_ERRORS else key
+            detail[key] = [
+                serializers.ErrorDetail(self.model_error_message(opts, error), code=error.code or 'invalid')
+                for error in errors
+            ]
+        return detail
+
+    @staticmethod
+    def model_error_message(opts, error):
+        unique_check = (error.params or {}).get('unique_check')
+        if error.code == 'unique' and unique_check:
+            if len(unique_check) == 1:
+                # UniqueValidator words it with the verbose names as they are, not capitalised.
+                return error.message % dict(
+                    error.params, model_name=opts.verbose_name, field_label=opts.get_field(unique_check[0]).verbose_name,
+                )
+            return f'The fields {", ".join(unique_check)} must make a unique set.'
+        return next(iter(error))
+
+class UserSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True)
     role = serializers.ChoiceField(choices=UserRole.choices, required=False, default=UserRole.CUSTOMER)
     
@@ -12,24 +76,40 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['user_id', 'created_at', 'updated_at']
         
     def create(self, validated_data):
+        # The async registration view hashes before saving and passes the result as `password_hash`.
+        encoded = validated_data.pop('password_hash', None)
         password = validated_data.pop('password')
         user = User(**validated_data)
-        user.set_password(password)
-        user.full_clean()  # runs model.clean()
-        user.save()
+        user.password = encoded or make_password(password)
+        user.save()  # validates, including model.clean()
         return user
 
     def update(self, instance, validated_data):
+        encoded = validated_data.pop('password_hash', None)
         password = validated_data.pop('password', None)
         for attr, val in validated_data.items():
             setattr(instance, attr, val)
-        if password:
-            instance.set_password(password)
-        instance.full_clean()
+        if encoded or password:
+            instance.password = encoded or make_password(password)
         instance.save()
         return instance
 
-class CategorySerializer(serializers.ModelSerializer):
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Signs the user's role and active flag into the token (see products/authentication.py)."""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['role'] = user.role
+        token['is_active'] = user.is_active
+        return token
+
+class LoginSerializer(serializers.Serializer):
+    """The credentials TokenObtainPairView accepts; checking them is left to the login view."""
+    email = serializers.CharField(write_only=True)
+    password = serializers.CharField(write_only=True, trim_whitespace=False, style={'input_type': 'password'})
+
+class CategorySerializer(TimedSerializerMixin, DatabaseUniquenessMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['category_id', 'name', 'description', 'parent', 'created_at']
@@ -40,33 +120,156 @@ class CategorySerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("A category cannot be its own parent.")
         return value
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, ExpandableFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'category': ('CategorySerializer', {}),
+        'images': ('ProductImageSerializer', {'many': True}),
+    }
+
     class Meta:
         model = Product
         fields = ['product_id', 'name', 'description', 'price', 'stock_quantity', 'category',
                   'is_active', 'created_at', 'updated_at']
         read_only_fields = ['product_id', 'created_at', 'updated_at']
         
-class ProductImageSerializer(serializers.ModelSerializer): 
+class ProductImageSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, serializers.ModelSerializer): 
+    """
+    Either link an image by `image_url` or upload the file as `image`
+    (multipart). An upload is stored once per content hash and `image_url`
+    points at the stored original; `variants` ({width: URL}) fills in once the
+    resized copies have been made (see products/images.py).
+    """
+    image = serializers.FileField(write_only=True, required=False)
+
     class Meta:
         model = ProductImage
-        fields = ['image_id', 'product', 'image_url', 'alt_text', 'created_at']
-        read_only_fields = ['image_id', 'created_at']
+        fields = ['image_id', 'product', 'image_url', 'image', 'variants', 'alt_text', 'created_at']
+        read_only_fields = ['image_id', 'variants', 'created_at']
+
+    def validate_image(self, upload):
+        try:
+            asset, _ = store_upload(upload)
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(exc.messages)
+        return asset
+
+    def use_asset(self, validated_data):
+        asset = validated_data.pop('image', None)
+        if asset is None:
+            return None
+        request = self.context.get('request')
+        url = asset.original.url
+        validated_data.update(
+            asset=asset, variants=asset.variants,
+            image_url=request.build_absolute_uri(url) if request is not None else url,
+        )
+        return asset
+
+    def catch_up(self, instance, asset):
+        if asset is not None and asset.status != ImageAssetStatus.READY:
+            transaction.on_commit(lambda: copy_variants([instance.pk]))
+        return instance
+
+    def create(self, validated_data):
+        asset = self.use_asset(validated_data)
+        return self.catch_up(super().create(validated_data), asset)
+
+    def update(self, instance, validated_data):
+        asset = self.use_asset(validated_data)
+        if asset is None and validated_data.get('image_url', instance.image_url) != instance.image_url:
+            validated_data.update(asset=None, variants={})  # linked elsewhere now; the old variants are stale
+        return self.catch_up(super().update(instance, validated_data), asset)
         
-class OrderSerializer(serializers.ModelSerializer):
+class OrderLineSerializer(serializers.Serializer):
+    """One line of a nested order; unit_price defaults to the product's current price."""
+    product = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1)
+    unit_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0'), required=False)
+
+class OrderSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, ExpandableFieldsMixin, serializers.ModelSerializer):
+    items = OrderLineSerializer(many=True, write_only=True, required=False)
+    expandable_fields = {
+        'items': ('OrderItemSerializer', {'many': True}),
+        'payments': ('PaymentSerializer', {'many': True}),
+    }
+
     class Meta:
         model = Order
-        fields = ['order_id', 'user', 'status', 'total_amount', 'created_at', 'updated_at']
+        fields = ['order_id', 'user', 'status', 'total_amount', 'items', 'created_at', 'updated_at']
         read_only_fields = ['order_id', 'total_amount', 'created_at', 'updated_at']
+
+    def validate_status(self, value):
+        # Changes of status are checked by Order.clean() against ORDER_TRANSITIONS.
+        if self.instance is None and value != OrderStatus.PENDING:
+            raise serializers.ValidationError('New orders are pending.')
+        return value
+
+    def validate_items(self, items):
+        if self.instance is not None:
+            raise serializers.ValidationError("Items can only be supplied when the order is created.")
+        # Resolve every product with a single query instead of one per line.
+        product_ids = {item['product'] for item in items}
+        products = Product.objects.in_bulk(product_ids)
+        missing = sorted(str(pk) for pk in product_ids - products.keys())
+        if missing:
+            raise serializers.ValidationError(
+                [f'Invalid pk "{pk}" - object does not exist.' for pk in missing]
+            )
+        for item in items:
+            item['product'] = products[item['product']]
+            item.setdefault('unit_price', item['product'].price)
+        return items
+
+    def create(self, validated_data):
+        """Create the order and all of its items in one transaction, totalling once."""
+        lines = validated_data.pop('items', [])
+        try:
+            with transaction.atomic():
+                order = Order(**validated_data)
+                order.save()
+                # One INSERT per batch plus a single UPDATE adding the lines to the total.
+                items = OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=line['product'], quantity=line['quantity'], unit_price=line['unit_price'])
+                    for line in lines
+                ], batch_size=500)
+                reserve_items(order, items)
+        except InsufficientStock as exc:
+            raise serializers.ValidationError({'items': [str(exc)]})
+        order.total_amount += sum((item.subtotal for item in items), Decimal('0'))
+        return order
         
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, ExpandableFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {
+        'product': ('ProductSerializer', {}),
+    }
+
     class Meta:
         model = OrderItem
         fields = ['order_item_id', 'order', 'product', 'quantity', 'unit_price',
                   'subtotal', 'created_at']
         read_only_fields = ['order_item_id', 'subtotal', 'created_at']
+
+    def create(self, validated_data):
+        try:
+            with transaction.atomic():
+                item = super().create(validated_data)
+                reserve_items(item.order, [item])
+        except InsufficientStock as exc:
+            raise serializers.ValidationError({'quantity': [str(exc)]})
+        return item
+
+    def update(self, instance, validated_data):
+        previous = (instance.order_id, instance.product_id, instance.quantity)
+        try:
+            with transaction.atomic():
+                item = super().update(instance, validated_data)
+                if (item.order_id, item.product_id, item.quantity) != previous:
+                    replace_item_reservation(item)
+        except InsufficientStock as exc:
+            raise serializers.ValidationError({'quantity': [str(exc)]})
+        return item
         
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['payment_id', 'order', 'payment_method', 'payment_status', 'amount',
@@ -74,9 +277,109 @@ class PaymentSerializer(serializers.ModelSerializer):
         read_only_fields = ['payment_id', 'transaction_id', 'payment_status', 
                             'created_at', 'updated_at']
         
-class AddressSerializer(serializers.ModelSerializer):
+class AddressSerializer(TimedSerializerMixin, DatabaseUniquenessMixin, serializers.ModelSerializer):
     class Meta:
         model = Address
         fields = ['address_id', 'user', 'street', 'city', 'state', 'postal_code',
                   'country', 'is_default', 'created_at', 'updated_at']
-        read_only_fields = ['address_id', 'user', 'created_at', 'updated_at']
\ No newline at end of file
+        read_only_fields = ['address_id', 'user', 'created_at', 'updated_at']
+
+class ExportParamsSerializer(serializers.Serializer):
+    """Query parameters of an export; `dataset` (from products/exports.py) goes in the context."""
+    start = serializers.DateTimeField(required=False, help_text='Created at or after (ISO date or datetime).')
+    end = serializers.DateTimeField(required=False, help_text='Created before (ISO date or datetime).')
+    status = serializers.CharField(required=False)
+    file_format = serializers.ChoiceField(choices=list(FORMATS), default='ndjson')
+
+    def validate_status(self, value):
+        choices = self.context['dataset'].status_choices
+        if value not in choices.values:
+            raise serializers.ValidationError(f'Must be one of: {", ".join(choices.values)}.')
+        return value
+
+    def validate(self, attrs):
+        if attrs.get('start') and attrs.get('end') and attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({'end': 'Must be after start.'})
+        return attrs
+
+class OrderTransitionSerializer(serializers.Serializer):
+    """
+    Body of a bulk order transition: the new `status`, and the orders either as
+    `order_ids` or by the filters (`from_status`, `start`, `end`).
+    """
+    status = serializers.ChoiceField(choices=OrderStatus.choices)
+    order_ids = serializers.ListField(child=serializers.UUIDField(), required=False, allow_empty=False,
+                                      max_length=100000)
+    from_status = serializers.ChoiceField(choices=OrderStatus.choices, required=False,
+                                          help_text='Only orders currently in this status.')
+    start = serializers.DateTimeField(required=False, help_text='Created at or after (ISO date or datetime).')
+    end = serializers.DateTimeField(required=False, help_text='Created before (ISO date or datetime).')
+
+    def validate_status(self, value):
+        if not order_status_sources(value):
+            raise serializers.ValidationError(f'No order can be moved to {value}.')
+        return value
+
+    def validate(self, attrs):
+        if not any(attrs.get(name) for name in ('order_ids', 'from_status', 'start', 'end')):
+            raise serializers.ValidationError('Give order_ids or at least one of from_status, start and end.')
+        if attrs.get('start') and attrs.get('end') and attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({'end': 'Must be after start.'})
+        return attrs
+
+    def orders(self):
+        """The orders the transition applies to, besides any order_ids."""
+        orders = Order.objects.all()
+        if 'from_status' in self.validated_data:
+            orders = orders.filter(status=self.validated_data['from_status'])
+        if 'start' in self.validated_data:
+            orders = orders.filter(created_at__gte=self.validated_data['start'])
+        if 'end' in self.validated_data:
+            orders = orders.filter(created_at__lt=self.validated_data['end'])
+        return orders
+
+class StockMovementSerializer(serializers.Serializer):
+    """A restock, return or adjustment of one product; only adjustments may be negative."""
+    quantity = serializers.IntegerField()
+    reason = serializers.ChoiceField(choices=StockMovementReason.choices, default=StockMovementReason.RESTOCK)
+
+    def validate(self, attrs):
+        if attrs['quantity'] == 0:
+            raise serializers.ValidationError({'quantity': 'Must not be zero.'})
+        if attrs['quantity'] < 0 and attrs['reason'] != StockMovementReason.ADJUSTMENT:
+            raise serializers.ValidationError({'quantity': 'Only adjustments can remove stock.'})
+        return attrs
+
+class AvailabilityParamsSerializer(serializers.Serializer):
+    ids = serializers.CharField(help_text='Comma-separated product ids, at most 100.')
+
+    def validate_ids(self, value):
+        field = serializers.UUIDField()
+        ids = [field.run_validation(part.strip()) for part in value.split(',') if part.strip()]
+        if not ids or len(ids) > 100:
+            raise serializers.ValidationError('Give between 1 and 100 product ids.')
+        return ids
+
+class ImportUploadSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    file_format = serializers.ChoiceField(choices=IMPORT_FORMATS, required=False,
+                                          help_text='Defaults to the file extension.')
+
+    def validate(self, attrs):
+        if 'file_format' not in attrs:
+            extension = attrs['file'].name.rsplit('.', 1)[-1].lower()
+            if extension not in IMPORT_FORMATS:
+                raise serializers.ValidationError({'file_format': 'Cannot tell the format from the file name.'})
+            attrs['file_format'] = extension
+        return attrs
+
+class AnalyticsParamsSerializer(serializers.Serializer):
+    start = serializers.DateField(required=False, help_text='First day (inclusive).')
+    end = serializers.DateField(required=False, help_text='Last day (inclusive).')
+    limit = serializers.IntegerField(required=False, default=10, min_value=1, max_value=100,
+                                     help_text='Number of top products.')
+
+    def validate(self, attrs):
+        if attrs.get('start') and attrs.get('end') and attrs['start'] > attrs['end']:
+            raise serializers.ValidationError({'end': 'Must not be before start.'})
+        return attrs
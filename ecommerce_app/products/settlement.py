@@ -0,0 +1,302 @@
+"""
+Payment settlement: a database-backed queue of pending payments.
+
+Payments are created `pending` and the `settle_payments` command moves them
+on. Each round:
+
+1. claims up to `PAYMENT_SETTLEMENT_BATCH_SIZE` due payments. On PostgreSQL the
+   candidates are read with `SELECT ... FOR UPDATE SKIP LOCKED`, so workers
+   never wait on each other's rows. The claim itself is a conditional UPDATE
+   that stamps a lease token and pushes `next_attempt_at` to the end of the
+   lease. It succeeds for only one worker per row, which is all SQLite (no row
+   locks) needs. A worker that dies leaves its payments to be claimed again
+   once the lease runs out;
+2. captures the claimed payments through the gateway client, up to
+   `PAYMENT_SETTLEMENT_CONCURRENCY` at a time on an event loop. Transient
+   errors and timeouts are retried `PAYMENT_GATEWAY_RETRIES` times with
+   exponential backoff and jitter;
+3. writes the outcomes back in a handful of set-based UPDATEs, guarded by the
+   lease token so a worker whose lease ran out changes nothing. Captured
+   payments complete and their pending orders become paid; declined payments
+   fail; payments that still hit transient errors are rescheduled, with the
+   delay doubling per attempt, until `PAYMENT_SETTLEMENT_MAX_ATTEMPTS`.
+
+The gateway client is `PAYMENT_GATEWAY`, a dotted path to a class with an
+async `capture(charge)` method that raises `GatewayDeclined` or
+`GatewayError`. `charge.transaction_id` is the idempotency key: a payment
+whose lease expired mid-capture is captured again with the same key.
+`FakeGateway` is an in-process stand-in for tests and local runs.
+
+Gateway latency and outcomes are exported as `payment_gateway_seconds` and
+`payments_settled_total` in `products.metrics`.
+"""
+import asyncio
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import Order, OrderStatus, Payment, PaymentStatus, order_status_changed
+
+COMPLETED = 'completed'
+DECLINED = 'declined'
+ERROR = 'error'
+
+
+class GatewayDeclined(Exception):
+    """The gateway refused the charge; retrying will not help."""
+
+
+class GatewayError(Exception):
+    """The charge may succeed if tried again (timeouts, 5xx, rate limits)."""
+
+
+@dataclass(frozen=True)
+class Charge:
+    """What the gateway client gets: a claimed payment, without the ORM."""
+    payment_id: uuid.UUID
+    order_id: uuid.UUID
+    transaction_id: str
+    amount: object
+    payment_method: str
+    attempt: int
+
+
+@dataclass
+class SettlementStats:
+    claimed: int = 0
+    completed: int = 0
+    failed: int = 0
+    retried: int = 0
+    orders_paid: int = 0
+    seconds: float = 0.0
+
+    @property
+    def per_second(self):
+        return self.claimed / self.seconds if self.seconds else 0.0
+
+    def add(self, other):
+        for field, value in asdict(other).items():
+            setattr(self, field, getattr(self, field) + value)
+
+    def as_dict(self):
+        return dict(asdict(self), per_second=self.per_second)
+
+
+class FakeGateway:
+    """
+    Approves every charge after `latency` seconds, except transaction ids in
+    `decline`, and those in `flaky` ({transaction_id: failures}) which first
+    fail that many times. `error_rate` adds random transient failures.
+    """
+
+    def __init__(self, latency=0.0, decline=(), flaky=None, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.decline = set(decline)
+        self.flaky = dict(flaky or {})
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.captured = {}
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def capture(self, charge):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if charge.transaction_id in self.captured:
+                return  # idempotent, like a real gateway given the same key
+            if charge.transaction_id in self.decline:
+                raise GatewayDeclined('Card declined.')
+            if self.flaky.get(charge.transaction_id):
+                self.flaky[charge.transaction_id] -= 1
+                raise GatewayError('Gateway unavailable.')
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise GatewayError('Gateway unavailable.')
+            self.captured[charge.transaction_id] = charge.amount
+        finally:
+            self.in_flight -= 1
+
+
+def get_gateway(path=None):
+    path = path or getattr(settings, 'PAYMENT_GATEWAY', '')
+    if not path:
+        raise ImproperlyConfigured('Set PAYMENT_GATEWAY to the payment gateway client class.')
+    return import_string(path)()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def claim_payments(batch_size, lease=None, now=None):
+    """(lease token, [Charge]) for up to `batch_size` due payments, now leased to the caller."""
+    now = now or timezone.now()
+    lease = lease or _setting('PAYMENT_SETTLEMENT_LEASE', timedelta(minutes=5))
+    token = uuid.uuid4().hex
+    due = Payment.objects.filter(payment_status=PaymentStatus.PENDING, next_attempt_at__lte=now)
+    with transaction.atomic():
+        candidates = list(
+            due.select_for_update(skip_locked=True).order_by('next_attempt_at').values_list('pk', flat=True)[:batch_size]
+        )
+        if not candidates:
+            return token, []
+        due.filter(pk__in=candidates).update(
+            lease_token=token, next_attempt_at=now + lease, attempts=F('attempts') + 1, updated_at=now,
+        )
+    rows = Payment.objects.filter(lease_token=token).values_list(
+        'pk', 'order_id', 'transaction_id', 'amount', 'payment_method', 'attempts',
+    )
+    return token, [Charge(*row) for row in rows]
+
+
+async def _capture(gateway, charge, retries, backoff, timeout):
+    """(outcome, error) for one charge, after up to `retries` retries of transient errors."""
+    error = ''
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))  # full jitter
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(gateway.capture(charge), timeout)
+        except GatewayDeclined as exc:
+            outcome, error = DECLINED, str(exc) or 'Declined.'
+        except (GatewayError, asyncio.TimeoutError, OSError) as exc:
+            outcome, error = ERROR, str(exc) or type(exc).__name__
+        else:
+            outcome, error = COMPLETED, ''
+        if metrics.enabled():
+            metrics.registry.observe('payment_gateway_seconds', (outcome,), time.perf_counter() - started)
+        if outcome != ERROR:
+            return outcome, error
+    return ERROR, error
+
+
+async def capture_charges(gateway, charges, concurrency=10, retries=2, backoff=0.2, timeout=10.0):
+    """[(outcome, error)] for `charges`, with at most `concurrency` gateway calls in flight."""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def capture(charge):
+        async with slots:
+            return await _capture(gateway, charge, retries, backoff, timeout)
+
+    return await asyncio.gather(*(capture(charge) for charge in charges))
+
+
+def _per_row(values, output_field):
+    """CASE pk WHEN ... THEN value for {pk: value}."""
+    return Case(*[When(pk=pk, then=Value(value)) for pk, value in values.items()], output_field=output_field)
+
+
+def record_outcomes(token, charges, outcomes, now=None):
+    """Write the outcomes of a claimed batch back in bulk; returns SettlementStats (without timing)."""
+    now = now or timezone.now()
+    max_attempts = _setting('PAYMENT_SETTLEMENT_MAX_ATTEMPTS', 5)
+    retry_delay = _setting('PAYMENT_SETTLEMENT_RETRY_DELAY', timedelta(seconds=30))
+    completed, failed, retry = {}, {}, {}
+    for charge, (outcome, error) in zip(charges, outcomes):
+        if outcome == COMPLETED:
+            completed[charge.payment_id] = charge.order_id
+        elif outcome == DECLINED or charge.attempt >= max_attempts:
+            failed[charge.payment_id] = error[:255]
+        else:
+            retry[charge.payment_id] = (error[:255], now + retry_delay * 2 ** (charge.attempt - 1))
+
+    stats = SettlementStats(claimed=len(charges))
+    leased = Payment.objects.filter(lease_token=token, payment_status=PaymentStatus.PENDING)
+    with transaction.atomic():
+        if completed:
+            # Only rows this worker still holds; another may have taken over an expired lease.
+            # Locking them keeps it that way until the UPDATE, so exactly these rows
+            # complete and only their orders are marked paid.
+            mine = dict(leased.filter(pk__in=completed).select_for_update().values_list('pk', 'order_id'))
+            stats.completed = leased.filter(pk__in=mine).update(
+                payment_status=PaymentStatus.COMPLETED, lease_token='', last_error='', updated_at=now,
+            )
+            if mine:
+                stats.orders_paid = mark_orders_paid(set(mine.values()), now)
+        if failed:
+            stats.failed = leased.filter(pk__in=failed).update(
+                payment_status=PaymentStatus.FAILED, lease_token='', updated_at=now,
+                last_error=_per_row(failed, models.CharField()),
+            )
+        if retry:
+            stats.retried = leased.filter(pk__in=retry).update(
+                lease_token='', updated_at=now,
+                last_error=_per_row({pk: error for pk, (error, _) in retry.items()}, models.CharField()),
+                next_attempt_at=_per_row({pk: due for pk, (_, due) in retry.items()}, models.DateTimeField()),
+            )
+    if metrics.enabled():
+        for outcome, count in (('completed', stats.completed), ('failed', stats.failed), ('retried', stats.retried)):
+            if count:
+                metrics.registry.increment('payments_settled_total', (outcome,), count)
+    return stats
+
+
+def mark_orders_paid(order_ids, now):
+    """Move the pending orders among `order_ids` to paid; returns how many moved."""
+    paid = list(
+        Order.objects.select_for_update().filter(pk__in=order_ids, status=OrderStatus.PENDING)
+        .values_list('pk', flat=True)
+    )
+    if not paid:
+        return 0
+    Order.objects.filter(pk__in=paid, status=OrderStatus.PENDING).update(status=OrderStatus.PAID, updated_at=now)
+    order_status_changed.send(sender=Order, order_ids=paid, previous=OrderStatus.PENDING, status=OrderStatus.PAID)
+    return len(paid)
+
+
+def fail_cancelled(now=None):
+    """Fail pending payments of cancelled orders without charging them; returns how many."""
+    return Payment.objects.filter(
+        payment_status=PaymentStatus.PENDING, order__status=OrderStatus.CANCELLED,
+    ).update(
+        payment_status=PaymentStatus.FAILED, lease_token='', last_error='Order was cancelled before settlement.',
+        updated_at=now or timezone.now(),
+    )
+
+
+def settle_batch(gateway, batch_size=None, concurrency=None, retries=None, backoff=None, timeout=None):
+    """Claim, capture and record one batch; returns its SettlementStats."""
+    started = time.perf_counter()
+    token, charges = claim_payments(batch_size or _setting('PAYMENT_SETTLEMENT_BATCH_SIZE', 100))
+    if not charges:
+        return SettlementStats()
+    outcomes = asyncio.run(capture_charges(
+        gateway, charges,
+        concurrency=concurrency or _setting('PAYMENT_SETTLEMENT_CONCURRENCY', 10),
+        retries=_setting('PAYMENT_GATEWAY_RETRIES', 2) if retries is None else retries,
+        backoff=_setting('PAYMENT_GATEWAY_BACKOFF', 0.2) if backoff is None else backoff,
+        timeout=timeout or _setting('PAYMENT_GATEWAY_TIMEOUT', 10.0),
+    ))
+    stats = record_outcomes(token, charges, outcomes)
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+
+def settle_payments(gateway=None, max_batches=None, **options):
+    """Settle batches until nothing is due (or `max_batches`); returns the combined SettlementStats."""
+    gateway = gateway or get_gateway()
+    total = SettlementStats()
+    total.failed += fail_cancelled()
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        stats = settle_batch(gateway, **options)
+        if not stats.claimed:
+            break
+        total.add(stats)
+        batches += 1
+    return total
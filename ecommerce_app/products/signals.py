@@ -0,0 +1,84 @@
+from django.db.models import F, QuerySet, Subquery
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .analytics import COUNTED_STATUSES, apply_orders, record_status_change
+from .authentication import invalidate_user
+from .cache import invalidate
+from .models import (
+    Category, Order, OrderItem, OrderItemQuerySet, OrderStatus, Product, ProductImage, StockReservation, User,
+    order_status_changed,
+)
+from .reservations import consume_reservations, release_reservations
+from .search import unindex_products
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_catalog_cache(sender, **kwargs):
+    invalidate(sender)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search_index(sender, instance, **kwargs):
+    unindex_products(sender, [instance.pk])
+
+
+@receiver(pre_delete, sender=OrderItem)
+def subtract_deleted_item_from_order_total(sender, instance, origin=None, **kwargs):
+    # OrderItemQuerySet.delete() has already adjusted the totals in one statement,
+    # and there is nothing to adjust when the order itself is being deleted.
+    if isinstance(origin, (Order, OrderItemQuerySet)):
+        return
+    if isinstance(origin, QuerySet) and origin.model is Order:
+        return
+    # Subtract the stored row, not the instance, which may be out of date.
+    item = sender._base_manager.filter(pk=instance.pk)
+    Order.objects.filter(pk__in=item.values('order')).update(
+        total_amount=F('total_amount') - Subquery(item.values('subtotal')),
+    )
+
+
+@receiver(order_status_changed, sender=Order)
+def settle_reservations_on_status_change(sender, order_ids, previous, status, **kwargs):
+    if status == OrderStatus.CANCELLED:
+        release_reservations(StockReservation.objects.filter(order_id__in=order_ids))
+    elif status != OrderStatus.PENDING:
+        consume_reservations(order_ids)
+
+
+@receiver(order_status_changed, sender=Order)
+def update_sales_rollups(sender, order_ids, previous, status, **kwargs):
+    record_status_change(order_ids, previous, status)
+
+
+@receiver(pre_delete, sender=Order)
+def remove_deleted_order_from_sales_rollups(sender, instance, **kwargs):
+    if instance.status in COUNTED_STATUSES:
+        apply_orders([instance.pk], sign=-1)
+
+
+@receiver(pre_delete, sender=Order)
+def release_reservations_of_deleted_order(sender, instance, **kwargs):
+    release_reservations(StockReservation.objects.filter(order=instance))
+
+
+@receiver(pre_delete, sender=OrderItem)
+def release_reservations_of_deleted_item(sender, instance, **kwargs):
+    release_reservations(StockReservation.objects.filter(order_item=instance))
+
+
+@receiver(post_delete, sender=Category)
+def reroot_subcategories_of_deleted_category(sender, instance, **kwargs):
+    # on_delete=SET_NULL turned the children into roots without calling save().
+    Category.objects.reroot_orphans()
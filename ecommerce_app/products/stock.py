@@ -0,0 +1,139 @@
+"""
+Stock movements on sharded counters.
+
+Restocks, returns and stock adjustments do not update `Product.stock_quantity`
+directly. Every one of them is recorded as a row in the append-only
+`StockMovement` ledger. Its quantity is then added to one of the product's
+`STOCK_COUNTER_SHARDS` counter rows (`StockCounterShard`), picked at random.
+Concurrent movements on a hot product therefore lock different rows instead of
+queueing on the product row, which checkouts hold while they take stock.
+
+What a product has available is therefore
+
+    Product.stock_quantity + the sum of its counter shards
+
+and `available()` reads it in one query. `compact_stock()`, run periodically by
+`manage.py compact_stock`, folds the counters back into `stock_quantity`. For a
+batch of products it locks the counters (`SELECT ... FOR UPDATE`, in product
+and shard order, the order movements lock them in), adds their sum to the
+products and takes the same amounts off the counters, all in one transaction.
+Two compactions of the same product, say the cron job and a checkout folding
+its products, therefore run one after the other, and the second finds the
+counters already folded instead of adding them a second time. Movements wait
+for the lock only while a batch is being folded. Like checkouts, compaction
+starts a new product generation in the catalog cache; movements do not.
+
+Taking stock for a checkout stays a conditional UPDATE of `stock_quantity`
+(products/reservations.py): splitting the stock itself across rows would let
+two checkouts each see enough in their own shard and oversell. When a checkout
+finds too little stock, it first folds the counters of its products and tries
+once more, so stock that was just returned or restocked can be sold at once.
+"""
+import random
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Product, StockCounterShard, StockMovement, StockMovementReason
+
+
+def shard_count():
+    return max(getattr(settings, 'STOCK_COUNTER_SHARDS', 8), 1)
+
+
+def record_movements(quantities, reason):
+    """
+    Append {product_id: quantity} to the ledger, adding each quantity to a
+    random counter shard of its product. Returns the StockMovements.
+    """
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity}
+    if not quantities:
+        return []
+    with transaction.atomic():
+        movements = StockMovement.objects.bulk_create([
+            StockMovement(product_id=product_id, quantity=quantity, reason=reason)
+            for product_id, quantity in quantities.items()
+        ])
+        # Sorted, so two movements on the same products never lock their shards in opposite orders.
+        for product_id in sorted(quantities, key=str):
+            shard = random.randrange(shard_count())
+            counter = StockCounterShard.objects.filter(product_id=product_id, shard=shard)
+            if not counter.update(delta=F('delta') + quantities[product_id]):
+                # The product's first movement: create every shard, then add to this one.
+                StockCounterShard.objects.bulk_create([
+                    StockCounterShard(product_id=product_id, shard=index) for index in range(shard_count())
+                ], ignore_conflicts=True)
+                counter.update(delta=F('delta') + quantities[product_id])
+    return movements
+
+
+def record_movement(product_id, quantity, reason=StockMovementReason.ADJUSTMENT):
+    movement, = record_movements({product_id: quantity}, reason)
+    return movement
+
+
+def pending_delta():
+    """Sum of a product's counter shards, as a subquery on Product (0 without any)."""
+    totals = (
+        StockCounterShard.objects.filter(product_id=OuterRef('pk')).order_by()
+        .values('product_id').annotate(total=Sum('delta')).values('total')
+    )
+    return Coalesce(Subquery(totals, output_field=models.IntegerField()), Value(0))
+
+
+def available(product_ids):
+    """{product_id: units available} for the products that exist, in one query."""
+    rows = Product.objects.filter(pk__in=product_ids).annotate(
+        available=F('stock_quantity') + pending_delta(),
+    ).values_list('pk', 'available')
+    return {pk: max(units, 0) for pk, units in rows}
+
+
+def compact_stock(product_ids=None, batch_size=None):
+    """
+    Fold the counter shards of `product_ids` (every product with something to
+    fold, by default) into stock_quantity. Returns the number of products changed.
+    """
+    batch_size = batch_size or getattr(settings, 'STOCK_COMPACTION_BATCH_SIZE', 500)
+    counters = StockCounterShard.objects.exclude(delta=0)
+    if product_ids is not None:
+        counters = counters.filter(product_id__in=product_ids)
+    compacted = 0
+    last = None
+    while True:
+        batch = counters if last is None else counters.filter(product_id__gt=last)
+        batch_ids = list(batch.order_by('product_id').values_list('product_id', flat=True).distinct()[:batch_size])
+        if not batch_ids:
+            break
+        with transaction.atomic():
+            rows = list(
+                counters.filter(product_id__in=batch_ids).select_for_update().order_by('product_id', 'shard')
+                .values_list('pk', 'product_id', 'delta')
+            )
+            totals = defaultdict(int)
+            for _, product_id, delta in rows:
+                totals[product_id] += delta
+            totals = {product_id: total for product_id, total in totals.items() if total}
+            if totals:
+                Product.objects.filter(pk__in=totals).update(
+                    stock_quantity=F('stock_quantity') + _per_row(totals),
+                )
+            StockCounterShard.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(
+                delta=F('delta') - _per_row({pk: delta for pk, _, delta in rows}),
+            )
+        compacted += len(totals)
+        last = batch_ids[-1]
+        if len(batch_ids) < batch_size:
+            break
+    return compacted
+
+
+def _per_row(values):
+    """CASE pk WHEN ... THEN value for {pk: value}."""
+    return Case(
+        *[When(pk=pk, then=Value(value)) for pk, value in values.items()],
+        default=Value(0), output_field=models.IntegerField(),
+    )
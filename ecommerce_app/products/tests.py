@@ -1,3 +1,1996 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.contrib.auth.models import AnonymousUser
+from django.db import router as db_router
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase
+from django.urls import resolve
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+from .analytics import rebuild_rollups
+from .authentication import CachedJWTAuthentication, user_cache
+from .cache import generations, stats as cache_stats
+from .benchmarks.concurrency import catalog_scenarios, speedups, ThroughputResult
+from .benchmarks.plans import check_plans, sequential_scans
+from .benchmarks.scenarios import SCENARIOS, ScenarioResult, compare, run_scenarios
+from .benchmarks.seed import SeedVolumes, clear_seed, seed_catalog
+from .benchmarks.stock import run_reservation_contention
+from .models import (
+    Category, ImageAsset, ImageAssetStatus, Order, OrderItem, OrderStatus, Payment, PaymentMethod, PaymentStatus, Product, ProductImage, ReservationStatus,
+    SalesRollup, StockCounterShard, StockMovement, StockMovementReason, StockReservation, User, UserRole,
+)
+from . import hashing, images, stock
+from .imports import import_rows
+from .pagination import KeysetPagination, check_keyset_orderings
+from .metrics import collect, registry as metrics_registry
+from .routers import PIN_COOKIE, ReplicaRoutingMiddleware
+from .reservations import InsufficientStock, expire_reservations, release_reservations, reserve_items
+from .search import TRUNCATED_HEADER, reset_fallback_index, uses_postgres
+from . import settlement
+from .serializers import ClaimsTokenObtainPairSerializer, OrderSerializer, ProductImageSerializer, ProductSerializer
+from .urls import router
+from .views import CategoryViewSet, ProductViewSet
+
+
+class CatalogTestMixin:
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Electronics')
+        self.user = User.objects.create_user(email='buyer@example.com', password='pw', first_name='A', last_name='B')
+        self.client.force_authenticate(self.user)
+
+    def create_products(self, count, images=2):
+        products = []
+        for i in range(count):
+            product = Product.objects.create(
+                name=f'Product {i:03}', description='', price=Decimal('10.00'),
+                stock_quantity=100, category=self.category,
+            )
+            for j in range(images):
+                ProductImage.objects.create(product=product, image_url=f'https://example.com/{i}/{j}.jpg')
+            products.append(product)
+        return products
+
+
+class KeysetPaginationTests(CatalogTestMixin, TestCase):
+
+    def walk(self, path):
+        """Follow the next links from `path`; returns (every page's results, the last page)."""
+        pages = []
+        response = self.client.get(path, secure=True)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data['results'])
+            if not response.data['next']:
+                return pages, response
+            response = self.client.get(response.data['next'], secure=True)
+
+    def paginate(self, queryset, **params):
+        paginator = KeysetPagination()
+        request = Request(RequestFactory().get('/items/', params))
+        page = paginator.paginate_queryset(queryset, request)
+        return page, paginator.get_paginated_response([item.pk for item in page]).data
+
+    def test_forward_and_backward_traversal(self):
+        products = self.create_products(7, images=0)
+        pages, last = self.walk('/api/products/?page_size=3')
+        self.assertEqual([[p['name'] for p in page] for page in pages],
+                         [['Product 000', 'Product 001', 'Product 002'], ['Product 003', 'Product 004', 'Product 005'],
+                          ['Product 006']])
+        self.assertIsNotNone(last.data['previous'])
+        back = self.client.get(last.data['previous'], secure=True)
+        self.assertEqual([p['name'] for p in back.data['results']], ['Product 003', 'Product 004', 'Product 005'])
+        first = self.client.get(back.data['previous'], secure=True)
+        self.assertEqual([p['product_id'] for p in first.data['results']], [str(p.pk) for p in products[:3]])
+        self.assertIsNone(first.data['previous'])
+
+    def test_equal_ordering_values_are_split_by_primary_key(self):
+        for i in range(5):
+            Product.objects.create(name=f'Same {i}', price=Decimal('5.00'), stock_quantity=1, category=self.category)
+        pages, _ = self.walk('/api/products/?ordering=-price&page_size=2')
+        ids = [p['product_id'] for page in pages for p in page]
+        self.assertEqual(len(ids), 5)
+        # Ties on price fall back to the primary key, in the direction of the last term.
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_nullable_ordering_column(self):
+        product, = self.create_products(1, images=0)
+        for alt_text in ('b', None, 'a', None, 'c'):
+            ProductImage.objects.create(product=product, image_url='https://example.com/x.jpg', alt_text=alt_text)
+        for ordering in ('alt_text', '-alt_text'):
+            queryset = ProductImage.objects.order_by(ordering)
+            seen, cursor = [], None
+            while True:
+                params = {'page_size': 2, **({'cursor': cursor} if cursor else {})}
+                page, data = self.paginate(queryset, **params)
+                seen += page
+                if not data['next']:
+                    break
+                cursor = parse_qs(urlsplit(data['next']).query)['cursor'][0]
+            texts = [image.alt_text for image in seen]
+            self.assertEqual(texts[:3], ['a', 'b', 'c'] if ordering == 'alt_text' else ['c', 'b', 'a'])
+            self.assertEqual(texts[3:], [None, None])  # NULLs last, whichever the direction
+
+    def test_cursor_is_refused_after_the_ordering_changes(self):
+        self.create_products(4, images=0)
+        next_link = self.client.get('/api/products/?ordering=created_at&page_size=2', secure=True).data['next']
+        # Same shape of values, different meaning: only the ordering recorded in the cursor tells them apart.
+        for ordering in ('updated_at', '-created_at'):
+            changed = next_link.replace('ordering=created_at', f'ordering={ordering}')
+            self.assertEqual(self.client.get(changed, secure=True).status_code, 404)
+        self.assertEqual(self.client.get(next_link, secure=True).status_code, 200)
+
+    def test_malformed_cursors_are_404(self):
+        self.create_products(2, images=0)
+        cursors = ['not-base64!', 'e30', base64.urlsafe_b64encode(b'[1,2]').decode(),
+                   base64.urlsafe_b64encode(b'{"v":[{"a":1},[2]],"o":"name,pk"}').decode(),
+                   base64.urlsafe_b64encode(b'{"v":["x","not-a-uuid"],"o":"name,product_id"}').decode()]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(f'/api/products/?cursor={cursor}', secure=True)
+                self.assertEqual(response.status_code, 404)
+
+    def test_page_numbers_are_for_admins_only(self):
+        self.create_products(5, images=0)
+        response = self.client.get('/api/products/?page=2&page_size=2', secure=True)
+        self.assertNotIn('count', response.data)  # customers always get cursors
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        response = self.client.get('/api/products/?page=2&page_size=2', secure=True)
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual([p['name'] for p in response.data['results']], ['Product 002', 'Product 003'])
+
+    def test_orderings_on_related_lookups_fail_the_system_check(self):
+        class RelatedOrderingViewSet(ProductViewSet):
+            ordering_fields = ['name', 'category__name']
+
+        with mock.patch.object(router, 'registry', [('related', RelatedOrderingViewSet, 'related')]):
+            errors = check_keyset_orderings()
+        self.assertEqual([error.id for error in errors], ['products.E001'])
+        self.assertEqual(check_keyset_orderings(), [])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductSearchTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_fallback_index()
+        self.addCleanup(reset_fallback_index)
+        self.headphones = self.product('Wireless headphones', 'Over-ear wireless set, noise cancelling.')
+        self.cable = self.product('Audio cable', 'Spare cable for wireless headphones.')
+        self.mouse = self.product('Wireless mouse', 'Quiet clicks.')
+
+    def product(self, name, description=''):
+        return Product.objects.create(name=name, description=description, price=Decimal('10.00'),
+                                      stock_quantity=1, category=self.category)
+
+    def search(self, query):
+        response = self.client.get(f'/api/products/?page_size=100&{query}', secure=True)
+        self.assertEqual(response.status_code, 200)
+        return [product['name'] for product in response.data['results']]
+
+    def test_every_word_must_match_and_names_rank_first(self):
+        self.assertEqual(self.search('q=wireless headphones'), ['Wireless headphones', 'Audio cable'])
+        self.assertEqual(self.search('q=wireless'), ['Wireless headphones', 'Wireless mouse', 'Audio cable'])
+        self.assertEqual(self.search('q=wireless cable'), ['Audio cable'])
+        self.assertEqual(self.search('q=wireless keyboard'), [])
+        self.assertEqual(self.search('q=wireless&ordering=name'), ['Audio cable', 'Wireless headphones',
+                                                                    'Wireless mouse'])
+        self.assertEqual(self.search('q=%20%21'), [])
+
+    def test_words_match_as_prefixes(self):
+        self.assertEqual(self.search('q=WIRE head'), ['Wireless headphones', 'Audio cable'])
+        self.assertEqual(self.search('q=mou'), ['Wireless mouse'])
+        self.assertEqual(self.search('q=phones'), [])  # prefixes only, not any substring
+
+    def test_writes_keep_the_index_in_sync(self):
+        self.assertEqual(self.search('q=mouse'), ['Wireless mouse'])  # builds the index
+        self.mouse.name = 'Wireless trackball'
+        self.mouse.save()
+        self.assertEqual(self.search('q=mouse'), [])
+        self.assertEqual(self.search('q=trackball'), ['Wireless trackball'])
+
+        self.cable.name = 'Audio lead'
+        Product.objects.bulk_update([self.cable], ['name'])
+        Product.objects.filter(pk=self.headphones.pk).update(description='Comes with a carry case.')
+        self.assertEqual(self.search('q=lead'), ['Audio lead'])
+        self.assertEqual(self.search('q=carry'), ['Wireless headphones'])
+        self.assertEqual(self.search('q=noise'), [])
+
+        Product.objects.bulk_create([Product(name='Wireless speaker', price=Decimal('5.00'), stock_quantity=1,
+                                             category=self.category)])
+        self.assertEqual(self.search('q=speaker'), ['Wireless speaker'])
+        self.mouse.delete()
+        Product.objects.filter(name='Wireless speaker').delete()
+        self.assertEqual(self.search('q=wireless'), ['Wireless headphones', 'Audio lead'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'the tsvector trigger is PostgreSQL only')
+    def test_the_vector_is_written_by_the_same_statement(self):
+        self.mouse.name = 'Wireless trackball'
+        with CaptureQueriesContext(connection) as queries:
+            self.mouse.save()
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.search('q=trackball'), ['Wireless trackball'])
+        stale = Product.objects.get(pk=self.cable.pk)
+        Product.objects.filter(pk=self.cable.pk).update(name='Audio lead')
+        stale.price = Decimal('2.00')
+        stale.save()  # writes the old name back, and its vector with it
+        Product.objects.filter(pk=self.cable.pk).update(stock_quantity=5)
+        self.assertEqual(self.search('q=audio cable'), ['Audio cable'])
+
+    @override_settings(SEARCH_FALLBACK_RESULT_LIMIT=2, CATALOG_CACHE_TIMEOUT=300)
+    def test_cut_short_results_are_flagged(self):
+        for _ in range(2):
+            response = self.client.get('/api/products/?q=wireless', secure=True)
+            self.assertEqual(response[TRUNCATED_HEADER], '2')
+            self.assertEqual([product['name'] for product in json.loads(response.content)['results']],
+                             ['Wireless headphones', 'Wireless mouse'])
+        self.assertEqual(response['X-Cache'], 'HIT')
+        response = self.client.get('/api/products/?q=wireless headphones', secure=True)
+        self.assertNotIn(TRUNCATED_HEADER, response)
+
+
+class OrderCreationTests(CatalogTestMixin, TestCase):
+
+    def test_nested_order_creation_costs_constant_queries(self):
+        products = self.create_products(25, images=0)
+        for count in (1, 25):
+            lines = [{'product': str(product.pk), 'quantity': 2} for product in products[:count]]
+            # user, products, order INSERT, items INSERT, total UPDATE, product locks, stock UPDATE,
+            # reservations INSERT, plus six savepoint statements.
+            with self.assertNumQueries(14):
+                response = self.client.post('/api/orders/', {'user': str(self.user.pk), 'items': lines},
+                                            format='json', secure=True)
+            self.assertEqual(response.status_code, 201, response.data)
+            order = Order.objects.get(pk=response.data['order_id'])
+            self.assertEqual(order.total_amount, Decimal('20.00') * count)
+            self.assertEqual(response.data['total_amount'], str(order.total_amount))
+            self.assertEqual(order.items.count(), count)
+            self.assertEqual(StockReservation.objects.filter(order=order).count(), count)
+        self.assertEqual(Product.objects.get(pk=products[0].pk).stock_quantity, 96)
+
+
+class OrderTotalTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(3, images=0)
+        self.order, self.other = Order.objects.create(user=self.user), Order.objects.create(user=self.user)
+
+    def add(self, order, product, quantity, unit_price='10.00'):
+        return OrderItem.objects.create(order=order, product=product, quantity=quantity, unit_price=Decimal(unit_price))
+
+    def assertTotalsMatchItems(self):
+        expected = {order.pk: Decimal('0') for order in Order.objects.all()}
+        for order_id, subtotal in OrderItem.objects.values_list('order_id', 'subtotal'):
+            expected[order_id] += subtotal
+        self.assertEqual(dict(Order.objects.values_list('pk', 'total_amount')), expected)
+        return expected
+
+    def test_item_writes_keep_the_total(self):
+        first = self.add(self.order, self.products[0], 2)
+        second = self.add(self.order, self.products[1], 1, '5.50')
+        third = self.add(self.other, self.products[2], 3, '4.00')
+        self.assertEqual(self.assertTotalsMatchItems(), {self.order.pk: Decimal('25.50'), self.other.pk: Decimal('12.00')})
+
+        first.quantity = 5
+        first.save()
+        second = OrderItem.objects.get(pk=second.pk)
+        second.order = self.other
+        second.save()
+        self.assertEqual(self.assertTotalsMatchItems()[self.order.pk], Decimal('50.00'))
+
+        OrderItem.objects.filter(order=self.other).update(unit_price=Decimal('1.25'))
+        OrderItem.objects.filter(pk=first.pk).update(order=self.other)
+        self.assertEqual(self.assertTotalsMatchItems()[self.order.pk], Decimal('0.00'))
+
+        items = list(OrderItem.objects.order_by('created_at'))
+        for item in items:
+            item.quantity += 1
+        items[0].order = self.order
+        OrderItem.objects.bulk_update(items, ['quantity', 'order'])
+        OrderItem.objects.bulk_create([OrderItem(order=self.order, product=self.products[1], quantity=2,
+                                                 unit_price=Decimal('3.00'))])
+        self.assertEqual(self.assertTotalsMatchItems()[self.order.pk], Decimal('66.00'))
+
+        third.delete()  # holds the subtotal it was created with
+        OrderItem.objects.filter(pk=second.pk).delete()
+        self.assertTotalsMatchItems()
+
+        self.products[0].delete()  # cascades to its items
+        Product.objects.filter(pk=self.products[1].pk).delete()
+        self.assertEqual(self.assertTotalsMatchItems(), {self.order.pk: Decimal('0.00'), self.other.pk: Decimal('0.00')})
+
+    def test_deleting_an_order_leaves_the_others_alone(self):
+        self.add(self.order, self.products[0], 1)
+        self.add(self.other, self.products[0], 2)
+        self.order.delete()
+        self.assertEqual(self.assertTotalsMatchItems(), {self.other.pk: Decimal('20.00')})
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        self.add(self.order, self.products[0], 2)
+        self.add(self.other, self.products[1], 1)
+        Order.objects.filter(pk=self.order.pk).update(total_amount=Decimal('99.00'))  # bypasses the items
+
+        out = io.StringIO()
+        call_command('reconcile_order_totals', batch_size=1, stdout=out)
+        self.assertIn(f'order {self.order.pk}: stored 99.00, items sum to 20', out.getvalue())
+        self.assertIn('Checked 2 orders', out.getvalue())
+        self.assertIn('1 drifted (total drift 79.00)', out.getvalue())
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total_amount, Decimal('99.00'))
+
+        out = io.StringIO()
+        call_command('reconcile_order_totals', fix=True, stdout=out)
+        self.assertIn('1 drifted (total drift 79.00), 1 fixed', out.getvalue())
+        self.assertTotalsMatchItems()
+
+
+class ReservationTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, self.other = self.create_products(2, images=0)  # 100 units each
+        self.order = Order.objects.create(user=self.user)
+
+    def reserve(self, order, product, quantity, **kwargs):
+        item = OrderItem.objects.create(order=order, product=product, quantity=quantity, unit_price=Decimal('10.00'))
+        return reserve_items(order, [item], **kwargs)
+
+    def stock_quantity(self, product):
+        return Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+
+    def test_an_order_takes_all_of_its_stock_or_none(self):
+        items = [OrderItem(order=self.order, product=self.product, quantity=60),
+                 OrderItem(order=self.order, product=self.other, quantity=101)]
+        with self.assertRaises(InsufficientStock) as raised:
+            reserve_items(self.order, items)
+        self.assertEqual((raised.exception.product_id, raised.exception.requested), (self.other.pk, 101))
+        self.assertEqual((self.stock_quantity(self.product), self.stock_quantity(self.other)), (100, 100))
+        self.assertFalse(StockReservation.objects.exists())
+
+        reserve_items(self.order, [OrderItem(order=self.order, product=self.product, quantity=60),
+                                   OrderItem(order=self.order, product=self.product, quantity=40)])
+        self.assertEqual(self.stock_quantity(self.product), 0)
+        with self.assertRaises(InsufficientStock):
+            self.reserve(self.order, self.product, 1)
+
+    @skipUnless(connection.features.has_select_for_update, 'needs row locks (PostgreSQL)')
+    def test_products_are_locked_in_primary_key_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            reserve_items(self.order, [OrderItem(order=self.order, product=self.other, quantity=1),
+                                       OrderItem(order=self.order, product=self.product, quantity=1)])
+        locking = next(query['sql'] for query in queries.captured_queries if 'FOR UPDATE' in query['sql'])
+        self.assertIn('ORDER BY', locking)
+
+    def test_cancelling_an_order_releases_its_stock_once(self):
+        self.reserve(self.order, self.product, 10)
+        self.order.status = OrderStatus.CANCELLED
+        self.order.save()
+        reservation = StockReservation.objects.get(order=self.order)
+        self.assertEqual(reservation.status, ReservationStatus.RELEASED)
+        self.assertEqual(stock.available([self.product.pk]), {self.product.pk: 100})
+        self.assertEqual(release_reservations(StockReservation.objects.filter(order=self.order)), 0)
+        self.assertEqual(stock.available([self.product.pk]), {self.product.pk: 100})
+
+    def test_expired_reservations_cancel_unpaid_orders(self):
+        self.reserve(self.order, self.product, 5, ttl=timedelta(minutes=-1))
+        paid = Order.objects.create(user=self.user)
+        self.reserve(paid, self.product, 3, ttl=timedelta(minutes=-1))
+        Order.objects.filter(pk=paid.pk).update(status=OrderStatus.PAID)  # paid before the sweep ran
+        fresh = Order.objects.create(user=self.user)
+        self.reserve(fresh, self.other, 2)
+
+        out = io.StringIO()
+        call_command('expire_reservations', stdout=out)
+        self.assertIn('Cancelled 1 unpaid orders; settled 2 expired reservations.', out.getvalue())
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        self.assertEqual((statuses[self.order.pk], statuses[paid.pk], statuses[fresh.pk]),
+                         (OrderStatus.CANCELLED, OrderStatus.PAID, OrderStatus.PENDING))
+        reservations = dict(StockReservation.objects.values_list('order_id', 'status'))
+        self.assertEqual(reservations, {self.order.pk: ReservationStatus.EXPIRED, paid.pk: ReservationStatus.CONSUMED,
+                                        fresh.pk: ReservationStatus.ACTIVE})
+        self.assertEqual(stock.available([self.product.pk, self.other.pk]), {self.product.pk: 97, self.other.pk: 98})
+        self.assertEqual(expire_reservations(), (0, 0))
+
+    def test_stock_changes_start_a_new_product_generation(self):
+        before = generations(['products.product', 'products.category'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reserve(self.order, self.product, 4)
+        after = generations(['products.product', 'products.category'])
+        self.assertNotEqual(after['products.product'], before['products.product'])
+        self.assertEqual(after['products.category'], before['products.category'])
+        # Movements only reach the counters; folding them into stock_quantity is a stock write.
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.record_movement(self.product.pk, 2, StockMovementReason.RESTOCK)
+        self.assertEqual(generations(['products.product', 'products.category']), after)
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.compact_stock()
+        self.assertNotEqual(generations(['products.product']), {'products.product': after['products.product']})
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+
+    def test_concurrent_checkouts_never_oversell(self):
+        result = run_reservation_contention(threads=4, stock=20, attempts_per_thread=10)
+        self.assertFalse(result.oversold)
+        self.assertTrue(result.consistent)
+        self.assertEqual(result.reserved + result.rejected + result.errors, result.attempts)
+        self.assertLessEqual(result.reserved, 20)
+
+
+class CategoryTreeTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.home = Category.objects.create(name='Home')
+        self.kitchen = Category.objects.create(name='Kitchen', parent=self.home)
+        self.knives = Category.objects.create(name='Knives', parent=self.kitchen)
+        self.garden = Category.objects.create(name='Garden', parent=self.home)
+        self.toys = Category.objects.create(name='Toys')
+
+    def position(self, category):
+        return Category.objects.values_list('path', 'depth').get(pk=category.pk)
+
+    def path_of(self, *categories):
+        return ''.join(category.pk.hex + Category.PATH_SEPARATOR for category in categories)
+
+    def test_paths_follow_the_parents(self):
+        self.assertEqual(self.position(self.knives), (self.path_of(self.home, self.kitchen, self.knives), 2))
+        self.assertEqual(set(self.home.get_descendants()), {self.kitchen, self.knives, self.garden})
+        self.assertEqual(set(self.kitchen.get_descendants(include_self=True)), {self.kitchen, self.knives})
+
+    def test_moving_a_category_moves_its_subtree(self):
+        self.kitchen.parent = self.toys
+        self.kitchen.save()
+        self.assertEqual(self.position(self.kitchen), (self.path_of(self.toys, self.kitchen), 1))
+        self.assertEqual(self.position(self.knives), (self.path_of(self.toys, self.kitchen, self.knives), 2))
+        self.assertEqual(set(self.home.get_descendants()), {self.garden})
+
+        kitchen = Category.objects.get(pk=self.kitchen.pk)
+        kitchen.parent = None
+        kitchen.save()
+        self.assertEqual(self.position(self.knives), (self.path_of(self.kitchen, self.knives), 1))
+        self.assertEqual(self.position(self.garden), (self.path_of(self.home, self.garden), 1))
+
+    def test_cycles_are_rejected(self):
+        home = Category.objects.get(pk=self.home.pk)
+        for parent in (self.knives, home):
+            home.parent = parent
+            with self.assertRaises(ValidationError) as raised:
+                home.save()
+            self.assertIn('parent', raised.exception.message_dict)
+        self.assertEqual(Category.objects.get(pk=self.home.pk).parent_id, None)
+        self.assertEqual(self.position(self.knives), (self.path_of(self.home, self.kitchen, self.knives), 2))
+
+    def test_deleting_a_category_turns_its_children_into_roots(self):
+        self.kitchen.delete()
+        knives = Category.objects.get(pk=self.knives.pk)
+        self.assertIsNone(knives.parent_id)
+        self.assertEqual(self.position(knives), (self.path_of(knives), 0))
+        self.assertEqual(set(self.home.get_descendants()), {self.garden})
+
+    def test_rebuild_paths_repairs_bulk_writes(self):
+        Category.objects.filter(pk=self.kitchen.pk).update(parent=self.toys)  # bypasses save()
+        self.assertEqual(Category.objects.rebuild_paths(), 2)
+        self.assertEqual(self.position(self.knives), (self.path_of(self.toys, self.kitchen, self.knives), 2))
+        self.assertEqual(Category.objects.rebuild_paths(), 0)
+
+    def test_products_of_a_whole_subtree(self):
+        for name, category in (('Pan', self.kitchen), ('Chef knife', self.knives), ('Rake', self.garden),
+                               ('Kite', self.toys)):
+            Product.objects.create(name=name, price=Decimal('1.00'), stock_quantity=1, category=category)
+
+        def names(query):
+            response = self.client.get(f'/api/products/?page_size=100&{query}', secure=True)
+            self.assertEqual(response.status_code, 200)
+            return {product['name'] for product in response.data['results']}
+
+        self.assertEqual(names(f'category_tree={self.home.pk}'), {'Pan', 'Chef knife', 'Rake'})
+        self.assertEqual(names(f'category_tree={self.kitchen.pk}'), {'Pan', 'Chef knife'})
+        self.assertEqual(names(f'category={self.kitchen.pk}'), {'Pan'})
+        self.assertEqual(names(f'category_tree={uuid.uuid4()}'), set())
+        self.assertEqual(self.client.get('/api/products/?category_tree=nope', secure=True).status_code, 400)
+
+    def test_tree_endpoint_nests_the_descendants(self):
+        with self.assertNumQueries(2):  # the root, then its whole subtree
+            response = self.client.get(f'/api/categories/{self.home.pk}/tree/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'category_id', 'name', 'description', 'parent', 'created_at', 'children'})
+
+        def shape(node):
+            return node['name'], sorted((shape(child) for child in node['children']))
+
+        self.assertEqual(shape(response.data), ('Home', [('Garden', []), ('Kitchen', [('Knives', [])])]))
+        kitchen = next(child for child in response.data['children'] if child['name'] == 'Kitchen')
+        self.assertEqual(kitchen['parent'], self.home.pk)
+        self.assertEqual(self.client.get(f'/api/categories/{uuid.uuid4()}/tree/', secure=True).status_code, 404)
+
+
+class CatalogCacheTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache_stats.reset()
+        self.addCleanup(cache_stats.reset)
+        self.product, = self.create_products(1, images=1)
+
+    def get(self, path):
+        return self.client.get(path, secure=True)
+
+    def assertRefreshed(self, path='/api/products/'):
+        """The next read misses and the one after it hits again."""
+        response = self.get(path)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(self.get(path)['X-Cache'], 'HIT')
+        return response
+
+    def test_a_repeated_read_is_served_from_the_cache(self):
+        path = f'/api/products/{self.product.pk}/'
+        for url in ('/api/products/', path):
+            first = self.get(url)
+            self.assertEqual(first['X-Cache'], 'MISS')
+            with self.assertNumQueries(0):
+                second = self.get(url)
+            self.assertEqual(second['X-Cache'], 'HIT')
+            self.assertEqual(second['Content-Type'], first['Content-Type'])
+            self.assertEqual(json.loads(second.content), json.loads(first.content))
+        self.assertEqual(self.get('/api/products/?ordering=-price')['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/api/products/?ordering=-price&')['X-Cache'], 'HIT')
+        missing = f'/api/products/{uuid.uuid4()}/'
+        for _ in range(2):
+            response = self.get(missing)  # errors are never cached
+            self.assertEqual(response.status_code, 404)
+            self.assertNotIn('X-Cache', response)
+
+    def test_writes_start_a_new_generation(self):
+        self.assertRefreshed()
+        with self.captureOnCommitCallbacks(execute=True):
+            created = Product.objects.create(name='Fresh', price=Decimal('5.00'), stock_quantity=1,
+                                             category=self.category)
+        self.assertIn('Fresh', self.assertRefreshed().content.decode())
+
+        created.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            created.save()
+        self.assertIn('Renamed', self.assertRefreshed().content.decode())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=created.pk).update(price=Decimal('7.00'))
+        self.assertIn('7.00', self.assertRefreshed().content.decode())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            created.delete()
+        self.assertNotIn('Renamed', self.assertRefreshed().content.decode())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product, image_url='https://example.com/new.jpg')
+        self.assertIn('new.jpg', self.assertRefreshed(f'/api/products/{self.product.pk}/?expand=images').content.decode())
+
+    def test_writes_to_other_models_keep_unrelated_entries(self):
+        self.assertRefreshed('/api/categories/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Product renamed'
+            self.product.save()
+        self.assertEqual(self.get('/api/categories/')['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Books')
+        self.assertIn('Books', self.assertRefreshed('/api/categories/').content.decode())
+
+    def test_replica_reads_are_stored_once_the_replica_caught_up(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.product.pk).update(price=Decimal('7.00'))
+        # The test database stands in for a replica that may not have the new price yet.
+        with self.settings(DATABASE_REPLICAS=[DEFAULT_DB_ALIAS]):
+            for _ in range(2):
+                self.assertEqual(self.get('/api/products/')['X-Cache'], 'MISS')
+            with self.settings(REPLICA_STICKY_SECONDS=0):
+                self.assertRefreshed()
+
+        # The primary has every write, so its reads are stored straight away.
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.product.pk).update(price=Decimal('8.00'))
+        self.assertRefreshed()
+
+    def test_stats_endpoint(self):
+        self.get('/api/products/')
+        self.get('/api/products/')
+        self.get('/api/products/')
+        self.get('/api/categories/')
+        self.assertEqual(self.get('/api/cache/stats/').status_code, 403)
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        response = self.get('/api/cache/stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'hits': 2, 'misses': 2, 'hit_ratio': 0.5,
+            'endpoints': {'product-list': {'hits': 2, 'misses': 1}, 'category-list': {'hits': 0, 'misses': 1}},
+        })
+
+
+class CachedAuthenticationTests(TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        self.factory = RequestFactory()
+        self.authentication = CachedJWTAuthentication()
+        self.user = User.objects.create_user(email='cached@example.com', password='pw', first_name='C', last_name='U')
+
+    def authenticate(self, user, **claims):
+        token = ClaimsTokenObtainPairSerializer.get_token(user).access_token
+        for claim, value in claims.items():
+            token[claim] = value
+        request = self.factory.get('/api/orders/', headers={'Authorization': f'Bearer {token}'})
+        return self.authentication.authenticate(request)[0]
+
+    def test_only_the_first_request_looks_the_user_up(self):
+        with self.assertNumQueries(1):
+            self.authenticate(self.user)
+        with self.assertNumQueries(0):
+            user = self.authenticate(self.user)
+        self.assertEqual((user.pk, user.first_name), (self.user.pk, 'C'))
+        user.first_name = 'Changed'  # each request gets its own copy
+        self.assertEqual(self.authenticate(self.user).first_name, 'C')
+
+    def test_saving_the_user_drops_the_cached_copy(self):
+        self.authenticate(self.user)
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(self.user).first_name, 'Renamed')
+
+        token_user = User.objects.get(pk=self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token_user)
+
+    def test_entries_expire_and_the_least_recently_used_is_evicted(self):
+        others = [User.objects.create_user(email=f'other{i}@example.com', password='pw', first_name='O', last_name='U') for i in range(2)]
+        with override_settings(AUTH_USER_CACHE_TTL=30), \
+                mock.patch('products.authentication.time.monotonic', return_value=1000.0) as clock:
+            self.authenticate(self.user)
+            clock.return_value = 1029.0
+            with self.assertNumQueries(0):
+                self.authenticate(self.user)
+            clock.return_value = 1031.0
+            with self.assertNumQueries(1):
+                self.authenticate(self.user)
+
+        with override_settings(AUTH_USER_CACHE_SIZE=2):
+            self.authenticate(others[0])
+            self.authenticate(self.user)  # now the most recently used
+            self.authenticate(others[1])
+        self.assertEqual(list(user_cache.entries), [str(self.user.pk), str(others[1].pk)])
+
+    @override_settings(JWT_TRUST_USER_CLAIMS=True)
+    def test_trusted_claims_build_a_deferred_user(self):
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        with self.assertNumQueries(0):
+            user = self.authenticate(self.user)
+        self.assertEqual((user.pk, user.role, user.is_active), (self.user.pk, UserRole.ADMIN, True))
+        self.assertIn('email', user.get_deferred_fields())
+        self.assertEqual(Order.objects.create(user=user).user_id, self.user.pk)
+
+        user.first_name = 'Saved'
+        user.save()  # writes only what it holds, not blanks over the rest
+        stored = User.objects.get(pk=self.user.pk)
+        self.assertEqual((stored.email, stored.first_name, stored.last_name), ('cached@example.com', 'Saved', 'U'))
+        self.assertTrue(stored.check_password('pw'))
+        self.assertEqual(user.email, 'cached@example.com')  # read on demand
+
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.user, is_active=False)
+
+
+class ProductExpandTests(CatalogTestMixin, TestCase):
+
+    def get(self, query):
+        return self.client.get('/api/products/' + query, secure=True)
+
+    def test_default_response_is_unchanged(self):
+        self.create_products(1)
+        response = self.get('')
+        self.assertEqual(response.status_code, 200)
+        product = response.data['results'][0]
+        self.assertEqual(product['category'], self.category.pk)
+        self.assertNotIn('images', product)
+
+    def test_expand_images_and_category(self):
+        self.create_products(1)
+        response = self.get('?expand=images,category')
+        self.assertEqual(response.status_code, 200)
+        product = response.data['results'][0]
+        self.assertEqual(product['category']['name'], 'Electronics')
+        self.assertEqual(len(product['images']), 2)
+        self.assertIn('image_url', product['images'][0])
+
+    def test_page_of_products_costs_constant_queries(self):
+        self.create_products(20)
+        # products joined with their category, then one query for every image
+        with self.assertNumQueries(2):
+            response = self.get('?expand=images,category&page_size=20')
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertTrue(all(len(p['images']) == 2 for p in response.data['results']))
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.create_products(20)
+        with self.assertNumQueries(2):
+            self.get('?expand=images,category&page_size=5')
+        cache.clear()
+        with self.assertNumQueries(2):
+            self.get('?expand=images,category&page_size=20')
+
+    def test_retrieve_expands(self):
+        product, = self.create_products(1)
+        with self.assertNumQueries(2):
+            response = self.get(f'{product.pk}/?expand=images,category')
+        self.assertEqual(response.data['category']['category_id'], str(self.category.pk))
+        self.assertEqual(len(response.data['images']), 2)
+
+    def test_unknown_expansion_is_rejected(self):
+        response = self.get('?expand=order_items')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('expand', response.data)
+
+
+class OrderExpandTests(CatalogTestMixin, TestCase):
+
+    def create_orders(self, count, products):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user)
+            for product in products:
+                OrderItem.objects.create(order=order, product=product, quantity=1, unit_price=product.price)
+            Payment.objects.create(order=order, payment_method=PaymentMethod.CREDIT_CARD, amount=order.total_amount)
+
+    def get(self, query):
+        return self.client.get('/api/orders/' + query, secure=True)
+
+    def test_expand_items_products_and_payments(self):
+        self.create_orders(1, self.create_products(2, images=0))
+        response = self.get('?expand=items,items.product,payments')
+        self.assertEqual(response.status_code, 200)
+        order = response.data['results'][0]
+        self.assertEqual(len(order['items']), 2)
+        self.assertEqual(order['items'][0]['product']['category'], self.category.pk)
+        self.assertEqual(len(order['payments']), 1)
+
+    def test_items_without_products_stay_flat(self):
+        product, = self.create_products(1, images=0)
+        self.create_orders(1, [product])
+        response = self.get('?expand=items')
+        self.assertEqual(response.data['results'][0]['items'][0]['product'], product.pk)
+
+    def test_page_of_orders_costs_constant_queries(self):
+        self.create_orders(10, self.create_products(3, images=0))
+        # orders, items, their products, payments
+        with self.assertNumQueries(4):
+            response = self.get('?expand=items,items.product,payments')
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_writes_ignore_expand(self):
+        product, = self.create_products(1, images=0)
+        response = self.client.post('/api/orders/?expand=items', {
+            'user': str(self.user.pk),
+            'items': [{'product': str(product.pk), 'quantity': 1}],
+        }, format='json', secure=True)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertNotIn('items', response.data)
+
+
+class SparseFieldsTests(CatalogTestMixin, TestCase):
+
+    def get(self, path):
+        return self.client.get(path, secure=True)
+
+    def test_fields_prunes_response_and_columns(self):
+        self.create_products(3, images=0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get('/api/products/?fields=product_id,name,price')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data['results'][0]), {'product_id', 'name', 'price'})
+        sql = queries.captured_queries[-1]['sql']
+        self.assertIn('"price"', sql)
+        self.assertNotIn('"description"', sql)
+        self.assertNotIn('"stock_quantity"', sql)
+
+    def test_omit(self):
+        self.create_products(1, images=0)
+        response = self.get('/api/products/?omit=description,created_at,updated_at')
+        self.assertEqual(
+            set(response.data['results'][0]),
+            {'product_id', 'name', 'price', 'stock_quantity', 'category', 'is_active'},
+        )
+
+    def test_cursor_pages_do_not_load_deferred_columns(self):
+        self.create_products(6, images=0)
+        response = self.get('/api/products/?fields=product_id&ordering=-price&page_size=2')
+        with self.assertNumQueries(1):
+            response = self.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_expanded_relation_can_be_omitted(self):
+        self.create_products(2)
+        response = self.get('/api/products/?expand=images,category&fields=name,images')
+        self.assertEqual(set(response.data['results'][0]), {'name', 'images'})
+        self.assertEqual(len(response.data['results'][0]['images']), 2)
+
+    def test_retrieve(self):
+        product, = self.create_products(1, images=0)
+        response = self.get(f'/api/products/{product.pk}/?fields=name')
+        self.assertEqual(response.data, {'name': product.name})
+
+    def test_other_viewsets(self):
+        order = Order.objects.create(user=self.user)
+        response = self.get('/api/orders/?fields=order_id,status')
+        self.assertEqual(response.data['results'], [{'order_id': str(order.pk), 'status': order.status}])
+
+    def test_unknown_field_is_rejected(self):
+        response = self.get('/api/products/?fields=name,colour')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.data)
+
+
+class FastReadTests(CatalogTestMixin, TestCase):
+
+    def assertSameAsSerializer(self, path, serializer_class, queryset):
+        response = self.client.get(path, secure=True)
+        self.assertEqual(response.status_code, 200)
+        expected = serializer_class(queryset, many=True).data
+        self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
+
+    def test_products_match_serializer_output(self):
+        self.create_products(3, images=0)
+        self.assertSameAsSerializer('/api/products/', ProductSerializer, Product.objects.order_by('name'))
+
+    def test_orders_match_serializer_output(self):
+        Order.objects.create(user=self.user)
+        Order.objects.create(user=self.user)
+        self.assertSameAsSerializer('/api/orders/', OrderSerializer, Order.objects.order_by('created_at', 'pk'))
+
+    def test_retrieve_matches_serializer_output(self):
+        product, = self.create_products(1, images=0)
+        response = self.client.get(f'/api/products/{product.pk}/', secure=True)
+        self.assertEqual(JSONRenderer().render(response.data), JSONRenderer().render(ProductSerializer(product).data))
+
+    def test_list_builds_no_model_instances(self):
+        self.create_products(3, images=0)
+        with mock.patch.object(Product, 'from_db', side_effect=AssertionError('model instance built')):
+            response = self.client.get('/api/products/', secure=True)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_missing_object_is_404(self):
+        response = self.client.get(f'/api/products/{uuid.uuid4()}/', secure=True)
+        self.assertEqual(response.status_code, 404)
+
+
+class ExportTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user(
+            email='finance@example.com', password='pw', first_name='F', last_name='N', role='admin',
+        )
+        self.client.force_authenticate(self.admin)
+        product, = self.create_products(1, images=0)
+        for status in ('pending', 'paid', 'paid'):
+            order = Order.objects.create(user=self.user, status=status)
+            OrderItem.objects.create(order=order, product=product, quantity=2, unit_price=product.price)
+
+    def export(self, query):
+        response = self.client.get('/api/exports/' + query, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        lines = self.export('orders/').splitlines()
+        self.assertEqual(len(lines), 3)
+        row = json.loads(lines[0])
+        self.assertEqual(set(row), {'order_id', 'user_id', 'status', 'total_amount', 'created_at', 'updated_at'})
+        self.assertEqual(row['total_amount'], '20.00')
+
+    def test_csv_with_status_filter(self):
+        rows = list(csv.reader(io.StringIO(self.export('order-items/?file_format=csv&status=paid'))))
+        self.assertEqual(rows[0][:3], ['order_item_id', 'order_id', 'product_id'])
+        self.assertEqual(len(rows), 3)
+
+    def test_date_range(self):
+        self.assertEqual(self.export('orders/?end=2000-01-01'), '')
+        self.assertEqual(len(self.export('orders/?start=2000-01-01').splitlines()), 3)
+
+    def test_invalid_parameters(self):
+        response = self.client.get('/api/exports/payments/?status=shipped', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('status', response.data)
+        self.assertEqual(self.client.get('/api/exports/users/', secure=True).status_code, 404)
+
+    def test_admin_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/exports/orders/', secure=True).status_code, 403)
+
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(
+            email='catalog@example.com', password='pw', first_name='C', last_name='M', role='admin',
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def run_import(self, dataset, text, file_format='csv', batch_size=None):
+        return import_rows(dataset, io.StringIO(text), file_format, batch_size)
+
+    def test_categories_with_parents_and_paths(self):
+        report = self.run_import('categories', 'name,description,parent\nPhones,,Electronics\nElectronics,All,\n')
+        self.assertEqual(report.as_dict()['failed'], 0)
+        phones = Category.objects.get(name='Phones')
+        self.assertEqual(phones.parent.name, 'Electronics')
+        self.assertEqual(phones.path, phones.parent.path + phones.pk.hex + '/')
+        self.assertEqual(phones.depth, 1)
+
+    def test_category_cycle_is_rejected(self):
+        self.run_import('categories', 'name,parent\nA,\nB,A\n')
+        report = self.run_import('categories', 'name,parent\nA,B\n')
+        self.assertEqual(report.errors[0]['errors'], {'parent': ['A category cannot be moved under one of its own subcategories.']})
+        self.assertIsNone(Category.objects.get(name='A').parent)
+
+    def test_products_upsert_in_batches_with_row_errors(self):
+        category = Category.objects.create(name='Electronics')
+        existing = Product.objects.create(name='Old', price=Decimal('5.00'), stock_quantity=7, category=category)
+        text = (
+            'product_id,name,price,category_name\n'
+            f'{existing.pk},Renamed,6.50,Electronics\n'
+            ',Phone,100,Electronics\n'
+            ',Cable,-1,Electronics\n'
+            ',Charger,10,Nowhere\n'
+            ',Case,oops,Electronics\n'
+        )
+        # Batch 1: categories, existing keys, an UPDATE of the existing row and an upsert of the
+        # new one (each in a savepoint). Batch 2: categories only.
+        with self.assertNumQueries(9):
+            report = self.run_import('products', text, batch_size=3)
+        self.assertEqual(report.processed, 5)
+        self.assertEqual(report.imported, 2)
+        self.assertEqual([error['line'] for error in report.sorted_errors()], [4, 5, 6])
+        self.assertIn('price', report.sorted_errors()[0]['errors'])
+        self.assertIn('category_name', report.sorted_errors()[1]['errors'])
+        existing.refresh_from_db()
+        # Columns the row does not carry are left alone.
+        self.assertEqual((existing.name, existing.price, existing.stock_quantity), ('Renamed', Decimal('6.50'), 7))
+        self.assertTrue(Product.objects.filter(name='Phone', category=category).exists())
+
+    def test_existing_products_take_partial_rows(self):
+        category = Category.objects.create(name='Electronics')
+        existing = Product.objects.create(name='Phone', price=Decimal('5.00'), stock_quantity=7, category=category)
+        updated_at = existing.updated_at
+        report = self.run_import('products', f'product_id,stock_quantity\n{existing.pk},3\n{uuid.uuid4()},4\n')
+        self.assertEqual(report.imported, 1)
+        # A new row still needs the columns the model requires.
+        self.assertEqual([error['line'] for error in report.sorted_errors()], [3])
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.price, existing.stock_quantity), ('Phone', Decimal('5.00'), 3))
+        self.assertGreater(existing.updated_at, updated_at)
+
+        report = self.run_import('products', json.dumps({'product_id': str(existing.pk), 'is_active': False}) + '\n',
+                                 file_format='ndjson')
+        self.assertEqual(report.as_dict()['failed'], 0)
+        self.assertFalse(Product.objects.get(pk=existing.pk).is_active)
+
+    def test_ndjson_images(self):
+        product = Product.objects.create(
+            name='Phone', price=Decimal('1.00'), category=Category.objects.create(name='Electronics'),
+        )
+        text = (
+            json.dumps({'product': str(product.pk), 'image_url': 'https://example.com/a.jpg'}) + '\n'
+            + json.dumps({'product': str(uuid.uuid4()), 'image_url': 'https://example.com/b.jpg'}) + '\n'
+            + 'not json\n'
+        )
+        report = self.run_import('product-images', text, file_format='ndjson')
+        self.assertEqual(report.imported, 1)
+        self.assertEqual([error['line'] for error in report.sorted_errors()], [2, 3])
+        self.assertEqual(product.images.count(), 1)
+
+    def test_endpoint(self):
+        upload = SimpleUploadedFile('feed.csv', b'name,description\nToys,Fun\n', content_type='text/csv')
+        response = self.client.post('/api/imports/categories/', {'file': upload}, secure=True)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['imported'], 1)
+        self.assertTrue(Category.objects.filter(name='Toys').exists())
+
+    def test_endpoint_is_admin_only(self):
+        self.client.force_authenticate(User.objects.create_user(
+            email='shopper@example.com', password='pw', first_name='S', last_name='H',
+        ))
+        upload = SimpleUploadedFile('feed.csv', b'name\nToys\n')
+        response = self.client.post('/api/imports/categories/', {'file': upload}, secure=True)
+        self.assertEqual(response.status_code, 403)
+
+
+class SalesRollupTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.phone, self.cable = self.create_products(2, images=0)
+
+    def place_order(self, *lines):
+        order = Order.objects.create(user=self.user)
+        for product, quantity in lines:
+            OrderItem.objects.create(order=order, product=product, quantity=quantity, unit_price=product.price)
+        return order
+
+    def rollup(self, product):
+        return SalesRollup.objects.filter(product=product).values_list('units_sold', 'gross_revenue', 'order_count').first()
+
+    def test_paid_orders_are_added_and_cancellations_subtracted(self):
+        first = self.place_order((self.phone, 2), (self.cable, 1))
+        second = self.place_order((self.phone, 1))
+        self.assertFalse(SalesRollup.objects.exists())
+
+        first.status = OrderStatus.PAID
+        first.save()
+        second.status = OrderStatus.PAID
+        second.save()
+        self.assertEqual(self.rollup(self.phone), (3, Decimal('30.00'), 2))
+        self.assertEqual(self.rollup(self.cable), (1, Decimal('10.00'), 1))
+
+        first.status = OrderStatus.SHIPPED
+        first.save()
+        self.assertEqual(self.rollup(self.phone), (3, Decimal('30.00'), 2))
+
+        first.status = OrderStatus.CANCELLED
+        first.save()
+        self.assertEqual(self.rollup(self.phone), (1, Decimal('10.00'), 1))
+        self.assertEqual(self.rollup(self.cable), (0, Decimal('0.00'), 0))
+
+    def test_deleting_a_paid_order(self):
+        order = self.place_order((self.phone, 2))
+        order.status = OrderStatus.PAID
+        order.save()
+        order.delete()
+        self.assertEqual(self.rollup(self.phone), (0, Decimal('0.00'), 0))
+
+    def test_backfill_matches_incremental(self):
+        for quantity in (1, 2, 3):
+            order = self.place_order((self.phone, quantity), (self.cable, 1))
+            order.status = OrderStatus.PAID
+            order.save()
+        self.place_order((self.phone, 5))  # still pending
+        incremental = sorted(SalesRollup.objects.values_list('product_id', 'units_sold', 'gross_revenue', 'order_count'))
+        self.assertEqual(rebuild_rollups(), 2)
+        rebuilt = sorted(SalesRollup.objects.values_list('product_id', 'units_sold', 'gross_revenue', 'order_count'))
+        self.assertEqual(rebuilt, incremental)
+
+    def test_analytics_endpoint_reads_only_rollups(self):
+        order = self.place_order((self.phone, 2), (self.cable, 3))
+        order.status = OrderStatus.PAID
+        order.save()
+        self.user.role = 'admin'
+        self.user.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/analytics/?limit=1', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all('products_orderitem' not in query['sql'] and 'products_order"' not in query['sql']
+                            for query in queries.captured_queries))
+        self.assertEqual(response.data['totals'], {'units': 5, 'revenue': Decimal('50.00')})
+        self.assertEqual(response.data['by_category'][0]['category_name'], 'Electronics')
+        self.assertEqual(len(response.data['top_products']), 1)
+        self.assertEqual(response.data['top_products'][0]['product_id'], self.cable.pk)
+
+    def test_analytics_is_admin_only(self):
+        self.assertEqual(self.client.get('/api/analytics/', secure=True).status_code, 403)
+
+
+class MetricsTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics_registry.reset()
+        self.create_products(6, images=0)
+
+    def test_requests_are_recorded_per_action(self):
+        self.client.get('/api/products/', secure=True)
+        self.client.get('/api/products/', secure=True)
+        self.user.role = 'admin'
+        self.user.save()
+        response = self.client.get('/api/metrics/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('api_request_duration_seconds_count{view="ProductViewSet",action="list"} 2', text)
+        self.assertIn('api_request_queries_bucket{view="ProductViewSet",action="list",le="+Inf"} 2', text)
+        self.assertIn('api_requests_total{view="ProductViewSet",action="list",status="200"} 2', text)
+        self.assertIn('api_response_size_bytes_count{view="ProductViewSet",action="list"} 2', text)
+        self.assertNotIn('api_n_plus_one_total{view="ProductViewSet"', text)
+
+    def test_serializer_time_is_counted_once(self):
+        products = list(Product.objects.all())
+        with collect() as stats:
+            ProductSerializer(products, many=True, expand={'category': {}}).data
+        self.assertGreater(stats.serializer_seconds, 0)
+        self.assertFalse(stats.in_serializer)
+
+    def test_repeated_query_shapes_are_flagged(self):
+        with collect() as stats:
+            names = [product.category.name for product in Product.objects.all()]
+        self.assertEqual(len(names), 6)
+        self.assertEqual(stats.queries, 7)
+        repeated = stats.repeated_queries(threshold=5)
+        self.assertEqual(list(repeated.values()), [6])
+        self.assertIn('products_category', next(iter(repeated)))
+
+        with collect() as stats:
+            list(Product.objects.select_related('category'))
+        self.assertEqual(stats.repeated_queries(threshold=5), {})
+
+    def test_metrics_are_admin_only(self):
+        self.assertEqual(self.client.get('/api/metrics/', secure=True).status_code, 403)
+
+
+class BenchmarkSuiteTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # The search scenario builds the in-process index on databases without full-text search.
+        self.addCleanup(reset_fallback_index)
+        self.counts = seed_catalog(SeedVolumes(users=5, categories=6, depth=3, products=30, images=1, orders=20,
+                                               items=2, addresses=1), seed=7)
+
+    def test_seed_volumes_and_derived_data(self):
+        self.assertEqual(self.counts['users'], 6)
+        self.assertEqual(Product.objects.count(), 30)
+        self.assertEqual(OrderItem.objects.count(), 40)
+        self.assertEqual(set(Category.objects.values_list('depth', flat=True)), {0, 1, 2})
+        totals = dict(Order.objects.values_list('pk', 'total_amount'))
+        Order.objects.recompute_totals()
+        self.assertEqual(dict(Order.objects.values_list('pk', 'total_amount')), totals)
+        self.assertTrue(SalesRollup.objects.exists())
+
+        clear_seed()
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Product.objects.exists())
+
+    def test_every_router_endpoint_has_a_scenario(self):
+        prefixes = {prefix for prefix, _, _ in router.registry}
+        covered = {scenario.path.split('/')[2] for scenario in SCENARIOS}
+        self.assertEqual(prefixes - covered, set())
+
+    def test_scenarios_succeed_and_leave_data_unchanged(self):
+        orders = Order.objects.count()
+        results = run_scenarios(iterations=1, warmup=0)
+        self.assertEqual([result.name for result in results if not result.ok], [])
+        self.assertEqual(Order.objects.count(), orders)
+
+    def test_baseline_comparison(self):
+        result = ScenarioResult('products-list', 10, 200, p50_ms=5.0, p90_ms=6.0, p99_ms=9.0, mean_ms=5.2, queries=2)
+        baseline = {'products-list': dict(result.as_dict(), p50_ms=3.0, queries=1)}
+        self.assertEqual(len(compare([result], baseline, tolerance=0.25)), 2)
+        self.assertEqual(compare([result], {'products-list': result.as_dict()}), [])
+
+
+class QueryPlanTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(reset_fallback_index)
+        seed_catalog(SeedVolumes(users=5, categories=6, products=200, images=1, orders=50, items=2), seed=3)
+
+    def test_read_paths_do_not_scan_large_tables(self):
+        self.assertEqual([str(problem) for problem in check_plans()], [])
+
+    def test_sequential_scans_are_recognised(self):
+        plan = 'Limit\n  ->  Sort\n        ->  Seq Scan on products_order\n  ->  Seq Scan on products_category'
+        self.assertEqual(sequential_scans(plan, 'postgresql', {'products_order'}), ['products_order'])
+        plan = '3 0 0 SCAN products_product USING INDEX product_name_idx\n7 0 0 SCAN products_productimage'
+        self.assertEqual(
+            sequential_scans(plan, 'sqlite', {'products_product', 'products_productimage'}), ['products_productimage'],
+        )
+
+
+class ValidatedSaveTests(CatalogTestMixin, TestCase):
+
+    def test_duplicate_is_reported_like_full_clean(self):
+        duplicate = User(email=self.user.email, first_name='C', last_name='D')
+        duplicate.set_unusable_password()
+        with self.assertRaises(ValidationError) as expected:
+            duplicate.full_clean()
+        with self.assertRaises(ValidationError) as raised, transaction.atomic(), self.assertNumQueries(1):
+            duplicate.save()
+        self.assertEqual(raised.exception.message_dict, expected.exception.message_dict)
+
+    def test_unknown_foreign_key_is_still_rejected(self):
+        with self.assertRaises(ValidationError) as raised:
+            Product(name='Ghost', price=Decimal('1.00'), category_id=uuid.uuid4()).save()
+        self.assertIn('category', raised.exception.message_dict)
+
+    def test_registration_is_one_insert_and_duplicates_keep_their_error(self):
+        payload = {'email': 'new@example.com', 'password': 'pw', 'first_name': 'N', 'last_name': 'U'}
+        client = APIClient()
+        with self.assertNumQueries(1):
+            self.assertEqual(client.post('/api/users/', payload, format='json', secure=True).status_code, 201)
+        with transaction.atomic():
+            response = client.post('/api/users/', payload, format='json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'email': ['user with this email already exists.']})
+
+    def test_writes_skip_validation_queries(self):
+        reset_fallback_index()  # once built, the SQLite-only search index reads back each written product
+        self.user.role = 'admin'
+        self.user.save()
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/categories/', {'name': 'Phones'}, format='json', secure=True)
+        self.assertEqual(response.status_code, 201)
+        # The same counts on PostgreSQL: its search vector is written by the INSERT or UPDATE itself.
+        payload = {'name': 'Phone', 'price': '5.00', 'stock_quantity': 3, 'category': str(self.category.pk)}
+        with self.assertNumQueries(2):  # the category lookup, then the INSERT
+            response = self.client.post('/api/products/', payload, format='json', secure=True)
+        self.assertEqual(response.status_code, 201)
+        product, = self.create_products(1, images=0)
+        # Load the product and update it; the unchanged category is not looked up again.
+        with self.assertNumQueries(2):
+            response = self.client.patch(f'/api/products/{product.pk}/', {'price': '6.00'}, format='json', secure=True)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.patch(f'/api/products/{product.pk}/', {'stock_quantity': -1}, format='json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'stock_quantity': ['Stock quantity cannot be negative.']})
+
+
+class PasswordHashingTests(TestCase):
+
+    def setUp(self):
+        metrics_registry.reset()
+        self.user = User.objects.create_user(email='login@example.com', password='pw-login', first_name='L', last_name='I')
+
+    def test_login_contract(self):
+        response = self.client.post('/api/token/', {'email': 'login@example.com', 'password': 'pw-login'},
+                                    content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {'refresh', 'access'})
+        access = response.json()['access']
+        self.assertEqual(self.client.get('/api/orders/', HTTP_AUTHORIZATION=f'Bearer {access}', secure=True).status_code, 200)
+
+        for credentials in ({'email': 'login@example.com', 'password': 'wrong'}, {'email': 'nobody@example.com', 'password': 'x'}):
+            response = self.client.post('/api/token/', credentials, content_type='application/json', secure=True)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json(), {'detail': 'No active account found with the given credentials'})
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+        response = self.client.post('/api/token/', {'email': 'login@example.com'}, content_type='application/json', secure=True)
+        self.assertEqual(response.json(), {'password': ['This field is required.']})
+
+        text = metrics_registry.render()
+        # The unknown user is hashed too, so all three attempts cost the same.
+        self.assertIn('password_hash_queue_seconds_count{operation="check"} 3', text)
+        self.assertIn('password_hash_seconds_count{operation="check"} 3', text)
+        self.assertIn('api_requests_total{view="AsyncTokenObtainPairView",action="post",status="401"} 2', text)
+
+    async def test_register_then_login(self):
+        payload = {'email': 'async@example.com', 'password': 'pw-async', 'first_name': 'A', 'last_name': 'S',
+                   'role': UserRole.ADMIN}
+        response = await self.async_client.post('/api/register/', payload, content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['email'], 'async@example.com')
+        self.assertEqual(response.json()['role'], UserRole.CUSTOMER)  # nobody registers as an admin
+        self.assertNotIn('password', response.json())
+        user = await User.objects.aget(email='async@example.com')
+        self.assertTrue(user.check_password('pw-async'))
+        self.assertEqual(user.role, UserRole.CUSTOMER)
+        response = await self.async_client.post('/api/token/', {'email': 'async@example.com', 'password': 'pw-async'},
+                                                content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 200)
+
+        # Last: the failed insert breaks the test's transaction.
+        response = await self.async_client.post('/api/register/', payload, content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'email': ['user with this email already exists.']})
+
+    def test_full_queue_is_refused(self):
+        executor = hashing.HashingExecutor(workers=1, queue=0)
+        self.addCleanup(executor.pool.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(hashing, 'executor', executor):
+            executor.submit(hashing.HASH, release.wait)  # takes the only slot
+            response = self.client.post('/api/token/', {'email': 'login@example.com', 'password': 'pw-login'},
+                                        content_type='application/json', secure=True)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            response = APIClient().post('/api/users/', {'email': 'sync@example.com', 'password': 'pw', 'first_name': 'S',
+                                                        'last_name': 'Y'}, format='json', secure=True)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            release.set()
+            response = self.client.post('/api/token/', {'email': 'login@example.com', 'password': 'pw-login'},
+                                        content_type='application/json', secure=True)
+            self.assertEqual(response.status_code, 200)
+        self.assertIn('password_hash_rejected_total{operation="check"} 1', metrics_registry.render())
+        self.assertIn('password_hash_rejected_total{operation="hash"} 1', metrics_registry.render())
+
+    def test_collection_nests(self):
+        with collect() as outer:
+            User.objects.count()
+            with collect() as inner:
+                User.objects.count()
+        self.assertEqual((outer.queries, inner.queries), (2, 1))
+
+
+class AsyncCatalogReadTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(reset_fallback_index)
+        self.products = self.create_products(3)
+        self.token = str(ClaimsTokenObtainPairSerializer.get_token(self.user).access_token)
+        self.factory = AsyncRequestFactory()
+        with self.settings(ASYNC_CATALOG_READS=True):
+            self.list_view = ProductViewSet.as_view({'get': 'list', 'post': 'create'})
+            self.detail_view = ProductViewSet.as_view({'get': 'retrieve', 'delete': 'destroy'})
+
+    def async_get(self, view, query='', **kwargs):
+        request = self.factory.get('/api/products/' + query, headers={'Authorization': f'Bearer {self.token}'}, secure=True)
+        return async_to_sync(view)(request, **kwargs)
+
+    def assertSameAsSync(self, query, view=None, **kwargs):
+        expected = self.client.get('/api/products/' + query, secure=True)
+        cache.clear()
+        response = self.async_get(view or self.list_view, query, **kwargs)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+        return response
+
+    def test_list_and_retrieve_are_async(self):
+        self.assertTrue(iscoroutinefunction(self.list_view))
+        self.assertTrue(iscoroutinefunction(self.detail_view))
+        self.assertEqual(self.list_view.actions, {'get': 'list', 'post': 'create'})
+        with self.settings(ASYNC_CATALOG_READS=False):
+            self.assertFalse(iscoroutinefunction(ProductViewSet.as_view({'get': 'list'})))
+        with self.settings(ASYNC_CATALOG_READS=True):
+            self.assertFalse(iscoroutinefunction(ProductViewSet.as_view({'post': 'create'})))
+
+    def test_list_matches_sync_view(self):
+        other = Category.objects.create(name='Garden')
+        self.products[0].category = other
+        self.products[0].save()
+        for query in ('', '?ordering=-name', '?q=Product 001', '?search=Product', '?fields=id,name',
+                      '?expand=category', f'?category={other.pk}', f'?category_tree={other.pk}', '?is_active=true'):
+            with self.subTest(query=query):
+                self.assertSameAsSync(query)
+
+    def test_cursor_pages_match_sync_view(self):
+        response = self.assertSameAsSync('?page_size=2')
+        next_url = json.loads(response.content)['next']
+        self.assertSameAsSync('?' + next_url.split('?', 1)[1])
+
+    def test_retrieve_matches_sync_view(self):
+        pk = self.products[1].pk
+        self.assertSameAsSync(f'{pk}/', self.detail_view, pk=str(pk))
+        self.assertSameAsSync(f'{uuid.uuid4()}/', self.detail_view, pk=str(uuid.uuid4()))
+
+    def test_authentication_and_other_methods(self):
+        request = self.factory.get('/api/categories/', secure=True, headers={'Authorization': 'Bearer nonsense'})
+        with self.settings(ASYNC_CATALOG_READS=True):
+            view = CategoryViewSet.as_view({'get': 'list'})
+        self.assertEqual(async_to_sync(view)(request).status_code, 401)
+
+        request = self.factory.post('/api/products/', {}, headers={'Authorization': f'Bearer {self.token}'}, secure=True)
+        response = async_to_sync(self.list_view)(request)
+        self.assertEqual(response.status_code, 403)  # create runs on the synchronous view
+
+    def test_catalog_scenarios(self):
+        names = {scenario.name for scenario in catalog_scenarios()}
+        self.assertIn('products-list', names)
+        self.assertFalse(any(name.startswith(('orders', 'auth')) for name in names))
+        with self.assertRaises(LookupError):
+            catalog_scenarios(['orders-list'])
+        results = [ThroughputResult('wsgi', 8, 100, 0, 2.0, 1.0, 2.0), ThroughputResult('asgi', 8, 100, 0, 1.0, 1.0, 2.0)]
+        self.assertEqual(speedups(results), {('wsgi', 8): 1.0, ('asgi', 8): 2.0})
+
+
+@override_settings(DATABASE_REPLICAS=['replica_a', 'replica_b'], REPLICA_STICKY_SECONDS=10)
+class ReplicaRoutingTests(TestCase):
+    """Routing decisions only; the aliases above don't exist, so nothing is read from them."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(email='reader@example.com', password='pw', first_name='R', last_name='E')
+        self.other = User.objects.create_user(email='other@example.com', password='pw', first_name='O', last_name='T')
+
+    def token(self, user):
+        return str(ClaimsTokenObtainPairSerializer.get_token(user).access_token)
+
+    def route(self, method='get', path='/api/products/', user=None, write=False, cookies=None, search=False):
+        """(the databases the view read from, before and after any write; the response)."""
+        request = getattr(self.factory, method)(path, headers={'Authorization': f'Bearer {self.token(user)}'} if user else {})
+        request.COOKIES.update(cookies or {})
+        request.resolver_match = resolve(path)
+        seen = []
+
+        def view(request):
+            if search:
+                uses_postgres(Product)  # what ?q= asks before it reads
+            seen.append(db_router.db_for_read(Product))
+            seen.append(db_router.db_for_read(Product))
+            if write:
+                request.user = user or AnonymousUser()
+                db_router.db_for_write(Product)
+                seen.append(db_router.db_for_read(Product))
+            return HttpResponse()
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen, response
+
+    def test_safe_api_reads_use_one_replica(self):
+        seen, _ = self.route()
+        self.assertIn(seen[0], ('replica_a', 'replica_b'))
+        self.assertEqual(seen[0], seen[1])
+        self.assertEqual(self.route('head', f'/api/categories/{uuid.uuid4()}/')[0][0][:8], 'replica_')
+        # Outside a request everything stays on the primary.
+        self.assertEqual(db_router.db_for_read(Product), DEFAULT_DB_ALIAS)
+
+    def test_writes_and_other_views_use_the_primary(self):
+        self.assertEqual(self.route('post')[0][:2], [DEFAULT_DB_ALIAS] * 2)
+        self.assertEqual(self.route(path='/api/token/')[0][:2], [DEFAULT_DB_ALIAS] * 2)
+        self.assertEqual(self.route(path='/admin/')[0][:2], [DEFAULT_DB_ALIAS] * 2)
+        seen, _ = self.route(user=self.user, write=True)
+        self.assertEqual(seen[2], DEFAULT_DB_ALIAS)  # after writing, the request reads its own write
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.route()[0][0], DEFAULT_DB_ALIAS)
+
+    def test_writer_is_pinned_to_the_primary(self):
+        self.route('post', user=self.user, write=True)
+        self.assertEqual(self.route(user=self.user)[0][0], DEFAULT_DB_ALIAS)
+        self.assertNotEqual(self.route(user=self.other)[0][0], DEFAULT_DB_ALIAS)
+        cache.clear()  # the window has passed
+        self.assertNotEqual(self.route(user=self.user)[0][0], DEFAULT_DB_ALIAS)
+
+        _, response = self.route('post', path='/api/register/', write=True)
+        cookie = response.cookies[PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 10)
+        self.assertEqual(self.route(cookies={PIN_COOKIE: cookie.value})[0][0], DEFAULT_DB_ALIAS)
+        self.assertNotEqual(self.route(cookies={PIN_COOKIE: '1'})[0][0], DEFAULT_DB_ALIAS)
+
+    def test_searches_stay_on_the_replica(self):
+        seen, response = self.route(search=True)
+        self.assertIn(seen[0], ('replica_a', 'replica_b'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        # Through the real view, with the test database standing in for the replica.
+        Product.objects.create(name='Phone', price=Decimal('1.00'), stock_quantity=1,
+                               category=Category.objects.create(name='Electronics'))
+        with self.settings(DATABASE_REPLICAS=[DEFAULT_DB_ALIAS]):
+            response = self.client.get('/api/products/?q=phone', secure=True,
+                                       headers={'Authorization': f'Bearer {self.token(self.user)}'})
+        self.assertEqual([product['name'] for product in response.json()['results']], ['Phone'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.assertNotEqual(self.route(user=self.user)[0][0], DEFAULT_DB_ALIAS)
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'needs DB_REPLICA_HOSTS or a second database alias in DATABASE_REPLICAS')
+class ReplicaDatabaseTests(TestCase):
+    """Against real replica connections (two SQLite files or a Postgres primary and replica)."""
+
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Replicated')
+        self.admin = User.objects.create_user(email='admin@example.com', password='pw', first_name='A', last_name='D',
+                                              role=UserRole.ADMIN)
+        self.user = User.objects.create_user(email='shopper@example.com', password='pw', first_name='S', last_name='H')
+
+    def queries_by_alias(self, method, user, path='/api/products/', **data):
+        token = str(ClaimsTokenObtainPairSerializer.get_token(user).access_token)
+        contexts = {alias: CaptureQueriesContext(connections[alias]) for alias in self.databases}
+        for context in contexts.values():
+            context.__enter__()
+        try:
+            response = getattr(self.client, method)(path, data, content_type='application/json', secure=True,
+                                                    HTTP_AUTHORIZATION=f'Bearer {token}')
+        finally:
+            for context in contexts.values():
+                context.__exit__(None, None, None)
+        self.assertLess(response.status_code, 300)
+        return {alias for alias, context in contexts.items() if len(context)}
+
+    def test_reads_follow_writes(self):
+        # Trusting the claims keeps user lookups, which replicas might not have the rows for, out of the picture.
+        with self.settings(JWT_TRUST_USER_CLAIMS=True, CATALOG_CACHE_TIMEOUT=0):
+            self.assertLessEqual(self.queries_by_alias('get', self.user), set(settings.DATABASE_REPLICAS))
+            self.assertEqual(self.queries_by_alias('post', self.admin, name='New', price='1.00', stock_quantity=1,
+                                                   category=str(self.category.pk)), {DEFAULT_DB_ALIAS})
+            self.assertEqual(self.queries_by_alias('get', self.admin), {DEFAULT_DB_ALIAS})
+            self.assertLessEqual(self.queries_by_alias('get', self.user), set(settings.DATABASE_REPLICAS))
+
+
+@override_settings(PAYMENT_SETTLEMENT_MAX_ATTEMPTS=3, PAYMENT_SETTLEMENT_RETRY_DELAY=timedelta(seconds=30))
+class SettlementTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        metrics_registry.reset()
+        product, = self.create_products(1, images=0)
+        self.orders = [Order.objects.create(user=self.user) for _ in range(3)]
+        for order in self.orders:
+            reserve_items(order, [OrderItem.objects.create(order=order, product=product, quantity=2,
+                                                           unit_price=Decimal('10.00'))])
+        self.payments = [
+            Payment.objects.create(order=order, amount=Decimal('20.00'), payment_method=PaymentMethod.PAYPAL)
+            for order in self.orders
+        ]
+
+    def settle(self, gateway, **options):
+        return settlement.settle_payments(gateway, backoff=0, **options)
+
+    def test_captured_payments_complete_and_pay_their_orders(self):
+        gateway = settlement.FakeGateway(decline={self.payments[2].transaction_id})
+        with CaptureQueriesContext(connection) as queries:
+            stats = self.settle(gateway, batch_size=10)
+        self.assertEqual((stats.claimed, stats.completed, stats.failed, stats.orders_paid), (3, 2, 1, 2))
+        statuses = dict(Payment.objects.values_list('pk', 'payment_status'))
+        self.assertEqual([statuses[p.pk] for p in self.payments], ['completed', 'completed', 'failed'])
+        self.assertEqual(Payment.objects.get(pk=self.payments[2].pk).last_error, 'Card declined.')
+        self.assertEqual([Order.objects.get(pk=o.pk).status for o in self.orders], ['paid', 'paid', 'pending'])
+        self.assertEqual(set(Payment.objects.values_list('lease_token', flat=True)), {''})
+        # order_status_changed went out: the paid orders' stock is consumed.
+        self.assertEqual(StockReservation.objects.filter(status=ReservationStatus.CONSUMED).count(), 2)
+        self.assertEqual(set(gateway.captured), {self.payments[0].transaction_id, self.payments[1].transaction_id})
+        self.assertEqual(self.settle(gateway).claimed, 0)
+
+        text = metrics_registry.render()
+        self.assertIn('payments_settled_total{outcome="completed"} 2', text)
+        self.assertIn('payment_gateway_seconds_count{outcome="declined"} 1', text)
+
+        # A batch costs the same number of queries however many payments it holds.
+        more = Order.objects.create(user=self.user)
+        Payment.objects.bulk_create([
+            Payment(order=more, amount=Decimal('1.00'), payment_method=PaymentMethod.PAYPAL, transaction_id=str(i))
+            for i in range(20)
+        ] + [Payment(order=self.orders[2], amount=Decimal('1.00'), payment_method=PaymentMethod.PAYPAL,
+                     transaction_id='extra')])
+        with CaptureQueriesContext(connection) as more_queries:
+            self.settle(settlement.FakeGateway(decline={'0'}), batch_size=50)
+        self.assertEqual(len(more_queries), len(queries))
+
+    def test_transient_errors_are_retried_then_rescheduled_then_failed(self):
+        first, second, _ = self.payments
+        gateway = settlement.FakeGateway(flaky={first.transaction_id: 2, second.transaction_id: 100})
+        stats = self.settle(gateway)
+        self.assertEqual((stats.completed, stats.retried), (2, 1))  # two retries were enough for the first
+        second.refresh_from_db()
+        self.assertEqual((second.payment_status, second.attempts, second.last_error),
+                         ('pending', 1, 'Gateway unavailable.'))
+        self.assertGreater(second.next_attempt_at, timezone.now() + timedelta(seconds=25))
+
+        for attempt, delay in ((2, 60), (3, None)):
+            Payment.objects.filter(pk=second.pk).update(next_attempt_at=timezone.now())
+            self.settle(gateway)
+            second.refresh_from_db()
+            self.assertEqual(second.attempts, attempt)
+            if delay:
+                self.assertGreater(second.next_attempt_at, timezone.now() + timedelta(seconds=delay - 5))
+        self.assertEqual(second.payment_status, PaymentStatus.FAILED)
+        self.assertEqual(Order.objects.get(pk=second.order_id).status, OrderStatus.PENDING)
+
+    def test_claims_are_exclusive_until_the_lease_runs_out(self):
+        token_a, claimed_a = settlement.claim_payments(2)
+        token_b, claimed_b = settlement.claim_payments(2)
+        self.assertEqual((len(claimed_a), len(claimed_b)), (2, 1))
+        self.assertFalse({c.payment_id for c in claimed_a} & {c.payment_id for c in claimed_b})
+        self.assertEqual(settlement.claim_payments(10)[1], [])
+
+        # Worker A stalls past its lease; C takes its payments over and A's late results are ignored.
+        later = timezone.now() + timedelta(minutes=6)
+        token_c, claimed_c = settlement.claim_payments(10, now=later)
+        self.assertEqual({c.payment_id for c in claimed_c}, {c.payment_id for c in claimed_a + claimed_b})
+        stats = settlement.record_outcomes(token_a, claimed_a, [(settlement.DECLINED, 'Late.')] * 2)
+        self.assertEqual(stats.failed, 0)
+        self.assertFalse(Payment.objects.exclude(payment_status=PaymentStatus.PENDING).exists())
+        stats = settlement.record_outcomes(token_a, claimed_a, [(settlement.COMPLETED, '')] * 2)
+        self.assertEqual((stats.completed, stats.orders_paid), (0, 0))
+        self.assertFalse(Payment.objects.exclude(payment_status=PaymentStatus.PENDING).exists())
+        self.assertFalse(Order.objects.exclude(status=OrderStatus.PENDING).exists())
+        stats = settlement.record_outcomes(token_c, claimed_c, [(settlement.COMPLETED, '')] * 3)
+        self.assertEqual((stats.completed, stats.orders_paid), (3, 3))
+        self.assertEqual({c.attempt for c in claimed_c}, {2})
+
+    def test_gateway_calls_run_concurrently_and_cancelled_orders_are_not_charged(self):
+        for order in self.orders[1:]:
+            Payment.objects.bulk_create([
+                Payment(order=order, amount=Decimal('1.00'), payment_method=PaymentMethod.PAYPAL,
+                        transaction_id=str(uuid.uuid4()))
+                for _ in range(5)
+            ])
+        self.orders[0].status = OrderStatus.CANCELLED
+        self.orders[0].save()
+        gateway = settlement.FakeGateway(latency=0.01)
+        stats = self.settle(gateway, concurrency=4)
+        self.assertEqual((stats.claimed, stats.completed, stats.failed), (12, 12, 1))
+        self.assertEqual(gateway.max_in_flight, 4)
+        self.assertNotIn(self.payments[0].transaction_id, gateway.captured)
+        self.assertEqual(Payment.objects.get(pk=self.payments[0].pk).payment_status, PaymentStatus.FAILED)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('settle_payments', gateway='products.settlement.FakeGateway', stdout=out)
+        self.assertIn('Claimed 3 payments: 3 completed, 0 failed, 0 rescheduled; 3 orders paid', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('settle_payments', stdout=io.StringIO())
+
+
+@override_settings(PRODUCT_IMAGE_WORKERS=0, PRODUCT_IMAGE_WIDTHS=(160, 320, 1280), PRODUCT_IMAGE_FORMAT='WEBP')
+class ImageUploadTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.admin = User.objects.create_user(email='admin@example.com', password='pw', first_name='A',
+                                              last_name='D', role=UserRole.ADMIN)
+        self.client.force_authenticate(self.admin)
+        self.product, self.other = self.create_products(2, images=0)
+
+    def png(self, width=800, height=600, color=(200, 40, 40)):
+        output = io.BytesIO()
+        Image.new('RGB', (width, height), color).save(output, 'PNG')
+        return SimpleUploadedFile('photo.png', output.getvalue(), content_type='image/png')
+
+    def upload(self, product, upload, execute=True):
+        with self.captureOnCommitCallbacks(execute=execute):
+            return self.client.post('/api/product-images/', {'product': str(product.pk), 'image': upload,
+                                                             'alt_text': 'Front'}, format='multipart', secure=True)
+
+    def test_upload_stores_original_and_makes_variants_after_commit(self):
+        response = self.upload(self.product, self.png())
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['variants'], {})  # made once the upload committed
+        self.assertNotIn('image', response.data)
+        asset = ImageAsset.objects.get()
+        self.assertEqual((asset.status, asset.width, asset.height, asset.content_type),
+                         (ImageAssetStatus.READY, 800, 600, 'image/png'))
+        self.assertTrue(response.data['image_url'].endswith(asset.original.url))
+
+        variants = self.client.get(f'/api/product-images/{response.data["image_id"]}/', secure=True).data['variants']
+        self.assertEqual(list(variants), ['160', '320', '800'])  # nothing wider than the original
+        original_size = default_storage.size(asset.original.name)
+        for width, url in variants.items():
+            name = url.removeprefix(settings.MEDIA_URL)
+            with default_storage.open(name) as stored, Image.open(stored) as image:
+                self.assertEqual((image.format, image.width), ('WEBP', int(width)))
+            self.assertLess(default_storage.size(name), original_size)
+
+    def test_same_file_is_stored_and_processed_once(self):
+        content = self.png().read()
+        first = self.upload(self.product, SimpleUploadedFile('a.png', content, content_type='image/png'))
+        with mock.patch('products.images.make_variants') as make_variants:
+            second = self.upload(self.other, SimpleUploadedFile('b.png', content, content_type='image/png'))
+        make_variants.assert_not_called()
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(ImageAsset.objects.count(), 1)
+        self.assertEqual(second.data['image_url'], first.data['image_url'])
+        self.assertEqual(list(second.data['variants']), ['160', '320', '800'])  # ready already
+        self.assertEqual(len(default_storage.listdir(f'product-images/{ImageAsset.objects.get().sha256}')[1]), 4)
+
+    def test_row_created_while_asset_is_pending_catches_up(self):
+        content = self.png().read()
+        self.upload(self.product, SimpleUploadedFile('a.png', content, content_type='image/png'), execute=False)
+        asset = ImageAsset.objects.get()
+        self.assertEqual(asset.status, ImageAssetStatus.PENDING)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/api/product-images/', {
+                'product': str(self.other.pk), 'image': SimpleUploadedFile('b.png', content, content_type='image/png'),
+            }, format='multipart', secure=True)
+        self.assertEqual(response.data['variants'], {})
+        # The worker finishes before the second row commits, so its copy misses that row.
+        images.process_asset(asset.pk)
+        ProductImage.objects.filter(pk=response.data['image_id']).update(variants={})
+        for callback in callbacks:
+            callback()
+        self.assertEqual(list(ProductImage.objects.get(pk=response.data['image_id']).variants), ['160', '320', '800'])
+
+    def test_rejects_files_that_are_not_images(self):
+        upload = SimpleUploadedFile('notes.png', b'not an image at all', content_type='image/png')
+        response = self.upload(self.product, upload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+        self.assertFalse(ImageAsset.objects.exists())
+        with override_settings(PRODUCT_IMAGE_MAX_BYTES=100):
+            self.assertEqual(self.upload(self.product, self.png()).status_code, 400)
+
+    def test_process_images_retries_pending_and_failed_assets(self):
+        with mock.patch('products.images.make_variants', side_effect=OSError('disk full')), \
+                self.assertLogs('products.images', 'ERROR'):
+            self.upload(self.product, self.png())
+        asset = ImageAsset.objects.get()
+        self.assertEqual((asset.status, asset.error), (ImageAssetStatus.FAILED, 'disk full'))
+        out = io.StringIO()
+        call_command('process_images', stdout=out)
+        self.assertIn('Processed 1 images; 0 failed.', out.getvalue())
+        self.assertEqual(ImageAsset.objects.get().status, ImageAssetStatus.READY)
+        self.assertEqual(list(ProductImage.objects.get().variants), ['160', '320', '800'])
+
+    def test_relinking_by_url_drops_the_variants(self):
+        image_id = self.upload(self.product, self.png()).data['image_id']
+        response = self.client.patch(f'/api/product-images/{image_id}/', {'image_url': 'https://example.com/x.jpg'},
+                                     format='json', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['variants'], {})
+        self.assertIsNone(ProductImage.objects.get().asset)
+
+    def test_list_matches_serializer_output(self):
+        self.upload(self.product, self.png())
+        ProductImage.objects.create(product=self.other, image_url='https://example.com/linked.jpg')
+        response = self.client.get('/api/product-images/', secure=True)
+        expected = ProductImageSerializer(ProductImage.objects.order_by('created_at'), many=True).data
+        self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
+        self.assertEqual(list(response.data['results'][0]['variants']), ['160', '320', '800'])
+
+
+class OrderTransitionTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, = self.create_products(1, images=0)
+        self.admin = User.objects.create_user(email='admin@example.com', password='pw', first_name='A',
+                                              last_name='D', role=UserRole.ADMIN)
+
+    def place_orders(self, count, status=OrderStatus.PENDING):
+        orders = []
+        for _ in range(count):
+            order = Order.objects.create(user=self.user)
+            reserve_items(order, [OrderItem.objects.create(order=order, product=self.product, quantity=1,
+                                                           unit_price=Decimal('10.00'))])
+            if status != OrderStatus.PENDING:
+                Order.objects.filter(pk=order.pk).update(status=status)
+            orders.append(order)
+        return orders
+
+    def transition(self, **body):
+        self.client.force_authenticate(self.admin)
+        return self.client.post('/api/orders/transition/', body, format='json', secure=True)
+
+    def test_save_refuses_changes_outside_the_graph(self):
+        order, = self.place_orders(1)
+        order.status = OrderStatus.SHIPPED
+        with self.assertRaises(ValidationError) as raised:
+            order.save()
+        self.assertEqual(raised.exception.message_dict['status'], ['An order cannot go from pending to shipped.'])
+        for status in (OrderStatus.PAID, OrderStatus.SHIPPED, OrderStatus.DELIVERED):
+            order.status = status
+            order.save()
+        order.status = OrderStatus.CANCELLED
+        with self.assertRaises(ValidationError):
+            order.save()
+
+    def test_api_refuses_invalid_transitions_and_new_orders_that_are_not_pending(self):
+        order, = self.place_orders(1, OrderStatus.DELIVERED)
+        response = self.client.patch(f'/api/orders/{order.pk}/', {'status': 'paid'}, format='json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('status', response.data)
+        response = self.client.post('/api/orders/', {'user': str(self.user.pk), 'status': 'paid'}, format='json',
+                                    secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['status'], ['New orders are pending.'])
+
+    def test_bulk_transition_by_filter_counts_changed_and_skipped(self):
+        paid = self.place_orders(3, OrderStatus.PAID)
+        self.place_orders(2)
+        self.place_orders(1, OrderStatus.DELIVERED)
+        response = self.transition(status='shipped', start=(timezone.now() - timedelta(days=1)).isoformat())
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data, {'status': 'shipped', 'changed': 3, 'skipped': 3,
+                                         'skipped_by_status': {'pending': 2, 'delivered': 1}, 'not_found': 0})
+        self.assertEqual(set(Order.objects.filter(status=OrderStatus.SHIPPED).values_list('pk', flat=True)),
+                         {order.pk for order in paid})
+
+    def test_bulk_transition_by_ids_sends_status_changes(self):
+        pending = self.place_orders(3)
+        missing = uuid.uuid4()
+        response = self.transition(status='paid', order_ids=[str(order.pk) for order in pending[:2]] + [str(missing)])
+        self.assertEqual(response.data['changed'], 2)
+        self.assertEqual(response.data['not_found'], 1)
+        # Reservations and sales rollups followed the paid orders.
+        self.assertEqual(StockReservation.objects.filter(status=ReservationStatus.CONSUMED).count(), 2)
+        self.assertEqual(SalesRollup.objects.get().units_sold, 2)
+        response = self.transition(status='cancelled', from_status='pending')
+        self.assertEqual((response.data['changed'], response.data['skipped']), (1, 0))
+        self.assertEqual(StockReservation.objects.filter(status=ReservationStatus.RELEASED).count(), 1)
+
+    def test_queries_per_chunk_do_not_grow_with_the_chunk(self):
+        def queries_for(count):
+            orders = self.place_orders(count, OrderStatus.PAID)
+            with CaptureQueriesContext(connection) as queries:
+                self.transition(status='shipped', order_ids=[str(order.pk) for order in orders])
+            return len(queries)
+
+        self.assertEqual(queries_for(2), queries_for(20))
+        with override_settings(ORDER_TRANSITION_CHUNK_SIZE=5):
+            self.place_orders(12, OrderStatus.PAID)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.transition(status='shipped', from_status='paid')
+        self.assertEqual(response.data['changed'], 12)
+        self.assertEqual(sum('UPDATE "products_order"' in query['sql'] for query in queries.captured_queries), 3)
+
+    def test_chunks_by_ids_name_only_their_own_ids(self):
+        orders = self.place_orders(12, OrderStatus.PAID)
+        ids = [order.pk for order in orders] + [uuid.uuid4()]
+        with override_settings(ORDER_TRANSITION_CHUNK_SIZE=5):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.transition(status='shipped', order_ids=[str(pk) for pk in ids])
+        self.assertEqual((response.data['changed'], response.data['not_found']), (12, 1))
+        named = [sum(pk.hex in query['sql'] for pk in ids) for query in queries.captured_queries]
+        self.assertEqual(max(named), 5)
+
+    def test_refuses_targets_without_sources_and_non_admins(self):
+        response = self.transition(status='pending', from_status='paid')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.transition(status='paid').status_code, 400)  # neither ids nor filters
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/orders/transition/', {'status': 'shipped', 'from_status': 'paid'},
+                                    format='json', secure=True)
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(STOCK_COUNTER_SHARDS=4)
+class StockCounterTests(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, self.other = self.create_products(2, images=0)  # 100 units each
+
+    def stock_quantity(self, product):
+        return Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk)
+
+    def test_movements_are_spread_over_the_shards_and_counted_as_available(self):
+        with mock.patch('products.stock.random.randrange', side_effect=[0, 1, 2, 2]):
+            for quantity in (5, 3, 2):
+                stock.record_movement(self.product.pk, quantity, StockMovementReason.RESTOCK)
+            stock.record_movement(self.product.pk, -4, StockMovementReason.ADJUSTMENT)
+        shards = dict(StockCounterShard.objects.filter(product=self.product).values_list('shard', 'delta'))
+        self.assertEqual(shards, {0: 5, 1: 3, 2: -2, 3: 0})
+        self.assertEqual(StockMovement.objects.filter(product=self.product).count(), 4)
+        self.assertEqual(self.stock_quantity(self.product), 100)  # the product row was not touched
+        with self.assertNumQueries(1):
+            self.assertEqual(stock.available([self.product.pk, self.other.pk]), {self.product.pk: 106,
+                                                                                   self.other.pk: 100})
+
+    def test_compaction_folds_the_counters_and_keeps_the_ledger(self):
+        stock.record_movements({self.product.pk: 7, self.other.pk: 2}, StockMovementReason.RETURN)
+        self.assertEqual(stock.compact_stock(batch_size=1), 2)
+        self.assertEqual((self.stock_quantity(self.product), self.stock_quantity(self.other)), (107, 102))
+        self.assertFalse(StockCounterShard.objects.exclude(delta=0).exists())
+        self.assertEqual(StockMovement.objects.count(), 2)
+        self.assertEqual(stock.available([self.product.pk]), {self.product.pk: 107})
+        self.assertEqual(stock.compact_stock(), 0)
+
+    def test_compaction_leaves_movements_made_while_it_ran(self):
+        stock.record_movement(self.product.pk, 5)
+        per_row = stock._per_row
+
+        def move_meanwhile(values):
+            if not StockMovement.objects.filter(quantity=1).exists():
+                stock.record_movement(self.product.pk, 1)
+            return per_row(values)
+
+        with mock.patch('products.stock._per_row', side_effect=move_meanwhile):
+            stock.compact_stock()
+        self.assertEqual(self.stock_quantity(self.product), 105)
+        self.assertEqual(stock.available([self.product.pk]), {self.product.pk: 106})
+
+    def test_released_reservations_return_stock_through_the_ledger(self):
+        order = Order.objects.create(user=self.user)
+        reserve_items(order, [OrderItem.objects.create(order=order, product=self.product, quantity=10,
+                                                       unit_price=Decimal('10.00'))])
+        order.status = OrderStatus.CANCELLED
+        order.save()
+        self.assertEqual(self.stock_quantity(self.product), 90)
+        self.assertEqual(stock.available([self.product.pk]), {self.product.pk: 100})
+        self.assertEqual(list(StockMovement.objects.values_list('reason', 'quantity')), [('release', 10)])
+
+    def test_checkout_folds_the_counters_before_refusing(self):
+        Product.objects.filter(pk=self.product.pk).update(stock_quantity=2)
+        stock.record_movement(self.product.pk, 3, StockMovementReason.RESTOCK)
+        order = Order.objects.create(user=self.user)
+        reserve_items(order, [OrderItem.objects.create(order=order, product=self.product, quantity=4,
+                                                       unit_price=Decimal('10.00'))])
+        self.assertEqual(self.stock_quantity(self.product), 1)
+        with self.assertRaises(InsufficientStock):
+            reserve_items(order, [OrderItem(order=order, product=self.product, quantity=2)])
+
+    def test_availability_and_stock_endpoints(self):
+        stock.record_movement(self.product.pk, 4, StockMovementReason.RETURN)
+        response = self.client.get(f'/api/products/availability/?ids={self.product.pk},{uuid.uuid4()}', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'results': [{'product_id': self.product.pk, 'available': 104}]})
+        self.assertEqual(self.client.get('/api/products/availability/?ids=nope', secure=True).status_code, 400)
+
+        path = f'/api/products/{self.product.pk}/stock/'
+        self.assertEqual(self.client.post(path, {'quantity': 5}, format='json', secure=True).status_code, 403)
+        self.user.role = UserRole.ADMIN
+        self.user.save()
+        response = self.client.post(path, {'quantity': 5}, format='json', secure=True)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['available'], 109)
+        response = self.client.post(path, {'quantity': -5, 'reason': 'restock'}, format='json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stock_quantity(self.product), 100)
+
+    def test_compact_stock_command(self):
+        stock.record_movement(self.product.pk, 6)
+        out = io.StringIO()
+        call_command('compact_stock', stdout=out)
+        self.assertIn('Compacted the stock counters of 1 products.', out.getvalue())
+        self.assertEqual(self.stock_quantity(self.product), 106)
+
+
+@skipUnless(connection.features.has_select_for_update, 'needs row locks (PostgreSQL)')
+@override_settings(STOCK_COUNTER_SHARDS=4)
+class ConcurrentCompactionTests(TransactionTestCase):
+
+    def test_concurrent_compactions_fold_each_movement_once(self):
+        category = Category.objects.create(name='Hot')
+        product = Product.objects.create(name='Hot item', price=Decimal('1.00'), stock_quantity=10, category=category)
+        stock.record_movement(product.pk, 5, StockMovementReason.RESTOCK)
+        first_locked = threading.Event()
+        per_row = stock._per_row
+
+        def slow_first_fold(values):
+            if threading.current_thread().name == 'first' and not first_locked.is_set():
+                first_locked.set()
+                time.sleep(0.5)  # the second compaction starts while this one holds the counters
+            return per_row(values)
+
+        def compact(wait=None):
+            try:
+                if wait is not None:
+                    wait.wait(5)
+                stock.compact_stock([product.pk])
+            finally:
+                connection.close()
+
+        with mock.patch('products.stock._per_row', side_effect=slow_first_fold):
+            threads = [threading.Thread(target=compact, name='first'),
+                       threading.Thread(target=compact, args=(first_locked,), name='second')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(Product.objects.values_list('stock_quantity', flat=True).get(pk=product.pk), 15)
+        self.assertEqual(set(StockCounterShard.objects.values_list('delta', flat=True)), {0})
+        self.assertEqual(stock.available([product.pk]), {product.pk: 15})
@@ -0,0 +1,107 @@
+"""
+Moving many orders to a new status at once.
+
+Orders follow ORDER_TRANSITIONS (products/models.py): pending -> paid ->
+shipped -> delivered, and cancelled from pending, paid or shipped.
+Order.save() refuses any other change of one order. `transition_orders`
+applies one transition to a whole set of orders, for example every paid order
+placed yesterday, without loading them as model instances or saving them one
+by one.
+
+The set is walked in primary key order, `ORDER_TRANSITION_CHUNK_SIZE` orders at
+a time; explicit order ids are sorted and sliced first, so every statement
+names at most one chunk of them. Each chunk is one transaction:
+
+1. the chunk's ids and current statuses are read and locked
+   (`SELECT ... FOR UPDATE` on PostgreSQL);
+2. one `UPDATE ... WHERE order_id IN (...) AND status IN (...)` moves the
+   orders whose status may go to the new one;
+3. `order_status_changed` is sent once per previous status, so stock
+   reservations and sales rollups follow in set-based statements as well.
+
+Orders in any other status are left alone and counted as skipped, per
+status. The number of queries per chunk does not depend on its size.
+"""
+from collections import Counter
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, OrderStatus, order_status_changed, order_status_sources
+
+
+@dataclass
+class TransitionResult:
+    status: str
+    changed: int = 0
+    skipped_by_status: Counter = field(default_factory=Counter)
+    not_found: int = 0
+
+    @property
+    def skipped(self):
+        return sum(self.skipped_by_status.values())
+
+    def as_dict(self):
+        return {
+            'status': self.status, 'changed': self.changed, 'skipped': self.skipped,
+            'skipped_by_status': dict(self.skipped_by_status), 'not_found': self.not_found,
+        }
+
+
+def chunk_size():
+    return getattr(settings, 'ORDER_TRANSITION_CHUNK_SIZE', 1000)
+
+
+def transition_orders(orders, status, order_ids=None, batch_size=None, now=None):
+    """
+    Move the orders of the `orders` queryset (only those in `order_ids`, when
+    given) to `status` where the transition is allowed. Returns a
+    TransitionResult; ids in `order_ids` that match no order count as not found.
+    """
+    if status not in OrderStatus.values:
+        raise ValueError(f'Unknown order status {status!r}.')
+    sources = order_status_sources(status)
+    if not sources:
+        raise ValueError(f'No order can be moved to {status}.')
+    batch_size = batch_size or chunk_size()
+    now = now or timezone.now()
+    orders = orders.order_by('pk')
+    result = TransitionResult(status=status)
+
+    if order_ids is not None:
+        # Each chunk names only its own ids, so no statement grows with the whole set.
+        order_ids = sorted(set(order_ids))
+        for start in range(0, len(order_ids), batch_size):
+            ids = order_ids[start:start + batch_size]
+            rows = transition_chunk(orders.filter(pk__in=ids), status, sources, now, result)
+            result.not_found += len(ids) - len(rows)
+        return result
+
+    last = None
+    while True:
+        chunk = orders if last is None else orders.filter(pk__gt=last)
+        rows = transition_chunk(chunk[:batch_size], status, sources, now, result)
+        if len(rows) < batch_size:
+            return result
+        last = rows[-1][0]
+
+
+def transition_chunk(chunk, status, sources, now, result):
+    """Lock and move one chunk of orders in a transaction, counting into `result`; returns its (pk, status) rows."""
+    with transaction.atomic():
+        rows = list(chunk.select_for_update(of=('self',)).values_list('pk', 'status'))
+        moving = {}
+        for pk, previous in rows:
+            if previous in sources:
+                moving.setdefault(previous, []).append(pk)
+            else:
+                result.skipped_by_status[previous] += 1
+        if moving:
+            result.changed += Order.objects.filter(
+                pk__in=[pk for ids in moving.values() for pk in ids], status__in=sources,
+            ).update(status=status, updated_at=now)
+            for previous, ids in moving.items():
+                order_status_changed.send(sender=Order, order_ids=ids, previous=previous, status=status)
+    return rows
@@ -3,9 +3,10 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     UserViewSet, CategoryViewSet, ProductViewSet,
     ProductImageViewSet, OrderViewSet, OrderItemViewSet,
-    PaymentViewSet, AddressViewSet
+    PaymentViewSet, AddressViewSet, CatalogCacheStatsView, ExportView, ImportView, AnalyticsView, MetricsView,
+    AsyncTokenObtainPairView, AsyncRegisterView,
 )
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenRefreshView
 
 router = DefaultRouter()
 router.register('users', UserViewSet)
@@ -19,6 +20,12 @@ router.register('addresses', AddressViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/', AsyncTokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('register/', AsyncRegisterView.as_view(), name='register'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('cache/stats/', CatalogCacheStatsView.as_view(), name='catalog_cache_stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('exports/<str:dataset>/', ExportView.as_view(), name='export'),
+    path('imports/<str:dataset>/', ImportView.as_view(), name='import'),
+    path('analytics/', AnalyticsView.as_view(), name='analytics'),
 ]
\ No newline at end of file
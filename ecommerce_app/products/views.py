@@ -1,16 +1,43 @@
 from django.shortcuts import render
-from .models import User, Category, Product, ProductImage, Order, OrderItem, Payment, Address
-from .serializers import UserSerializer, CategorySerializer, ProductSerializer, ProductImageSerializer, OrderSerializer, OrderItemSerializer, PaymentSerializer, AddressSerializer
+from .models import User, UserRole, Category, Product, ProductImage, Order, OrderItem, Payment, Address
+from .serializers import UserSerializer, CategorySerializer, ProductSerializer, ProductImageSerializer, OrderSerializer, OrderItemSerializer, PaymentSerializer, AddressSerializer, ExportParamsSerializer, ImportUploadSerializer, OrderTransitionSerializer, StockMovementSerializer, AvailabilityParamsSerializer, AnalyticsParamsSerializer, ClaimsTokenObtainPairSerializer, LoginSerializer
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework import viewsets, permissions, status
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from .permissions import IsAdminOrReadOnly
+from .authentication import CachedJWTAuthentication
+from .permissions import IsAdminOrReadOnly, IsAdminRole
+from .analytics import sales_report
+from .cache import CachedReadMixin, stats as cache_stats
+from .exports import DATASETS, FORMATS, iter_export
+from .imports import IMPORTERS, import_rows, text_stream
+from .stock import available, record_movement
+from .transitions import transition_orders
+from rest_framework.parsers import MultiPartParser
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotFound, Throttled
+from asgiref.sync import sync_to_async
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from django.contrib.auth.models import update_last_login
+from .hashing import acheck_password, amake_password
+from .asyncread import AsyncReadMixin
+from .fastread import FastReadMixin
+from .metrics import registry as metrics_registry
+from .mixins import ExpandMixin, SparseFieldsMixin
+from rest_framework.views import APIView
+from .search import TRUNCATED_HEADER, ProductSearchFilter
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters
 from rest_framework.response import Response
+from rest_framework.decorators import action
+from .filters import ProductFilter
 
 # Create your views here.
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(FastReadMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = User.objects.all().order_by('email')
     serializer_class = UserSerializer
     
@@ -23,56 +50,125 @@ class UserViewSet(viewsets.ModelViewSet):
             permission_classes = [IsAuthenticated]
         return [permission() for permission in permission_classes]
     
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CachedReadMixin, FastReadMixin, SparseFieldsMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all().order_by('name')
     serializer_class = CategorySerializer
     permission_classes = [IsAdminOrReadOnly]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
+    cache_dependencies = ('products.category',)
     
-class ProductViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        """The category with all of its descendants, nested, fetched in a single query."""
+        root = self.get_object()
+        nodes = {}
+        tree = None
+        # Ordering by path puts every parent before its children.
+        for category in root.get_descendants(include_self=True).order_by('path'):
+            node = dict(CategorySerializer(category, context=self.get_serializer_context()).data, children=[])
+            nodes[category.pk] = node
+            if category.pk == root.pk:
+                tree = node
+            else:
+                nodes[category.parent_id]['children'].append(node)
+        return Response(tree)
+    
+class ProductViewSet(CachedReadMixin, FastReadMixin, SparseFieldsMixin, ExpandMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all().order_by('name')
     serializer_class = ProductSerializer
     permission_classes = [IsAdminOrReadOnly]
-    authentication_classes = (JWTAuthentication,)
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    # Fields you can filter by exact match
-    filterset_fields = ['category', 'is_active', 'price', 'stock_quantity']
-    # Fields to allow text search (partial matches)
+    authentication_classes = (CachedJWTAuthentication,)
+    cache_dependencies = ('products.product', 'products.category', 'products.productimage')
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter, ProductSearchFilter]
+    # Fields you can filter by exact match, plus ?category_tree=<id> for a whole subtree
+    filterset_class = ProductFilter
+    # Fields to allow text search (partial matches); prefer the indexed, ranked ?q=
     search_fields = ['name', 'description']
     # Fields you can order by
     ordering_fields = ['name', 'price', 'stock_quantity', 'created_at', 'updated_at']
     ordering = ['name']  # Default ordering for DRF
+    # Set on ?q= pages the in-process search index had to cut short (products/search.py)
+    cached_headers = (TRUNCATED_HEADER,)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        limit = getattr(self.request, 'search_truncated', None)
+        if limit is not None:
+            response[TRUNCATED_HEADER] = str(limit)
+        return response
+
+    @action(detail=False, methods=['get'], serializer_class=AvailabilityParamsSerializer)
+    def availability(self, request):
+        """
+        Units available right now for ?ids=<id>,<id>,..., counting stock
+        movements not yet folded into stock_quantity. One query, never cached.
+        """
+        params = AvailabilityParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        units = available(params.validated_data['ids'])
+        return Response({
+            'results': [{'product_id': pk, 'available': units[pk]} for pk in params.validated_data['ids'] if pk in units],
+        })
+
+    @action(detail=True, methods=['post'], serializer_class=StockMovementSerializer)
+    def stock(self, request, pk=None):
+        """Admins: record a restock, return or adjustment without locking the product row."""
+        product = self.get_object()
+        movement = StockMovementSerializer(data=request.data)
+        movement.is_valid(raise_exception=True)
+        record_movement(product.pk, **movement.validated_data)
+        return Response({'product_id': product.pk, 'available': available([product.pk])[product.pk]},
+                        status=status.HTTP_201_CREATED)
     
-class ProductImageViewSet(viewsets.ModelViewSet):
+class ProductImageViewSet(CachedReadMixin, FastReadMixin, SparseFieldsMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = ProductImage.objects.all().order_by('created_at')
     serializer_class = ProductImageSerializer
     permission_classes = [IsAdminOrReadOnly]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
+    cache_dependencies = ('products.productimage',)
     
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(FastReadMixin, SparseFieldsMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all().order_by('-created_at')
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    ordering_fields = ['created_at', 'updated_at', 'total_amount']
     
     # Users will view their own orders
     def get_queryset(self):
         return Order.objects.filter(user=self.request.user).order_by('created_at')
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminRole], serializer_class=OrderTransitionSerializer)
+    def transition(self, request):
+        """
+        Admins: move every order in `order_ids`, or matching the filters, to
+        `status` where ORDER_TRANSITIONS allows it, in set-based batches.
+        Returns how many orders changed and how many were skipped, per status.
+        """
+        params = OrderTransitionSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        result = transition_orders(
+            params.orders(), params.validated_data['status'], order_ids=params.validated_data.get('order_ids'),
+        )
+        return Response(result.as_dict())
     
-class OrderItemViewSet(viewsets.ModelViewSet):
+class OrderItemViewSet(FastReadMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = OrderItem.objects.all().order_by('created_at')
     serializer_class = OrderItemSerializer
     permission_classes = [IsAuthenticated]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
     
     def get_queryset(self):
         return OrderItem.objects.filter(order__user=self.request.user).order_by('created_at')
 
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(FastReadMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = Payment.objects.all().order_by('-created_at')
     serializer_class = PaymentSerializer
     permission_classes = [IsAuthenticated]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    ordering_fields = ['created_at', 'updated_at', 'amount']
     
     def get_queryset(self):
         # Limit payments to those belonging to the current user's orders.
@@ -106,15 +202,184 @@ class PaymentViewSet(viewsets.ModelViewSet):
             status=status.HTTP_405_METHOD_NOT_ALLOWED
         )
         
-class AddressViewSet(viewsets.ModelViewSet):
+class AddressViewSet(FastReadMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     queryset = Address.objects.all().order_by('created_at')
     serializer_class = AddressSerializer
     permission_classes = [IsAuthenticated]
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
     
     def get_queryset(self):
         return Address.objects.filter(user=self.request.user).order_by('created_at')
     
     def perform_create(self, serializer):
         # Ensure the address is tied to the logged-in user
-        serializer.save(user=self.request.user)
\ No newline at end of file
+        serializer.save(user=self.request.user)
+
+class CatalogCacheStatsView(APIView):
+    """
+    Hit and miss counters of the catalog response cache, per endpoint.
+    Counters are kept per worker process.
+    """
+    permission_classes = [IsAdminRole]
+    authentication_classes = (CachedJWTAuthentication,)
+
+    def get(self, request):
+        counts = cache_stats.snapshot()
+        hits = sum(c['hits'] for c in counts.values())
+        misses = sum(c['misses'] for c in counts.values())
+        return Response({
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'endpoints': counts,
+        })
+
+class MetricsView(APIView):
+    """
+    Per-endpoint latency, query, serializer and response size histograms in
+    Prometheus text format. Values are kept per worker process.
+    """
+    permission_classes = [IsAdminRole]
+    authentication_classes = (CachedJWTAuthentication,)
+
+    def get(self, request):
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class ExportView(APIView):
+    """
+    Stream every order, order item or payment matching the filters as NDJSON or CSV.
+    Filters: ?start= and ?end= on created_at, ?status=; choose the output with ?file_format=.
+    """
+    permission_classes = [IsAdminRole]
+    authentication_classes = (CachedJWTAuthentication,)
+
+    def perform_content_negotiation(self, request, force=False):
+        # The export body is not rendered by DRF; only errors are, as JSON.
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, dataset):
+        spec = DATASETS.get(dataset)
+        if spec is None:
+            raise NotFound(f'Unknown export "{dataset}".')
+        params = ExportParamsSerializer(data=request.query_params, context={'dataset': spec})
+        params.is_valid(raise_exception=True)
+        file_format = params.validated_data.pop('file_format')
+        rows = spec.queryset(**params.validated_data)
+        response = StreamingHttpResponse(iter_export(spec, rows, file_format), content_type=FORMATS[file_format])
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{file_format}"'
+        return response
+
+class ImportView(APIView):
+    """
+    Insert or update categories, products or product images from an uploaded
+    CSV or NDJSON file (multipart field `file`). Returns the per-row error report.
+    """
+    permission_classes = [IsAdminRole]
+    authentication_classes = (CachedJWTAuthentication,)
+    parser_classes = [MultiPartParser]
+    max_errors = 1000
+
+    def post(self, request, dataset):
+        if dataset not in IMPORTERS:
+            raise NotFound(f'Unknown import "{dataset}".')
+        upload = ImportUploadSerializer(data=request.data)
+        upload.is_valid(raise_exception=True)
+        report = import_rows(
+            dataset, text_stream(upload.validated_data['file'].file), upload.validated_data['file_format'],
+        )
+        return Response(report.as_dict(max_errors=self.max_errors))
+
+class AnalyticsView(APIView):
+    """
+    Sales totals, revenue per day and per category, and top-selling products
+    for ?start= .. ?end= (inclusive dates). Reads only the sales rollups.
+    """
+    permission_classes = [IsAdminRole]
+    authentication_classes = (CachedJWTAuthentication,)
+
+    def get(self, request):
+        params = AnalyticsParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        report = sales_report(**params.validated_data)
+        return Response(dict(
+            start=params.validated_data.get('start'), end=params.validated_data.get('end'), **report,
+        ))
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAuthView(View):
+    """
+    Base for the async login and registration views. They are plain async
+    Django views rather than DRF ones, so under ASGI the request never holds a
+    thread while its password is hashed (see products/hashing.py). Parsing,
+    throttling and error bodies follow DRF's, so clients see the same API.
+    """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+    www_authenticate = 'Bearer realm="api"'
+
+    async def post(self, request):
+        drf_request = Request(request, parsers=[parser() for parser in self.parser_classes])
+        try:
+            await sync_to_async(self.check_throttles)(drf_request)
+            return await self.handle(drf_request)
+        except APIException as exc:
+            return self.error_response(exc)
+
+    async def handle(self, request):
+        raise NotImplementedError
+
+    def check_throttles(self, request):
+        waits = [throttle.wait() for throttle in (cls() for cls in self.throttle_classes)
+                 if not throttle.allow_request(request, self)]
+        if waits:
+            raise Throttled(max((wait for wait in waits if wait is not None), default=None))
+
+    def json_response(self, data, status=status.HTTP_200_OK):
+        return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+    def error_response(self, exc):
+        detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+        response = self.json_response(detail, status=exc.status_code)
+        if getattr(exc, 'wait', None):
+            response['Retry-After'] = '%d' % exc.wait
+        if isinstance(exc, AuthenticationFailed):
+            response['WWW-Authenticate'] = self.www_authenticate
+        return response
+
+class AsyncTokenObtainPairView(AsyncAuthView):
+    """
+    POST email and password for a refresh and access token pair; the same
+    contract as simplejwt's TokenObtainPairView, with the password check run on
+    the hashing executor.
+    """
+
+    async def handle(self, request):
+        credentials = LoginSerializer(data=request.data)
+        credentials.is_valid(raise_exception=True)
+        email, password = credentials.validated_data['email'], credentials.validated_data['password']
+        user = await User._default_manager.filter(**{User.USERNAME_FIELD: email}).afirst()
+        # Unknown users are still checked (against nothing), so both cases take as long.
+        matches, upgraded = await acheck_password(password, user.password if user else None)
+        if not matches or not jwt_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(
+                ClaimsTokenObtainPairSerializer.default_error_messages['no_active_account'], code='no_active_account',
+            )
+        if upgraded:
+            await User._default_manager.filter(pk=user.pk).aupdate(password=upgraded)
+        if jwt_settings.UPDATE_LAST_LOGIN:
+            await sync_to_async(update_last_login)(None, user)
+        refresh = await sync_to_async(ClaimsTokenObtainPairSerializer.get_token)(user)
+        return self.json_response({'refresh': str(refresh), 'access': str(refresh.access_token)})
+
+class AsyncRegisterView(AsyncAuthView):
+    """
+    Create a customer account; the body and response are those of POST
+    /api/users/, except that a submitted `role` is ignored.
+    """
+
+    async def handle(self, request):
+        serializer = UserSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)  # runs no queries, uniqueness is left to the insert
+        encoded = await amake_password(serializer.validated_data['password'])
+        await sync_to_async(serializer.save)(password_hash=encoded, role=UserRole.CUSTOMER)
+        return self.json_response(serializer.data, status=status.HTTP_201_CREATED)